@@ -0,0 +1,462 @@
+"""
+Анализ аудио: отпечаток, громкость и данные для бесшовного воспроизведения.
+
+Длительность, частота дискретизации и битрейт берутся из заголовков
+(mutagen, в ingest.read_audio_metadata). Здесь - то, для чего нужен
+декодированный сигнал:
+
+    отпечаток  - первые FINGERPRINT_SECONDS, моно 5512 Гц. Сигнал
+                 раскладывается вейвлет-пакетом Хаара на BANDS полос, на
+                 каждом кадре считаются энергии полос, и каждый бит
+                 подотпечатка - знак изменения разности энергий соседних
+                 полос между соседними кадрами (схема Haitsma-Kalker, как
+                 у chromaprint - переживает перекодирование и смену битрейта).
+                 Хранится как массив uint16, по одному на кадр;
+    громкость  - интегральная громкость по BS.1770 (K-фильтр, стробирование
+                 -70 LUFS и -10 LU), в LUFS, и пик (доля полной шкалы).
+                 Из них - усиление до REFERENCE_LOUDNESS (как ReplayGain 2.0),
+                 ограниченное пиком, чтобы не было клиппинга (replay_gain);
+    задержка   - для MP3 из тега LAME/Info: сколько отсчетов в начале
+                 декодированного сигнала (задержка кодера + декодера) и в конце
+                 (добивка последнего кадра) не относятся к записи. Плееру это
+                 нужно, чтобы переходить к следующему треку без паузы.
+
+Декодирует локальный ffmpeg (один проход: PCM для отпечатка в stdout,
+громкость и истинный пик - фильтром ebur128). Без ffmpeg разбираются только WAV (модуль
+wave): сигнал сводится в моно, громкость считается на 11025 Гц с
+поправкой на число каналов - это приближение.
+
+Результат привязан к пути файла в хранилище (audio_analysis.source):
+одинаковые загрузки анализируются один раз. Похожие записи ищутся по
+индексу длительности и сравниваются по доле несовпавших бит (find_duplicates).
+Досчитать старые треки:
+
+    python analysis.py [--db music.db] [--uploads uploads] [--force]
+"""
+import math
+import os
+import re
+import subprocess
+import wave
+from array import array
+
+FINGERPRINT_RATE = 5512
+FINGERPRINT_SECONDS = 120
+# Кадр 1024 отсчета (~186 мс) с шагом в полкадра
+FRAME_SIZE = 1024
+FRAME_STEP = 512
+BAND_LEVELS = 4
+BANDS = 2 ** BAND_LEVELS
+
+LOUDNESS_RATE = 11025
+ABSOLUTE_GATE = -70.0
+RELATIVE_GATE = -10.0
+
+# Доля несовпавших бит, ниже которой записи считаются одной и той же
+DUPLICATE_BER = 0.2
+DUPLICATE_DURATION_DELTA = 2.0
+MAX_SHIFT = 3
+MIN_COMPARE_FRAMES = 50
+
+ANALYZE_TIMEOUT = 900
+ERROR_MAX_LENGTH = 200
+LOUDNESS_RE = re.compile(r'I:\s+(-?\d+(?:\.\d+)?) LUFS')
+PEAK_RE = re.compile(r'Peak:\s+(-?\d+(?:\.\d+)?|-inf) dBFS')
+
+# Целевая громкость (ReplayGain 2.0) и запас до полной шкалы
+REFERENCE_LOUDNESS = -18.0
+
+# Тег Xing/Info ищется в первом кадре; LAME-расширение идет за ним
+GAPLESS_SCAN_BYTES = 4096
+XING_MAX_OFFSET = 40
+LAME_ENCODERS = (b'LAME', b'Lavc', b'Lavf')
+# Задержка декодера MP3 (отсчетов) - в тег LAME не входит
+MP3_DECODER_DELAY = 529
+# Форматы, где контейнер сам отрезает лишние отсчеты
+GAPLESS_NATIVE = ('wav', 'ogg')
+
+
+def init_schema(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS audio_analysis
+                 (source TEXT PRIMARY KEY,
+                  duration REAL,
+                  sample_rate INTEGER,
+                  bitrate INTEGER,
+                  loudness REAL,
+                  fingerprint BLOB,
+                  analyzed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+    for column in ('peak REAL', 'encoder_delay INTEGER', 'encoder_padding INTEGER'):
+        try:
+            c.execute(f"ALTER TABLE audio_analysis ADD COLUMN {column}")
+        except:
+            pass
+    # Кандидаты в дубликаты - по близкой длительности
+    c.execute("CREATE INDEX IF NOT EXISTS idx_audio_analysis_duration ON audio_analysis(duration)")
+    c.execute("DROP TRIGGER IF EXISTS analysis_blobs_ad")
+    c.execute("""CREATE TRIGGER analysis_blobs_ad AFTER DELETE ON blobs BEGIN
+                     DELETE FROM audio_analysis WHERE source = old.path;
+                 END""")
+
+
+# === Декодирование ===
+
+def _downmix(samples, channels):
+    if channels == 1:
+        return samples
+    mixed = [0] * (len(samples) // channels)
+    for ch in range(channels):
+        mixed = [a + b for a, b in zip(mixed, samples[ch::channels])]
+    return [value / channels for value in mixed]
+
+
+def _decimate(samples, factor):
+    """Понижение частоты усреднением соседних отсчетов (грубый ФНЧ)"""
+    if factor <= 1:
+        return samples
+    whole = len(samples) - len(samples) % factor
+    sums = samples[0:whole:factor]
+    for k in range(1, factor):
+        sums = [a + b for a, b in zip(sums, samples[k:whole:factor])]
+    return [value / factor for value in sums]
+
+
+def decode_wav(path, rate, max_seconds=None):
+    """(моно-сигнал на частоте около rate в int16-шкале, частота, каналы, пик); None - формат не PCM 16 бит"""
+    try:
+        with wave.open(path, 'rb') as wav:
+            if wav.getsampwidth() != 2:
+                return None
+            channels = wav.getnchannels()
+            source_rate = wav.getframerate()
+            factor = max(1, round(source_rate / rate))
+            limit = wav.getnframes() if max_seconds is None else min(wav.getnframes(), int(max_seconds * source_rate))
+            block = source_rate - source_rate % factor or factor
+            signal = []
+            peak = 0
+            read = 0
+            while read < limit:
+                data = array('h')
+                data.frombytes(wav.readframes(min(block, limit - read)))
+                if not data:
+                    break
+                read += len(data) // channels
+                peak = max(peak, max(data), -min(data))
+                signal.extend(_decimate(_downmix(data, channels), factor))
+            return signal, source_rate / factor, channels, peak / 32768.0
+    except (wave.Error, EOFError):
+        return None
+
+
+def decode_ffmpeg(ffmpeg, path):
+    """Один проход ffmpeg: (сигнал для отпечатка, громкость LUFS или None, истинный пик или None)"""
+    command = [ffmpeg, '-hide_banner', '-nostats', '-nostdin', '-i', path,
+               '-map', '0:a:0', '-t', str(FINGERPRINT_SECONDS), '-ac', '1', '-ar', str(FINGERPRINT_RATE),
+               '-f', 's16le', 'pipe:1',
+               '-map', '0:a:0', '-af', 'ebur128=framelog=verbose:peak=true', '-f', 'null', '-']
+    result = subprocess.run(command, capture_output=True, timeout=ANALYZE_TIMEOUT)
+    stderr = result.stderr.decode('utf-8', 'replace')
+    if result.returncode != 0:
+        raise RuntimeError(stderr.strip()[-ERROR_MAX_LENGTH:] or f"ffmpeg exit {result.returncode}")
+    samples = array('h')
+    samples.frombytes(result.stdout[:len(result.stdout) - len(result.stdout) % 2])
+    found = LOUDNESS_RE.findall(stderr)
+    loudness = float(found[-1]) if found else None
+    if loudness is not None and loudness <= ABSOLUTE_GATE:
+        loudness = None
+    found = PEAK_RE.findall(stderr)
+    peak = 10 ** (float(found[-1]) / 20) if found and found[-1] != '-inf' else None
+    return samples, loudness, peak
+
+
+# === Отпечаток ===
+
+def _haar_bands(signal, levels):
+    """Вейвлет-пакет Хаара: 2^levels полос, каждая в 2^levels раз короче сигнала"""
+    bands = [list(signal)]
+    for _ in range(levels):
+        split = []
+        for band in bands:
+            even, odd = band[0::2], band[1::2]
+            split.append([a + b for a, b in zip(even, odd)])
+            split.append([a - b for a, b in zip(even, odd)])
+        bands = split
+    return bands
+
+
+def fingerprint(signal):
+    """Подотпечатки uint16 (BANDS - 1 бит на кадр) или None для слишком короткого сигнала"""
+    bands = _haar_bands(signal, BAND_LEVELS)
+    frame = FRAME_SIZE // BANDS
+    step = FRAME_STEP // BANDS
+    length = len(bands[0])
+    if length < frame * 2:
+        return None
+    energies = []
+    for start in range(0, length - frame + 1, step):
+        energies.append([sum(v * v for v in band[start:start + frame]) for band in bands])
+    words = array('H')
+    for prev, cur in zip(energies, energies[1:]):
+        word = 0
+        for m in range(BANDS - 1):
+            if (cur[m] - cur[m + 1]) - (prev[m] - prev[m + 1]) > 0:
+                word |= 1 << m
+        words.append(word)
+    return words
+
+
+def fingerprint_bytes(words):
+    return words.tobytes() if words is not None else None
+
+
+def _words(data):
+    words = array('H')
+    words.frombytes(data)
+    return words
+
+
+def bit_error_rate(a, b):
+    """Минимальная доля несовпавших бит при сдвиге до MAX_SHIFT кадров"""
+    a, b = _words(a), _words(b)
+    best = 1.0
+    for shift in range(-MAX_SHIFT, MAX_SHIFT + 1):
+        x = a[shift:] if shift > 0 else a
+        y = b[-shift:] if shift < 0 else b
+        count = min(len(x), len(y))
+        if count < MIN_COMPARE_FRAMES:
+            continue
+        errors = sum(bin(p ^ q).count('1') for p, q in zip(x[:count], y[:count]))
+        best = min(best, errors / (count * (BANDS - 1)))
+    return best
+
+
+# === Громкость (без ffmpeg) ===
+
+def _biquad(signal, b, a):
+    b0, b1, b2 = b
+    _, a1, a2 = a
+    x1 = x2 = y1 = y2 = 0.0
+    out = []
+    append = out.append
+    for x in signal:
+        y = b0 * x + b1 * x1 + b2 * x2 - a1 * y1 - a2 * y2
+        x2, x1, y2, y1 = x1, x, y1, y
+        append(y)
+    return out
+
+
+def _k_weighting(rate):
+    """Коэффициенты двух каскадов K-фильтра BS.1770 для частоты rate"""
+    k = math.tan(math.pi * 1681.974450955533 / rate)
+    vh = 10 ** (3.999843853973347 / 20)
+    vb = vh ** 0.4996667741545416
+    q = 0.7071752369554196
+    a0 = 1 + k / q + k * k
+    shelf = ((vh + vb * k / q + k * k) / a0, 2 * (k * k - vh) / a0, (vh - vb * k / q + k * k) / a0), \
+            (1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0)
+    k = math.tan(math.pi * 38.13547087602444 / rate)
+    q = 0.5003270373238773
+    a0 = 1 + k / q + k * k
+    highpass = (1.0, -2.0, 1.0), (1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0)
+    return shelf, highpass
+
+
+def integrated_loudness(signal, rate, channels=1):
+    """Интегральная громкость моно-сигнала (int16-шкала), LUFS или None (тишина)"""
+    for b, a in _k_weighting(rate):
+        signal = _biquad(signal, b, a)
+    # Блоки 400 мс с шагом 100 мс собираются из средних квадратов 100-мс отрезков
+    quarter = int(rate * 0.1)
+    scale = 32768.0 * 32768.0
+    powers = [sum(v * v for v in signal[i:i + quarter]) / (quarter * scale)
+              for i in range(0, len(signal) - quarter + 1, quarter)]
+    # Моно-сумма коррелированных каналов на 10*log10(каналы) тише суммы мощностей каналов
+    gain = float(channels)
+    blocks = [gain * sum(powers[i:i + 4]) / 4 for i in range(len(powers) - 3)]
+
+    def lufs(power):
+        return -0.691 + 10 * math.log10(power) if power > 0 else -math.inf
+
+    gated = [p for p in blocks if lufs(p) > ABSOLUTE_GATE]
+    if not gated:
+        return None
+    threshold = lufs(sum(gated) / len(gated)) + RELATIVE_GATE
+    gated = [p for p in gated if lufs(p) > threshold]
+    return round(lufs(sum(gated) / len(gated)), 2) if gated else None
+
+
+def replay_gain(loudness, peak=None):
+    """Усиление до REFERENCE_LOUDNESS в дБ, не выше запаса до пика; None - громкость неизвестна"""
+    if loudness is None:
+        return None
+    gain = REFERENCE_LOUDNESS - loudness
+    if peak:
+        gain = min(gain, -20 * math.log10(peak))
+    return round(gain, 2)
+
+
+def album_gain(tracks):
+    """
+    Общее усиление для треков альбома (dict с loudness, peak, duration):
+    громкость - среднее по мощности, взвешенное длительностью, пик - наибольший.
+    Внутри альбома сохраняется разница громкости между треками.
+    None - если хоть один трек не измерен (тогда плеер берет усиление трека).
+    """
+    measured = [t for t in tracks if t.get('loudness') is not None]
+    if not measured or len(measured) < len(tracks):
+        return None
+    weights = [t.get('duration') or 1.0 for t in measured]
+    power = sum(w * 10 ** (t['loudness'] / 10) for w, t in zip(weights, measured)) / sum(weights)
+    peaks = [t['peak'] for t in measured if t.get('peak')]
+    return replay_gain(10 * math.log10(power), max(peaks) if peaks else None)
+
+
+# === Бесшовное воспроизведение ===
+
+def _lame_tag(path):
+    """(задержка кодера, добивка) из тега LAME; None - тега нет"""
+    with open(path, 'rb') as f:
+        head = f.read(10)
+        offset = 0
+        if len(head) == 10 and head[:3] == b'ID3':
+            size = (head[6] & 0x7f) << 21 | (head[7] & 0x7f) << 14 | (head[8] & 0x7f) << 7 | (head[9] & 0x7f)
+            offset = 10 + size + (10 if head[5] & 0x10 else 0)
+        f.seek(offset)
+        data = f.read(GAPLESS_SCAN_BYTES)
+    start = data.find(b'\xff')
+    while start != -1 and start + 1 < len(data) and data[start + 1] & 0xe0 != 0xe0:
+        start = data.find(b'\xff', start + 1)
+    if start == -1:
+        return None
+    for marker in (b'Xing', b'Info'):
+        pos = data.find(marker, start, start + XING_MAX_OFFSET + len(marker))
+        if pos != -1:
+            break
+    else:
+        return None
+    flags = int.from_bytes(data[pos + 4:pos + 8], 'big')
+    # Кадры, байты, оглавление (100 байт), качество - если есть по флагам
+    lame = pos + 8 + (4 if flags & 1 else 0) + (4 if flags & 2 else 0) + (100 if flags & 4 else 0) + (4 if flags & 8 else 0)
+    if len(data) < lame + 24 or data[lame:lame + 4] not in LAME_ENCODERS:
+        return None
+    raw = data[lame + 21:lame + 24]
+    return raw[0] << 4 | raw[1] >> 4, (raw[1] & 0x0f) << 8 | raw[2]
+
+
+def gapless(path):
+    """
+    (задержка, добивка) в отсчетах декодированного сигнала: столько в начале
+    и в конце не относится к записи. (None, None) - неизвестно.
+    """
+    ext = path.rsplit('.', 1)[-1].lower()
+    if ext in GAPLESS_NATIVE:
+        return 0, 0
+    if ext != 'mp3':
+        return None, None
+    tag = _lame_tag(path)
+    if tag is None:
+        return None, None
+    delay, padding = tag
+    return delay + MP3_DECODER_DELAY, max(0, padding - MP3_DECODER_DELAY)
+
+
+# === Анализ файла ===
+
+def analyze(path, ffmpeg=None):
+    """
+    {'fingerprint', 'loudness', 'peak', 'encoder_delay', 'encoder_padding'};
+    без декодера отпечаток, громкость и пик - None (задержка читается из тега)
+    """
+    result = {'fingerprint': None, 'loudness': None, 'peak': None}
+    result['encoder_delay'], result['encoder_padding'] = gapless(path)
+    if ffmpeg:
+        samples, result['loudness'], result['peak'] = decode_ffmpeg(ffmpeg, path)
+        result['fingerprint'] = fingerprint_bytes(fingerprint(samples))
+        return result
+    if not path.lower().endswith('.wav'):
+        return result
+    decoded = decode_wav(path, LOUDNESS_RATE)
+    if decoded is None:
+        return result
+    signal, rate, channels, result['peak'] = decoded
+    result['loudness'] = integrated_loudness(signal, rate, channels)
+    head = signal[:int(FINGERPRINT_SECONDS * rate)]
+    result['fingerprint'] = fingerprint_bytes(fingerprint(_decimate(head, max(1, round(rate / FINGERPRINT_RATE)))))
+    return result
+
+
+def save(c, source, meta):
+    """Записать результат анализа файла (внутри транзакции вызывающего)"""
+    c.execute("""INSERT OR REPLACE INTO audio_analysis
+                     (source, duration, sample_rate, bitrate, loudness, peak, encoder_delay, encoder_padding, fingerprint)
+                 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+              (source, meta.get('duration'), meta.get('sample_rate'), meta.get('bitrate'), meta.get('loudness'),
+               meta.get('peak'), meta.get('encoder_delay'), meta.get('encoder_padding'), meta.get('fingerprint')))
+
+
+def load(c, source):
+    c.execute("SELECT * FROM audio_analysis WHERE source = ?", (source,))
+    return c.fetchone()
+
+
+def find_duplicates(c, source, threshold=DUPLICATE_BER):
+    """Другие файлы с той же записью: [(source, доля несовпавших бит)] по возрастанию"""
+    row = load(c, source)
+    if not row or row['fingerprint'] is None or row['duration'] is None:
+        return []
+    c.execute("""SELECT source, fingerprint FROM audio_analysis
+                 WHERE duration BETWEEN ? AND ? AND source != ? AND fingerprint IS NOT NULL""",
+              (row['duration'] - DUPLICATE_DURATION_DELTA, row['duration'] + DUPLICATE_DURATION_DELTA, source))
+    matches = []
+    for other, data in c.fetchall():
+        ber = bit_error_rate(row['fingerprint'], data)
+        if ber < threshold:
+            matches.append((other, round(ber, 4)))
+    return sorted(matches, key=lambda m: m[1])
+
+
+if __name__ == '__main__':
+    import argparse
+
+    import db
+    import ingest
+    import transcode
+
+    parser = argparse.ArgumentParser(description='Досчитать длительность, битрейт, отпечаток, громкость и задержку кодера треков')
+    parser.add_argument('--db', default='music.db', help='файл базы данных')
+    parser.add_argument('--uploads', default='uploads', help='каталог загрузок')
+    parser.add_argument('--force', action='store_true', help='пересчитать и уже проанализированные файлы')
+    args = parser.parse_args()
+
+    ffmpeg = transcode.find_ffmpeg(os.environ.get('TRANSCODE_FFMPEG'))
+    conn = db.connect(args.db)
+    init_schema(conn)
+    conn.commit()
+    c = conn.cursor()
+    c.execute("""SELECT DISTINCT t.filename FROM tracks t
+                 LEFT JOIN audio_analysis a ON a.source = t.filename
+                 WHERE t.filename IS NOT NULL AND t.filename != ''""" +
+              ("" if args.force else " AND a.source IS NULL"))
+    sources = [row[0] for row in c.fetchall()]
+    done = 0
+    for source in sources:
+        path = os.path.join(args.uploads, *source.split('/'))
+        if not os.path.isfile(path):
+            continue
+        try:
+            meta = ingest.read_audio_metadata(path)
+            meta.update(analyze(path, ffmpeg))
+        except Exception as e:
+            print(f"{source}: {e}")
+            continue
+        c.execute("BEGIN IMMEDIATE")
+        save(c, source, meta)
+        c.execute("""UPDATE tracks SET duration = COALESCE(?, duration), sample_rate = ?, bitrate = ?, loudness = ?,
+                         gain = ?, peak = ?, encoder_delay = ?, encoder_padding = ?
+                     WHERE filename = ?""",
+                  (meta['duration'], meta['sample_rate'], meta['bitrate'], meta['loudness'],
+                   replay_gain(meta['loudness'], meta['peak']), meta['peak'],
+                   meta['encoder_delay'], meta['encoder_padding'], source))
+        conn.commit()
+        done += 1
+    conn.close()
+    print(f"Analyzed {done} of {len(sources)} file(s)" + ("" if ffmpeg else " (no ffmpeg: only WAV fingerprints/loudness)"))
@@ -1,16 +1,37 @@
 import os
+import atexit
+import threading
+import time
 import sqlite3
 import base64
 import hashlib
 import hmac
 import json
 import urllib.parse
-from datetime import datetime
+from datetime import datetime, timezone
 from functools import wraps
-from flask import Flask, render_template, request, jsonify, send_from_directory, redirect, url_for, session
+from flask import Flask, render_template, request, jsonify, send_from_directory, redirect, url_for, session, g, Response
 from werkzeug.utils import secure_filename
 from werkzeug.security import generate_password_hash, check_password_hash
 
+import db
+import lyrics as lrc
+import playcounter
+import streaming
+import blobstore
+import ingest
+import analysis
+import thumbnails
+import search
+import generations
+import pagecache
+import counters
+import playstats
+import trending
+import recommend
+import resumable
+import transcode
+
 try:
     from mutagen.mp3 import MP3
     from mutagen.id3 import ID3NoHeaderError
@@ -27,6 +48,26 @@ UPLOAD_FOLDER = 'uploads'
 DB_FILE = 'music.db'
 ALLOWED_EXTENSIONS = {'mp3', 'wav', 'ogg', 'jpg', 'jpeg', 'png'}
 TELEGRAM_BOT_TOKEN = os.environ.get('BOT_TOKEN', '')
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', db.DEFAULT_POOL_SIZE))
+# Отдача /uploads через фронтенд-сервер: '' (сам Flask), 'x-accel' (nginx) или 'x-sendfile'
+UPLOADS_OFFLOAD = os.environ.get('UPLOADS_OFFLOAD', '').lower() or None
+UPLOADS_ACCEL_PREFIX = os.environ.get('UPLOADS_ACCEL_PREFIX', '/protected-uploads/')
+PLAY_SPILL_FOLDER = 'play_spill'
+PLAY_FLUSH_INTERVAL_MS = int(os.environ.get('PLAY_FLUSH_INTERVAL_MS', playcounter.DEFAULT_FLUSH_INTERVAL_MS))
+PLAY_FLUSH_MAX_EVENTS = int(os.environ.get('PLAY_FLUSH_MAX_EVENTS', playcounter.DEFAULT_FLUSH_MAX_EVENTS))
+# Насколько могут устареть счетчики прослушиваний/лайков в ответах JSON API с ETag
+API_COUNTERS_MAX_AGE = int(os.environ.get('API_COUNTERS_MAX_AGE', 60))
+BLOB_SWEEP_INTERVAL = int(os.environ.get('BLOB_SWEEP_INTERVAL', blobstore.DEFAULT_SWEEP_INTERVAL))
+THUMB_CACHE_FOLDER = os.environ.get('THUMB_CACHE_FOLDER', 'thumb_cache')
+THUMB_CACHE_MAX_MB = int(os.environ.get('THUMB_CACHE_MAX_MB', thumbnails.DEFAULT_MAX_BYTES // (1024 * 1024)))
+INGEST_WORKERS = int(os.environ.get('INGEST_WORKERS', ingest.DEFAULT_WORKERS))
+COUNTER_RECONCILE_INTERVAL = int(os.environ.get('COUNTER_RECONCILE_INTERVAL', counters.DEFAULT_INTERVAL))
+PLAY_ROLLUP_INTERVAL = int(os.environ.get('PLAY_ROLLUP_INTERVAL', playstats.DEFAULT_INTERVAL))
+SIMILAR_REBUILD_INTERVAL = int(os.environ.get('SIMILAR_REBUILD_INTERVAL', recommend.DEFAULT_INTERVAL))
+RENDITIONS_FOLDER = os.environ.get('RENDITIONS_FOLDER', 'renditions')
+TRANSCODE_WORKERS = int(os.environ.get('TRANSCODE_WORKERS', transcode.DEFAULT_WORKERS))
+# Треки от этой длительности (сек) дополнительно режутся на сегменты HLS; 0 - выключено
+HLS_MIN_DURATION = int(os.environ.get('HLS_MIN_DURATION', transcode.DEFAULT_HLS_MIN_DURATION))
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
@@ -38,8 +79,12 @@ SSO_CLIENT_SECRET = os.environ.get('SSO_CLIENT_SECRET', '')
 SSO_REDIRECT_URI = "https://mp3.dreampartners.online/callback"
 
 # Инициализация БД
+# Полнотекстовый поиск доступен, если SQLite собран с FTS5 (проверяется в init_db)
+SEARCH_FTS_ENABLED = False
+
 def init_db():
-    conn = sqlite3.connect(DB_FILE)
+    global SEARCH_FTS_ENABLED
+    conn = db.connect(DB_FILE)
     c = conn.cursor()
     
     # Таблица пользователей
@@ -115,13 +160,35 @@ def init_db():
                   created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                   expires_at TIMESTAMP)''')
     
+    # Разобранные LRC (временная шкала строк для плеера)
+    c.execute('''CREATE TABLE IF NOT EXISTS lyrics_timelines
+                 (track_id INTEGER PRIMARY KEY,
+                  lyrics_hash TEXT,
+                  timeline TEXT,
+                  updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  FOREIGN KEY (track_id) REFERENCES tracks(id) ON DELETE CASCADE)''')
+    
+    playcounter.init_schema(c)
+    blobstore.init_schema(c)
+    ingest.init_schema(c)
+    analysis.init_schema(c)
+    transcode.init_schema(c)
+    resumable.init_schema(c)
+    
     # Индексы
     c.execute("CREATE INDEX IF NOT EXISTS idx_tracks_user_id ON tracks(user_id)")
     c.execute("CREATE INDEX IF NOT EXISTS idx_tracks_slug ON tracks(slug)")
     c.execute("CREATE INDEX IF NOT EXISTS idx_albums_user_id ON albums(user_id)")
     c.execute("CREATE INDEX IF NOT EXISTS idx_albums_slug ON albums(slug)")
+    # Триггеры версий ищут альбомы трека по track_id
+    c.execute("CREATE INDEX IF NOT EXISTS idx_album_tracks_track_id ON album_tracks(track_id)")
+    # Порядок треков альбома: MAX(sort_order) при добавлении и соседи при перемещении - по индексу
+    c.execute("CREATE INDEX IF NOT EXISTS idx_album_tracks_order ON album_tracks(album_id, sort_order)")
     c.execute("CREATE INDEX IF NOT EXISTS idx_users_telegram_id ON users(telegram_id)")
     c.execute("CREATE INDEX IF NOT EXISTS idx_users_nickname ON users(nickname)")
+    # Индексы для keyset-пагинации /api/tracks по (sort_order, id)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_tracks_public_order ON tracks(hidden, COALESCE(sort_order, 999999), id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_tracks_user_order ON tracks(user_id, COALESCE(sort_order, 999999), id)")
     
     # Создаем дефолтного админа если его нет
     c.execute("SELECT COUNT(*) FROM admins")
@@ -175,12 +242,301 @@ def init_db():
         c.execute("ALTER TABLE tracks ADD COLUMN likes_count INTEGER DEFAULT 0")
     except:
         pass
+    try:
+        c.execute("ALTER TABLE tracks ADD COLUMN updated_at TIMESTAMP")
+    except:
+        pass
+    try:
+        c.execute("ALTER TABLE tracks ADD COLUMN status TEXT DEFAULT 'ready'")
+    except:
+        pass
+    try:
+        c.execute("ALTER TABLE tracks ADD COLUMN ingest_error TEXT")
+    except:
+        pass
+    try:
+        c.execute("ALTER TABLE tracks ADD COLUMN duration REAL")
+    except:
+        pass
+    # Готов плейлист HLS (см. transcode.py)
+    try:
+        c.execute("ALTER TABLE tracks ADD COLUMN segmented INTEGER DEFAULT 0")
+    except:
+        pass
+    # Параметры аудио из ingest/analysis.py (громкость - интегральная, LUFS)
+    for column in ('sample_rate INTEGER', 'bitrate INTEGER', 'loudness REAL'):
+        try:
+            c.execute(f"ALTER TABLE tracks ADD COLUMN {column}")
+        except:
+            pass
+    # Нормализация громкости и бесшовные переходы: усиление (дБ), пик,
+    # лишние отсчеты в начале/конце декодированного сигнала (analysis.py)
+    for column in ('gain REAL', 'peak REAL', 'encoder_delay INTEGER', 'encoder_padding INTEGER'):
+        try:
+            c.execute(f"ALTER TABLE tracks ADD COLUMN {column}")
+        except:
+            pass
+    # Рейтинг "в тренде" (log2 затухающей суммы, см. trending.py)
+    trend_added = False
+    try:
+        c.execute("ALTER TABLE tracks ADD COLUMN trend_score REAL DEFAULT 0")
+        c.execute("ALTER TABLE albums ADD COLUMN trend_score REAL DEFAULT 0")
+        trend_added = True
+    except:
+        pass
+    if trend_added:
+        trending.rebuild(c)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_tracks_trending ON tracks(hidden, trend_score, id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_albums_trending ON albums(hidden, trend_score, id)")
+    
+    # FTS5-индексы поиска и триггеры поколений кэшей (после миграций - колонки уже есть)
+    SEARCH_FTS_ENABLED = search.init_schema(c)
+    generations.init_schema(c)
+    # Журнал изменений для сверки likes_count/plays_count
+    counters.init_schema(c)
+    # Почасовые/посуточные агрегаты журнала прослушиваний
+    playstats.init_schema(c)
+    # Индекс похожих треков (совместные прослушивания и лайки)
+    recommend.init_schema(c)
     
     conn.commit()
     conn.close()
 
 init_db()
 
+# Пул соединений: одно соединение на запрос, возвращается в пул в teardown
+db_pool = db.ConnectionPool(DB_FILE, size=DB_POOL_SIZE)
+
+def get_db():
+    """Соединение с БД для текущего запроса (берется из пула один раз)"""
+    if 'db_conn' not in g:
+        g.db_conn = db_pool.acquire()
+    return g.db_conn
+
+@app.teardown_appcontext
+def release_db(exception=None):
+    """Возвращаем соединение в пул после запроса"""
+    conn = g.pop('db_conn', None)
+    if conn is not None:
+        db_pool.release(conn)
+
+# Контентно-адресуемое хранилище загрузок (uploads/ab/cd/<sha256>.<ext>)
+blob_store = blobstore.BlobStore(UPLOAD_FOLDER)
+
+def ingest_upload(file_storage):
+    """Принять загруженный файл во временный файл хранилища, считая SHA-256 по ходу"""
+    ext = file_storage.filename.rsplit('.', 1)[1].lower()
+    return blob_store.ingest(file_storage.stream, ext)
+
+# Миниатюры обложек 64/256/512 (WebP/JPEG) с LRU-кэшем на диске
+thumb_cache = thumbnails.ThumbnailCache(UPLOAD_FOLDER, THUMB_CACHE_FOLDER,
+                                        max_bytes=THUMB_CACHE_MAX_MB * 1024 * 1024)
+blob_store.on_remove.append(thumb_cache.discard)
+thumb_cache.start()
+atexit.register(thumb_cache.stop)
+
+# Удаление файлов без ссылок (release_blob только уменьшает счетчик)
+blob_collector = blobstore.BlobCollector(DB_FILE, blob_store, interval=BLOB_SWEEP_INTERVAL)
+blob_collector.start()
+atexit.register(blob_collector.stop)
+
+@app.template_global()
+def thumb_url(filename, size=256):
+    """URL миниатюры обложки для шаблонов"""
+    return f"/thumbs/{size}/{filename}"
+
+# Локальный ffmpeg (с libmp3lame) для анализа и перекодирования; None - нет
+FFMPEG = transcode.find_ffmpeg(os.environ.get('TRANSCODE_FFMPEG'))
+
+# Фоновая обработка загрузок: теги, обложка из APIC, длительность, отпечаток и громкость
+ingest_queue = ingest.IngestQueue(DB_FILE, blob_store, workers=INGEST_WORKERS, thumbnails=thumb_cache,
+                                  ffmpeg=FFMPEG)
+ingest_queue.recover()
+ingest_queue.start()
+atexit.register(ingest_queue.stop)
+
+# Версии аудио пониженного битрейта (только при наличии локального ffmpeg с libmp3lame)
+transcoder = transcode.TranscodeQueue(DB_FILE, UPLOAD_FOLDER, RENDITIONS_FOLDER,
+                                      ffmpeg=FFMPEG,
+                                      workers=TRANSCODE_WORKERS, hls_min_duration=HLS_MIN_DURATION)
+blob_store.on_remove.append(transcoder.discard)
+transcoder.recover()
+transcoder.start()
+atexit.register(transcoder.stop)
+
+# Буфер прослушиваний: сбрасывается в БД пачками, переживает падение через spill-файлы
+play_counter = playcounter.PlayCounter(DB_FILE, PLAY_SPILL_FOLDER,
+                                       flush_interval_ms=PLAY_FLUSH_INTERVAL_MS,
+                                       flush_max_events=PLAY_FLUSH_MAX_EVENTS)
+play_counter.recover()
+play_counter.start()
+atexit.register(play_counter.stop)
+
+# Инкрементальная сверка счетчиков лайков и прослушиваний (журнал + обход пачками)
+counter_reconciler = counters.CounterReconciler(DB_FILE, interval=COUNTER_RECONCILE_INTERVAL)
+counter_reconciler.start()
+atexit.register(counter_reconciler.stop)
+
+# Сворачивание журнала прослушиваний в почасовые/посуточные агрегаты
+play_rollup = playstats.PlayRollup(DB_FILE, interval=PLAY_ROLLUP_INTERVAL)
+play_rollup.start()
+atexit.register(play_rollup.stop)
+
+# Индекс похожих треков для /api/tracks/<id>/similar и режима радио
+similarity_index = recommend.SimilarityIndex(DB_FILE, interval=SIMILAR_REBUILD_INTERVAL)
+similarity_index.start()
+atexit.register(similarity_index.stop)
+
+# Максимум параметров в одном IN (...) - с запасом под SQLITE_MAX_VARIABLE_NUMBER
+LIKED_IDS_CHUNK = 500
+
+def fill_is_liked(c, items, user_id, kind='track'):
+    """Проставить is_liked всей странице треков/альбомов одним запросом на лайки"""
+    table, column = ('album_likes', 'album_id') if kind == 'album' else ('likes', 'track_id')
+    liked_ids = set()
+    if user_id and items:
+        ids = list({item['id'] for item in items})
+        for i in range(0, len(ids), LIKED_IDS_CHUNK):
+            chunk = ids[i:i + LIKED_IDS_CHUNK]
+            placeholders = ','.join('?' * len(chunk))
+            c.execute(f"SELECT {column} FROM {table} WHERE user_id = ? AND {column} IN ({placeholders})",
+                      [user_id] + chunk)
+            liked_ids.update(row[0] for row in c.fetchall())
+    for item in items:
+        item['is_liked'] = item['id'] in liked_ids
+    return items
+
+# === ПРОЕКЦИЯ И ПАГИНАЦИЯ ТРЕКОВ ===
+
+# Поля, которые можно запросить через ?fields= (имя -> SQL выражение)
+TRACK_FIELDS = {
+    'id': 't.id',
+    'user_id': 't.user_id',
+    'title': 't.title',
+    'artist': 't.artist',
+    'filename': 't.filename',
+    'cover_filename': 't.cover_filename',
+    'lyrics': 't.lyrics',
+    'sort_order': 't.sort_order',
+    'hidden': 't.hidden',
+    'slug': 't.slug',
+    'created_at': 't.created_at',
+    'updated_at': 't.updated_at',
+    'is_pinned': 't.is_pinned',
+    'status': 't.status',
+    'duration': 't.duration',
+    'sample_rate': 't.sample_rate',
+    'bitrate': 't.bitrate',
+    'loudness': 't.loudness',
+    'gain': 't.gain',
+    'peak': 't.peak',
+    'segmented': 't.segmented',
+    'nickname': 'u.nickname',
+    'display_name': 'u.display_name',
+    'avatar_url': 'u.avatar_url',
+    'plays_count': 'COALESCE(t.plays_count, 0)',
+    'likes_count': 'COALESCE(t.likes_count, 0)',
+}
+# Поля списка по умолчанию - все, кроме тяжелого lyrics
+TRACK_LIST_FIELDS = [name for name in TRACK_FIELDS if name != 'lyrics']
+# Ключ сортировки списка треков (совпадает с выражением в индексах idx_tracks_*_order)
+TRACKS_ORDER_KEY = 'COALESCE(t.sort_order, 999999)'
+# ?sort= для /api/tracks -> (ключ сортировки, направление)
+TRACK_SORTS = {
+    'default': (TRACKS_ORDER_KEY, 'ASC'),
+    'trending': ('t.trend_score', 'DESC'),
+}
+TRACKS_PAGE_DEFAULT = 50
+TRACKS_PAGE_MAX = 200
+
+def track_select_fields(fields=None):
+    """SELECT-список для треков; fields=None - полная строка, как раньше"""
+    if fields is None:
+        return """t.*, u.nickname, u.display_name, u.avatar_url,
+                  COALESCE(t.plays_count, 0) as plays_count,
+                  COALESCE(t.likes_count, 0) as likes_count"""
+    names = ['id'] + [f.strip() for f in fields if f.strip() in TRACK_FIELDS and f.strip() != 'id']
+    return ', '.join(f"{TRACK_FIELDS[name]} AS {name}" for name in dict.fromkeys(names))
+
+def encode_cursor(*values):
+    """Непрозрачный курсор для keyset-пагинации"""
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (ValueError, TypeError):
+        raise ValueError('Invalid cursor')
+    if not isinstance(values, list) or len(values) != 2:
+        raise ValueError('Invalid cursor')
+    return values
+
+def parse_db_timestamp(value):
+    """TIMESTAMP из SQLite ('YYYY-MM-DD HH:MM:SS', UTC) -> datetime"""
+    if not value:
+        return None
+    try:
+        return datetime.strptime(str(value)[:19], '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc)
+    except ValueError:
+        return None
+
+def conditional_json(payload, last_modified=None):
+    """JSON-ответ с ETag/Last-Modified; при совпадении отдает 304 без тела"""
+    response = jsonify(payload)
+    response.add_etag()
+    if last_modified:
+        response.last_modified = last_modified
+    # Ответ зависит от сессии (is_liked, скрытые треки владельца)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.vary.add('Cookie')
+    return response.make_conditional(request)
+
+def generation_etag(c, names=(), entities=(), per_user=True):
+    """
+    ETag JSON-ответа по счетчикам поколений (без выполнения основного запроса).
+    В ключ входят путь с параметрами, пользователь и версия его лайков (is_liked).
+    Счетчики прослушиваний/лайков поколения не меняют, поэтому ключ еще и
+    меняется раз в API_COUNTERS_MAX_AGE секунд - дольше они не устаревают.
+    """
+    user_id = session.get('user_id') if per_user else None
+    entities = list(entities)
+    if user_id:
+        entities.append((generations.LIKES, user_id))
+    versions = generations.snapshot(c, names, entities)
+    period = int(time.time() // API_COUNTERS_MAX_AGE) if API_COUNTERS_MAX_AGE > 0 else 0
+    key = f"{request.path}?{request.query_string.decode('latin-1')}|{user_id}|{versions}|{period}"
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+def generation_json(etag, build):
+    """
+    Ответ для generation_etag: при совпадении If-None-Match - 304 сразу,
+    иначе build() -> payload (или готовый ответ с ошибкой, он отдается как есть).
+    """
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        result = build()
+        if isinstance(result, tuple):
+            return result
+        response = jsonify(result)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.vary.add('Cookie')
+    return response
+
+def save_lyrics_timeline(c, track_id, text):
+    """Разобрать LRC один раз и сохранить готовую шкалу; возвращает (hash, json)"""
+    text_hash = lrc.lyrics_hash(text)
+    timeline_json = lrc.dump_timeline(lrc.parse_lrc(text))
+    c.execute("""INSERT INTO lyrics_timelines (track_id, lyrics_hash, timeline, updated_at)
+                 VALUES (?, ?, ?, datetime('now'))
+                 ON CONFLICT(track_id) DO UPDATE SET
+                 lyrics_hash = excluded.lyrics_hash,
+                 timeline = excluded.timeline,
+                 updated_at = excluded.updated_at""", (track_id, text_hash, timeline_json))
+    return text_hash, timeline_json
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
@@ -266,11 +622,149 @@ def check_ajax():
     else:
         request.is_ajax = False
 
+SEARCH_LIMIT_DEFAULT = 20
+SEARCH_LIMIT_MAX = 50
+
+def fts_match(query):
+    """Выражение MATCH для запроса; None - искать через LIKE (нет FTS5 или в запросе нет слов)"""
+    return search.match_query(query) if SEARCH_FTS_ENABLED else None
+
+def search_tracks(c, query, limit, fields=None):
+    """Публичные треки по запросу: FTS5 с ранжированием bm25, иначе LIKE"""
+    match = fts_match(query)
+    if match:
+        # CROSS JOIN фиксирует порядок: сначала совпадения из индекса, потом строки по rowid
+        c.execute(f"""SELECT {track_select_fields(fields)}
+                      FROM tracks_fts
+                      CROSS JOIN tracks t ON t.id = tracks_fts.rowid
+                      JOIN users u ON t.user_id = u.id
+                      WHERE tracks_fts MATCH ? AND t.hidden = 0
+                      ORDER BY {search.bm25('tracks_fts', search.TRACK_WEIGHTS)}, t.is_pinned DESC, t.id DESC
+                      LIMIT ?""", (match, limit))
+    else:
+        search_term = f"%{query}%"
+        c.execute(f"""SELECT {track_select_fields(fields)}
+                      FROM tracks t
+                      JOIN users u ON t.user_id = u.id
+                      WHERE t.hidden = 0 AND (t.title LIKE ? OR t.artist LIKE ?)
+                      ORDER BY t.is_pinned DESC, t.created_at DESC
+                      LIMIT ?""", (search_term, search_term, limit))
+    return c.fetchall()
+
+ALBUM_SEARCH_FIELDS = """a.*, u.nickname, u.display_name, u.avatar_url,
+                         COALESCE(a.plays_count, 0) as plays_count,
+                         COALESCE(a.likes_count, 0) as likes_count"""
+
+def search_albums(c, query, limit):
+    """Публичные альбомы по запросу: FTS5 с ранжированием bm25, иначе LIKE"""
+    match = fts_match(query)
+    if match:
+        c.execute(f"""SELECT {ALBUM_SEARCH_FIELDS}
+                      FROM albums_fts
+                      CROSS JOIN albums a ON a.id = albums_fts.rowid
+                      JOIN users u ON a.user_id = u.id
+                      WHERE albums_fts MATCH ? AND a.hidden = 0
+                      ORDER BY {search.bm25('albums_fts', search.ALBUM_WEIGHTS)}, a.is_pinned DESC, a.id DESC
+                      LIMIT ?""", (match, limit))
+    else:
+        search_term = f"%{query}%"
+        c.execute(f"""SELECT {ALBUM_SEARCH_FIELDS}
+                      FROM albums a
+                      JOIN users u ON a.user_id = u.id
+                      WHERE a.hidden = 0 AND (a.title LIKE ? OR a.description LIKE ?)
+                      ORDER BY a.is_pinned DESC, a.created_at DESC
+                      LIMIT ?""", (search_term, search_term, limit))
+    return c.fetchall()
+
+def search_users(c, query, limit):
+    """Пользователи по нику/имени"""
+    match = fts_match(query)
+    if match:
+        c.execute(f"""SELECT u.id, u.nickname, u.display_name, u.avatar_url
+                      FROM users_fts
+                      CROSS JOIN users u ON u.id = users_fts.rowid
+                      WHERE users_fts MATCH ?
+                      ORDER BY {search.bm25('users_fts', search.USER_WEIGHTS)}
+                      LIMIT ?""", (match, limit))
+    else:
+        search_term = f"%{query}%"
+        c.execute("""SELECT u.id, u.nickname, u.display_name, u.avatar_url
+                     FROM users u
+                     WHERE u.nickname LIKE ? OR u.display_name LIKE ?
+                     LIMIT ?""", (search_term, search_term, limit))
+    return c.fetchall()
+
+# === СНАПШОТ ГЛАВНОЙ ===
+
+HOME_FEED_LIMIT = 50
+# Счетчики прослушиваний/лайков в снапшоте обновляются не реже раза в HOME_FEED_MAX_AGE секунд
+HOME_FEED_MAX_AGE = int(os.environ.get('HOME_FEED_MAX_AGE', 60))
+PAGE_CACHE_TTL = int(os.environ.get('PAGE_CACHE_TTL', pagecache.DEFAULT_TTL))
+PAGE_CACHE_MAX_ENTRIES = int(os.environ.get('PAGE_CACHE_MAX_ENTRIES', pagecache.DEFAULT_MAX_ENTRIES))
+
+# Порядок ленты (?sort=) -> ORDER BY для треков и альбомов; trending - по индексу trend_score
+FEED_ORDERS = {
+    'recent': ('t.is_pinned DESC, t.created_at DESC', 'a.is_pinned DESC, a.created_at DESC'),
+    'trending': ('t.trend_score DESC, t.id DESC', 'a.trend_score DESC, a.id DESC'),
+}
+
+def feed_sort():
+    """Порядок ленты из ?sort= (неизвестное значение - по умолчанию)"""
+    sort = request.args.get('sort', 'recent')
+    return sort if sort in FEED_ORDERS else 'recent'
+
+# Снапшоты по порядку ленты
+_home_feeds = {}
+_home_feed_lock = threading.Lock()
+
+def build_home_feed(c, sort='recent'):
+    """Публичные ленты треков и альбомов (закрепленные, потом новые; или в тренде)"""
+    tracks_order, albums_order = FEED_ORDERS[sort]
+    c.execute(f"""SELECT t.*, u.nickname, u.display_name, u.avatar_url,
+                        COALESCE(t.plays_count, 0) as plays_count,
+                        COALESCE(t.likes_count, 0) as likes_count
+                 FROM tracks t 
+                 JOIN users u ON t.user_id = u.id 
+                 WHERE t.hidden = 0
+                 ORDER BY {tracks_order} LIMIT ?""", (HOME_FEED_LIMIT,))
+    tracks = fill_is_liked(c, [dict(row) for row in c.fetchall()], None)
+    
+    c.execute(f"""SELECT a.*, u.nickname, u.display_name, u.avatar_url,
+                        COALESCE(a.plays_count, 0) as plays_count,
+                        COALESCE(a.likes_count, 0) as likes_count
+                 FROM albums a 
+                 JOIN users u ON a.user_id = u.id 
+                 WHERE a.hidden = 0
+                 ORDER BY {albums_order} LIMIT ?""", (HOME_FEED_LIMIT,))
+    albums = fill_is_liked(c, [dict(row) for row in c.fetchall()], None, 'album')
+    return tracks, albums
+
+def get_home_feed(c, sort='recent'):
+    """
+    Снапшот анонимной главной: ленты и отрисованная страница.
+    Перестраивается, когда триггеры увеличили поколение home_feed
+    (загрузка, удаление, видимость, закрепление, профиль) или снапшот устарел
+    (для trending это и есть обновление рейтинга - раз в HOME_FEED_MAX_AGE).
+    """
+    generation = generations.get(c, generations.HOME_FEED)
+    feed = _home_feeds.get(sort)
+    if feed and feed['generation'] == generation and time.monotonic() - feed['built_at'] < HOME_FEED_MAX_AGE:
+        return feed
+    
+    with _home_feed_lock:
+        feed = _home_feeds.get(sort)
+        if feed and feed['generation'] == generation and time.monotonic() - feed['built_at'] < HOME_FEED_MAX_AGE:
+            return feed
+        tracks, albums = build_home_feed(c, sort)
+        feed = {'generation': generation, 'built_at': time.monotonic(),
+                'tracks': tracks, 'albums': albums, 'html': None}
+        _home_feeds[sort] = feed
+        return feed
+
 @app.route('/')
 def index():
     """Главная страница - unified версия"""
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     c = conn.cursor()
     
     search_query = request.args.get('q', '').strip()
@@ -284,67 +778,22 @@ def index():
         if user_row:
             current_user = dict(user_row)
     
-    # Получаем все публичные треки
-    tracks_query = """SELECT t.*, u.nickname, u.display_name, u.avatar_url,
-                        COALESCE(t.plays_count, 0) as plays_count,
-                        COALESCE(t.likes_count, 0) as likes_count
-                 FROM tracks t 
-                 JOIN users u ON t.user_id = u.id 
-                 WHERE t.hidden = 0"""
-    tracks_params = []
-    
-    if search_query:
-        tracks_query += " AND (t.title LIKE ? OR t.artist LIKE ?)"
-        search_term = f"%{search_query}%"
-        tracks_params.extend([search_term, search_term])
-        
-    tracks_query += " ORDER BY t.is_pinned DESC, t.created_at DESC LIMIT 50"
-    
-    c.execute(tracks_query, tracks_params)
-    tracks_rows = c.fetchall()
-    
-    # Проверяем лайки для треков
-    tracks = []
-    for row in tracks_rows:
-        track = dict(row)
-        if current_user_id:
-            c.execute("SELECT id FROM likes WHERE user_id = ? AND track_id = ?", (current_user_id, track['id']))
-            track['is_liked'] = c.fetchone() is not None
-        else:
-            track['is_liked'] = False
-        tracks.append(track)
-    
-    # Получаем все публичные альбомы
-    albums_query = """SELECT a.*, u.nickname, u.display_name, u.avatar_url,
-                        COALESCE(a.plays_count, 0) as plays_count,
-                        COALESCE(a.likes_count, 0) as likes_count
-                 FROM albums a 
-                 JOIN users u ON a.user_id = u.id 
-                 WHERE a.hidden = 0"""
-    albums_params = []
-    
     if search_query:
-        albums_query += " AND (a.title LIKE ? OR a.description LIKE ?)"
-        search_term = f"%{search_query}%"
-        albums_params.extend([search_term, search_term])
+        tracks = fill_is_liked(c, [dict(row) for row in search_tracks(c, search_query, 50)], current_user_id)
+        albums = fill_is_liked(c, [dict(row) for row in search_albums(c, search_query, 50)], current_user_id, 'album')
+    else:
+        feed = get_home_feed(c, feed_sort())
+        if not current_user:
+            # Аноним без поиска - готовая страница из снапшота, без запросов к трекам и альбомам
+            if feed['html'] is None:
+                feed['html'] = render_template('unified.html', tracks=feed['tracks'], albums=feed['albums'],
+                                               current_user=None, search_query='', mode='library')
+            return feed['html']
         
-    albums_query += " ORDER BY a.is_pinned DESC, a.created_at DESC LIMIT 50"
-    
-    c.execute(albums_query, albums_params)
-    albums_rows = c.fetchall()
-    
-    # Проверяем лайки для альбомов
-    albums = []
-    for row in albums_rows:
-        album = dict(row)
-        if current_user_id:
-            c.execute("SELECT id FROM album_likes WHERE user_id = ? AND album_id = ?", (current_user_id, album['id']))
-            album['is_liked'] = c.fetchone() is not None
-        else:
-            album['is_liked'] = False
-        albums.append(album)
+        # Свои лайки - поверх копии снапшота
+        tracks = fill_is_liked(c, [dict(track) for track in feed['tracks']], current_user_id)
+        albums = fill_is_liked(c, [dict(album) for album in feed['albums']], current_user_id, 'album')
     
-    conn.close()
     return render_template('unified.html', 
                           tracks=tracks, 
                           albums=albums, 
@@ -352,6 +801,38 @@ def index():
                           search_query=search_query,
                           mode='library')
 
+# === КЭШ ПУБЛИЧНЫХ СТРАНИЦ ===
+
+# Страницы /track, /album, /user для анонимов: версия объекта + TTL
+page_cache = pagecache.PageCache(max_entries=PAGE_CACHE_MAX_ENTRIES, ttl=PAGE_CACHE_TTL)
+
+def page_version_sql(kind, id_expr):
+    """Версия объекта тем же запросом, что и сам объект (без гонки с изменениями)"""
+    return f"COALESCE((SELECT version FROM entity_versions WHERE kind = '{kind}' AND id = {id_expr}), 0) as page_version"
+
+def get_cached_page(c, key):
+    """Готовая страница для анонима или None"""
+    if session.get('user_id'):
+        return None
+    return page_cache.get(key, lambda kind, entity_id: generations.entity_version(c, kind, entity_id))
+
+def cached_page_response(page):
+    """HTML из кэша с ETag; 304, если у клиента та же версия"""
+    response = Response(page.body, mimetype='text/html')
+    response.set_etag(page.etag)
+    response.headers['Cache-Control'] = 'public, no-cache'
+    response.vary.add('Cookie')
+    response = response.make_conditional(request)
+    if response.status_code == 304:
+        page_cache.count_not_modified()
+    return response
+
+def render_shared_page(key, kind, entity_id, version, html):
+    """Закэшировать страницу для анонимов; залогиненным - как есть"""
+    if session.get('user_id'):
+        return html
+    return cached_page_response(page_cache.put(key, kind, entity_id, version, html))
+
 @app.route('/app')
 def app_page():
     """Telegram Web App - главная страница приложения"""
@@ -362,10 +843,14 @@ def app_page():
 @app.route('/track/<track_identifier>')
 def share_track(track_identifier):
     """Публичная страница трека - unified версия"""
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     c = conn.cursor()
     
+    cache_key = ('track', track_identifier)
+    cached = get_cached_page(c, cache_key)
+    if cached:
+        return cached_page_response(cached)
+    
     current_user_id = session.get('user_id')
     
     # Получаем текущего пользователя
@@ -377,16 +862,18 @@ def share_track(track_identifier):
             current_user = dict(user_row)
     
     if track_identifier.isdigit():
-        c.execute("""SELECT t.*, u.nickname, u.display_name, u.avatar_url,
+        c.execute(f"""SELECT t.*, u.nickname, u.display_name, u.avatar_url,
                         COALESCE(t.plays_count, 0) as plays_count,
-                        COALESCE(t.likes_count, 0) as likes_count
+                        COALESCE(t.likes_count, 0) as likes_count,
+                        {page_version_sql(generations.TRACK, 't.id')}
                      FROM tracks t 
                      JOIN users u ON t.user_id = u.id 
                      WHERE t.id = ? AND t.hidden = 0""", (int(track_identifier),))
     else:
-        c.execute("""SELECT t.*, u.nickname, u.display_name, u.avatar_url,
+        c.execute(f"""SELECT t.*, u.nickname, u.display_name, u.avatar_url,
                         COALESCE(t.plays_count, 0) as plays_count,
-                        COALESCE(t.likes_count, 0) as likes_count
+                        COALESCE(t.likes_count, 0) as likes_count,
+                        {page_version_sql(generations.TRACK, 't.id')}
                      FROM tracks t 
                      JOIN users u ON t.user_id = u.id 
                      WHERE t.slug = ? AND t.hidden = 0""", (track_identifier,))
@@ -394,33 +881,33 @@ def share_track(track_identifier):
     row = c.fetchone()
     
     if not row:
-        conn.close()
         return "Track not found", 404
         
     track = dict(row)
+    version = track.pop('page_version')
     
     # Проверяем лайк текущего пользователя
-    if current_user_id:
-        c.execute("SELECT id FROM likes WHERE user_id = ? AND track_id = ?", (current_user_id, track['id']))
-        track['is_liked'] = c.fetchone() is not None
-    else:
-        track['is_liked'] = False
+    fill_is_liked(c, [track], current_user_id)
     
-    conn.close()
     title = f"{track['artist']} - {track['title']}"
-    return render_template('unified.html', 
+    html = render_template('unified.html', 
                           shared_track=track, 
                           current_user=current_user,
                           page_title=title,
                           mode='player')
+    return render_shared_page(cache_key, generations.TRACK, track['id'], version, html)
 
 @app.route('/album/<album_identifier>')
 def share_album(album_identifier):
     """Публичная страница альбома - unified версия"""
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     c = conn.cursor()
     
+    cache_key = ('album', album_identifier)
+    cached = get_cached_page(c, cache_key)
+    if cached:
+        return cached_page_response(cached)
+    
     current_user_id = session.get('user_id')
     
     # Получаем текущего пользователя
@@ -432,33 +919,31 @@ def share_album(album_identifier):
             current_user = dict(user_row)
     
     if album_identifier.isdigit():
-        c.execute("""SELECT a.*, u.nickname, u.display_name, u.avatar_url,
+        c.execute(f"""SELECT a.*, u.nickname, u.display_name, u.avatar_url,
                         COALESCE(a.plays_count, 0) as plays_count,
-                        COALESCE(a.likes_count, 0) as likes_count
+                        COALESCE(a.likes_count, 0) as likes_count,
+                        {page_version_sql(generations.ALBUM, 'a.id')}
                      FROM albums a 
                      JOIN users u ON a.user_id = u.id 
                      WHERE a.id = ? AND a.hidden = 0""", (int(album_identifier),))
     else:
-        c.execute("""SELECT a.*, u.nickname, u.display_name, u.avatar_url,
+        c.execute(f"""SELECT a.*, u.nickname, u.display_name, u.avatar_url,
                         COALESCE(a.plays_count, 0) as plays_count,
-                        COALESCE(a.likes_count, 0) as likes_count
+                        COALESCE(a.likes_count, 0) as likes_count,
+                        {page_version_sql(generations.ALBUM, 'a.id')}
                      FROM albums a 
                      JOIN users u ON a.user_id = u.id 
                      WHERE a.slug = ? AND a.hidden = 0""", (album_identifier,))
     
     album = c.fetchone()
     if not album:
-        conn.close()
         return "Album not found", 404
     
     album = dict(album)
+    version = album.pop('page_version')
     
     # Проверяем лайк текущего пользователя
-    if current_user_id:
-        c.execute("SELECT id FROM album_likes WHERE user_id = ? AND album_id = ?", (current_user_id, album['id']))
-        album['is_liked'] = c.fetchone() is not None
-    else:
-        album['is_liked'] = False
+    fill_is_liked(c, [album], current_user_id, 'album')
     
     # Получаем треки альбома с информацией о пользователе
     c.execute("""SELECT t.*, at.sort_order, u.nickname,
@@ -472,35 +957,35 @@ def share_album(album_identifier):
     tracks = [dict(row) for row in c.fetchall()]
     
     # Проверяем лайки для треков
-    for track in tracks:
-        if current_user_id:
-            c.execute("SELECT id FROM likes WHERE user_id = ? AND track_id = ?", (current_user_id, track['id']))
-            track['is_liked'] = c.fetchone() is not None
-        else:
-            track['is_liked'] = False
+    fill_is_liked(c, tracks, current_user_id)
     
-    conn.close()
     
-    return render_template('unified.html', 
+    html = render_template('unified.html', 
                           shared_album=album, 
                           album_tracks=tracks,
                           current_user=current_user,
                           page_title=album['title'],
                           mode='player')
+    return render_shared_page(cache_key, generations.ALBUM, album['id'], version, html)
 
 @app.route('/user/<nickname>')
 def user_library(nickname):
     """Публичная библиотека пользователя"""
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     c = conn.cursor()
     
-    c.execute("SELECT * FROM users WHERE nickname = ?", (nickname,))
+    cache_key = ('user', nickname)
+    cached = get_cached_page(c, cache_key)
+    if cached:
+        return cached_page_response(cached)
+    
+    c.execute(f"SELECT *, {page_version_sql(generations.USER, 'users.id')} FROM users WHERE nickname = ?", (nickname,))
     user = c.fetchone()
     if not user:
         return "User not found", 404
     
     user = dict(user)
+    version = user.pop('page_version')
     
     # Получаем треки пользователя
     c.execute("""SELECT * FROM tracks 
@@ -514,16 +999,15 @@ def user_library(nickname):
                  ORDER BY created_at DESC""", (user['id'],))
     albums = [dict(row) for row in c.fetchall()]
     
-    conn.close()
-    return render_template('library.html', user=user, tracks=tracks, albums=albums)
+    html = render_template('library.html', user=user, tracks=tracks, albums=albums)
+    return render_shared_page(cache_key, generations.USER, user['id'], version, html)
 
 # === API ROUTES ===
 
 @app.route('/auth/browser/<token>')
 def auth_browser(token):
     """Авторизация в браузере по токену"""
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     c = conn.cursor()
     
     # Ищем токен и проверяем срок действия (10 минут)
@@ -531,7 +1015,6 @@ def auth_browser(token):
     row = c.fetchone()
     
     if not row:
-        conn.close()
         return "Ссылка недействительна или устарела. Запросите новую в боте /login", 400
         
     telegram_id = row[0]
@@ -541,7 +1024,6 @@ def auth_browser(token):
     user = c.fetchone()
     
     if not user:
-        conn.close()
         return "Пользователь не найден. Сначала зайдите через Telegram Web App.", 404
         
     # Авторизуем
@@ -551,7 +1033,6 @@ def auth_browser(token):
     # Удаляем использованный токен
     c.execute("DELETE FROM auth_tokens WHERE token = ?", (token,))
     conn.commit()
-    conn.close()
     
     return redirect('/app') # Перенаправляем в приложение
 
@@ -583,8 +1064,7 @@ def auth_telegram():
         if 'photo_url' in user_data:
             avatar_url = user_data['photo_url']
         
-        conn = sqlite3.connect(DB_FILE)
-        conn.row_factory = sqlite3.Row
+        conn = get_db()
         c = conn.cursor()
         
         # Проверяем существующего пользователя
@@ -622,7 +1102,6 @@ def auth_telegram():
         # Получаем обновленные данные
         c.execute("SELECT * FROM users WHERE id = ?", (user_id,))
         user = dict(c.fetchone())
-        conn.close()
         
         # Сохраняем в сессию
         session['user_id'] = user_id
@@ -646,12 +1125,10 @@ def logout():
 @login_required
 def get_profile():
     """Получить профиль текущего пользователя"""
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     c = conn.cursor()
     c.execute("SELECT * FROM users WHERE id = ?", (session['user_id'],))
     user = c.fetchone()
-    conn.close()
     
     if not user:
         return jsonify({'error': 'User not found'}), 404
@@ -671,58 +1148,85 @@ def update_profile():
         display_name = request.form.get('display_name', '').strip()
         nickname = request.form.get('nickname', '').strip().lower()
     
-    conn = sqlite3.connect(DB_FILE)
+    conn = get_db()
     c = conn.cursor()
     
     # Проверяем уникальность nickname
     if nickname:
         c.execute("SELECT id FROM users WHERE nickname = ? AND id != ?", (nickname, session['user_id']))
         if c.fetchone():
-            conn.close()
             return jsonify({'error': 'Nickname already taken'}), 400
     
     # Обработка аватара
     avatar_url = None
-    if 'avatar' in request.files and request.files['avatar'].filename:
-        avatar = request.files['avatar']
-        if allowed_file(avatar.filename):
-            avatar_filename = secure_filename(avatar.filename)
-            avatar_filename = f"avatar_{session['user_id']}_{int(datetime.now().timestamp())}_{avatar_filename}"
-            avatar.save(os.path.join(app.config['UPLOAD_FOLDER'], avatar_filename))
-            avatar_url = f"/uploads/{avatar_filename}"
+    old_avatar = None
+    avatar_blob = None
+    try:
+        if 'avatar' in request.files and request.files['avatar'].filename:
+            avatar = request.files['avatar']
+            if allowed_file(avatar.filename):
+                avatar_blob = ingest_upload(avatar)
+                avatar_url = f"/uploads/{blobstore.acquire_blob(c, blob_store, avatar_blob)}"
             
-            # Удаляем старый аватар если был локальный (начинается с /uploads/)
-            c.execute("SELECT avatar_url FROM users WHERE id = ?", (session['user_id'],))
-            old_avatar = c.fetchone()[0]
-            if old_avatar and old_avatar.startswith('/uploads/'):
-                try:
-                    old_path = os.path.join(app.config['UPLOAD_FOLDER'], old_avatar.split('/')[-1])
-                    if os.path.exists(old_path):
-                        os.remove(old_path)
-                except Exception as e:
-                    print(f"Error deleting old avatar: {e}")
+                # Старый аватар освобождаем, если был локальный (начинается с /uploads/)
+                c.execute("SELECT avatar_url FROM users WHERE id = ?", (session['user_id'],))
+                old_avatar = c.fetchone()[0]
 
-    # Обновляем профиль
-    query = "UPDATE users SET display_name = ?"
-    params = [display_name]
+        # Обновляем профиль
+        query = "UPDATE users SET display_name = ?"
+        params = [display_name]
     
-    if nickname:
-        query += ", nickname = ?"
-        params.append(nickname)
+        if nickname:
+            query += ", nickname = ?"
+            params.append(nickname)
     
-    if avatar_url:
-        query += ", avatar_url = ?"
-        params.append(avatar_url)
+        if avatar_url:
+            query += ", avatar_url = ?"
+            params.append(avatar_url)
         
-    query += " WHERE id = ?"
-    params.append(session['user_id'])
+        query += " WHERE id = ?"
+        params.append(session['user_id'])
     
-    c.execute(query, params)
+        c.execute(query, params)
     
-    conn.commit()
-    conn.close()
+        if old_avatar and old_avatar.startswith('/uploads/'):
+            blobstore.release_blob(c, blob_store, old_avatar[len('/uploads/'):])
     
-    return jsonify({'success': True})
+        conn.commit()
+        if avatar_url:
+            thumb_cache.schedule(avatar_url[len('/uploads/'):])
+        
+        return jsonify({'success': True})
+    finally:
+        blob_store.discard(avatar_blob)
+
+@app.route('/api/search', methods=['GET'])
+def api_search():
+    """Поиск по трекам, альбомам и пользователям: ?q=...&type=tracks,albums,users&limit=20"""
+    query = request.args.get('q', '').strip()
+    types = set(filter(None, request.args.get('type', 'tracks,albums,users').split(',')))
+    try:
+        limit = int(request.args.get('limit', SEARCH_LIMIT_DEFAULT))
+    except ValueError:
+        return jsonify({'error': 'Invalid limit'}), 400
+    limit = max(1, min(limit, SEARCH_LIMIT_MAX))
+    
+    result = {'query': query}
+    if not query:
+        return jsonify(dict(result, tracks=[], albums=[], users=[]))
+    
+    conn = get_db()
+    c = conn.cursor()
+    user_id = session.get('user_id')
+    if 'tracks' in types:
+        tracks = [dict(row) for row in search_tracks(c, query, limit, TRACK_LIST_FIELDS)]
+        result['tracks'] = fill_is_liked(c, tracks, user_id)
+    if 'albums' in types:
+        albums = [dict(row) for row in search_albums(c, query, limit)]
+        result['albums'] = fill_is_liked(c, albums, user_id, 'album')
+    if 'users' in types:
+        result['users'] = [dict(row) for row in search_users(c, query, limit)]
+    return jsonify(result)
 
 @app.route('/api/tracks', methods=['GET'])
 def get_tracks():
@@ -732,10 +1236,18 @@ def get_tracks():
     track_id = request.args.get('id', type=int)  # Поддержка фильтрации по ID
     current_user_id = session.get('user_id')
     
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     c = conn.cursor()
     
+    # ETag по поколениям: повторный запрос без изменений - 304 без выборки
+    if track_id:
+        etag = generation_etag(c, entities=[(generations.API_TRACK, track_id)])
+    else:
+        etag = generation_etag(c, names=[generations.API_TRACKS])
+    return generation_json(etag, lambda: load_tracks(c, show_hidden, user_id, track_id, current_user_id))
+
+def load_tracks(c, show_hidden, user_id, track_id, current_user_id):
+    """Выдача /api/tracks: список, страница или один трек"""
     # Если запрашивается конкретный трек по ID
     if track_id:
         if show_hidden and 'user_id' in session and user_id and user_id == session['user_id']:
@@ -754,70 +1266,299 @@ def get_tracks():
                          WHERE t.id = ? AND t.hidden = 0""", (track_id,))
         
         track = c.fetchone()
-        conn.close()
         
         if not track:
-            return jsonify([]), 200
+            return []
         
         track_dict = dict(track)
         
         # Проверяем лайк текущего пользователя
-        if current_user_id:
-            conn = sqlite3.connect(DB_FILE)
-            c = conn.cursor()
-            c.execute("SELECT id FROM likes WHERE user_id = ? AND track_id = ?", (current_user_id, track_id))
-            track_dict['is_liked'] = c.fetchone() is not None
-            conn.close()
-        else:
-            track_dict['is_liked'] = False
+        fill_is_liked(c, [track_dict], current_user_id)
         
-        return jsonify([track_dict])
+        return [track_dict]
     
-    if show_hidden and 'user_id' in session:
+    # Фильтры списка
+    where = []
+    params = []
+    if show_hidden and 'user_id' in session and user_id and user_id == session['user_id']:
         # Показываем скрытые только свои треки
-        if user_id and user_id == session['user_id']:
-            c.execute("""SELECT t.*, u.nickname, u.display_name, u.avatar_url,
-                        COALESCE(t.plays_count, 0) as plays_count,
-                        COALESCE(t.likes_count, 0) as likes_count
-                         FROM tracks t 
-                         JOIN users u ON t.user_id = u.id 
-                         WHERE t.user_id = ? 
-                         ORDER BY COALESCE(t.sort_order, 999999) ASC, t.id ASC""", (user_id,))
-        else:
-            c.execute("""SELECT t.*, u.nickname, u.display_name, u.avatar_url,
-                        COALESCE(t.plays_count, 0) as plays_count,
-                        COALESCE(t.likes_count, 0) as likes_count
-                         FROM tracks t 
-                         JOIN users u ON t.user_id = u.id 
-                         WHERE t.hidden = 0 
-                         ORDER BY COALESCE(t.sort_order, 999999) ASC, t.id ASC""")
+        where.append("t.user_id = ?")
+        params.append(user_id)
     else:
-        query = """SELECT t.*, u.nickname, u.display_name, u.avatar_url,
-                  COALESCE(t.plays_count, 0) as plays_count,
-                  COALESCE(t.likes_count, 0) as likes_count
-                   FROM tracks t 
-                   JOIN users u ON t.user_id = u.id 
-                   WHERE t.hidden = 0"""
-        params = []
-        if user_id:
-            query += " AND t.user_id = ?"
+        where.append("t.hidden = 0")
+        if user_id and not show_hidden:
+            where.append("t.user_id = ?")
             params.append(user_id)
-        query += " ORDER BY COALESCE(t.sort_order, 999999) ASC, t.id ASC"
-        c.execute(query, params)
     
-    tracks = []
+    limit = request.args.get('limit', type=int)
+    cursor = request.args.get('cursor', '')
+    fields = request.args.get('fields', '')
+    # ?sort=trending - по рейтингу (индекс trend_score), иначе ручной порядок
+    order_key, direction = TRACK_SORTS.get(request.args.get('sort'), TRACK_SORTS['default'])
+    
+    # Старый формат: весь список массивом (если не запрошена пагинация), тоже без lyrics
+    if not limit and not cursor:
+        select = track_select_fields(fields.split(',') if fields else TRACK_LIST_FIELDS)
+        c.execute(f"""SELECT {select}
+                     FROM tracks t 
+                     JOIN users u ON t.user_id = u.id 
+                     WHERE {' AND '.join(where)}
+                     ORDER BY {order_key} {direction}, t.id {direction}""", params)
+        return fill_is_liked(c, [dict(row) for row in c.fetchall()], current_user_id)
+    
+    # Keyset-пагинация по (ключ сортировки, id), без lyrics по умолчанию
+    limit = max(1, min(limit or TRACKS_PAGE_DEFAULT, TRACKS_PAGE_MAX))
+    if cursor:
+        try:
+            after_order, after_id = decode_cursor(cursor)
+        except ValueError:
+            return jsonify({'error': 'Invalid cursor'}), 400
+        # Отдельное условие >= (<=) нужно, чтобы SQLite искал по индексу, а не сканировал с начала
+        bound, after = ('>=', '>') if direction == 'ASC' else ('<=', '<')
+        where.append(f"{order_key} {bound} ? AND ({order_key}, t.id) {after} (?, ?)")
+        params.extend([after_order, after_order, after_id])
+    
+    select = track_select_fields(fields.split(',') if fields else TRACK_LIST_FIELDS)
+    c.execute(f"""SELECT {select}, {order_key} AS _order_key
+                 FROM tracks t 
+                 JOIN users u ON t.user_id = u.id 
+                 WHERE {' AND '.join(where)}
+                 ORDER BY {order_key} {direction}, t.id {direction}
+                 LIMIT ?""", params + [limit + 1])
+    rows = [dict(row) for row in c.fetchall()]
+    
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1]['_order_key'], rows[-1]['id'])
+    for row in rows:
+        row.pop('_order_key', None)
+    
+    tracks = fill_is_liked(c, rows, current_user_id)
+    return {'tracks': tracks, 'next_cursor': next_cursor}
+
+def get_visible_track(c, track_id, fields=None):
+    """Трек по ID: публичный, либо скрытый, но принадлежащий текущему пользователю"""
+    c.execute(f"""SELECT {track_select_fields(fields)}
+                 FROM tracks t 
+                 JOIN users u ON t.user_id = u.id 
+                 WHERE t.id = ? AND (t.hidden = 0 OR t.user_id = ?)""",
+              (track_id, session.get('user_id') or 0))
+    row = c.fetchone()
+    return dict(row) if row else None
+
+@app.route('/api/tracks/<int:track_id>', methods=['GET'])
+def get_track(track_id):
+    """Получить один трек"""
+    conn = get_db()
+    c = conn.cursor()
+    track = get_visible_track(c, track_id)
+    if not track:
+        return jsonify({'error': 'Track not found'}), 404
+    
+    fill_is_liked(c, [track], session.get('user_id'))
+    return conditional_json(track, parse_db_timestamp(track.get('updated_at') or track.get('created_at')))
+
+@app.route('/api/tracks/<int:track_id>/playback', methods=['GET'])
+def get_track_playback(track_id):
+    """
+    Задержка и добивка кодера (в отсчетах) того файла, который
+    /uploads/<файл> с тем же ?quality= отдаст этому клиенту. У версий из
+    transcode.py они свои, а не как у оригинала; плееру они нужны для
+    бесшовного перехода к следующему треку.
+    """
+    c = get_db().cursor()
+    track = get_visible_track(c, track_id)
+    if not track:
+        return jsonify({'error': 'Track not found'}), 404
+    quality = requested_quality()
+    chosen = transcode.choose_quality(c, track['filename'], quality) if quality else None
+    if chosen:
+        delay, padding = transcode.rendition_gapless(c, track['filename'], chosen)
+        info = {'quality': chosen, 'sample_rate': transcode.RENDITION_SAMPLE_RATE,
+                'encoder_delay': delay, 'encoder_padding': padding}
+    else:
+        info = {'quality': 'original', 'sample_rate': track['sample_rate'],
+                'encoder_delay': track['encoder_delay'], 'encoder_padding': track['encoder_padding']}
+    response = jsonify(info)
+    # Выбор версии меняется, когда перекодирование догонит загрузку
+    response.headers['Cache-Control'] = 'no-cache'
+    if request.args.get('quality') == 'auto':
+        response.vary.update(transcode.CLIENT_HINTS)
+    return response
+
+SIMILAR_LIMIT_DEFAULT = 10
+SIMILAR_LIMIT_MAX = 50
+# Сколько уже сыгранных треков радио может передать в ?exclude=
+SIMILAR_EXCLUDE_MAX = 200
+
+@app.route('/api/tracks/<int:track_id>/similar', methods=['GET'])
+def get_similar_tracks(track_id):
+    """
+    Похожие треки: ?limit=10&exclude=1,2,3 (уже сыгранные в режиме радио).
+    Соседи из track_similar (чтение по ключу), недостающее - треки того же
+    автора и общий тренд; у таких similarity = null.
+    """
+    limit = max(1, min(request.args.get('limit', SIMILAR_LIMIT_DEFAULT, type=int), SIMILAR_LIMIT_MAX))
+    try:
+        exclude = {int(x) for x in request.args.get('exclude', '').split(',') if x.strip()}
+    except ValueError:
+        return jsonify({'error': 'Invalid exclude'}), 400
+    exclude = set(list(exclude)[:SIMILAR_EXCLUDE_MAX])
+    exclude.add(track_id)
+    
+    conn = get_db()
+    c = conn.cursor()
+    track = get_visible_track(c, track_id, ['id', 'user_id'])
+    if not track:
+        return jsonify({'error': 'Track not found'}), 404
+    
+    select = track_select_fields(TRACK_LIST_FIELDS)
+    c.execute(f"""SELECT {select}, s.score AS similarity
+                 FROM track_similar s
+                 JOIN tracks t ON t.id = s.similar_id
+                 JOIN users u ON t.user_id = u.id
+                 WHERE s.track_id = ? AND t.hidden = 0
+                 ORDER BY s.rank""", (track_id,))
+    result = [row for row in (dict(r) for r in c.fetchall()) if row['id'] not in exclude][:limit]
+    
+    # Мало данных о прослушиваниях - добираем тем же автором, затем трендом
+    fallbacks = [("t.user_id = ?", [track['user_id']]), ("1 = 1", [])]
+    for condition, params in fallbacks:
+        if len(result) >= limit:
+            break
+        seen = exclude | {row['id'] for row in result}
+        c.execute(f"""SELECT {select}, NULL AS similarity
+                     FROM tracks t
+                     JOIN users u ON t.user_id = u.id
+                     WHERE t.hidden = 0 AND {condition}
+                     ORDER BY t.trend_score DESC, t.id DESC
+                     LIMIT ?""", params + [limit + len(seen)])
+        result.extend(row for row in (dict(r) for r in c.fetchall()) if row['id'] not in seen)
+        result = result[:limit]
+    
+    return jsonify(fill_is_liked(c, result, session.get('user_id')))
+
+@app.route('/api/tracks/<int:track_id>/duplicates', methods=['GET'])
+@login_required
+def get_track_duplicates(track_id):
+    """
+    Другие треки с той же записью (свой трек): тот же файл (match = 1)
+    или похожий отпечаток (match = 1 - доля несовпавших бит). Видны свои и публичные треки.
+    """
+    conn = get_db()
+    c = conn.cursor()
+    c.execute("SELECT filename FROM tracks WHERE id = ? AND user_id = ?", (track_id, session['user_id']))
+    track = c.fetchone()
+    if not track:
+        return jsonify({'error': 'Track not found'}), 404
+    
+    matches = {track['filename']: 1.0}
+    for source, ber in analysis.find_duplicates(c, track['filename']):
+        matches[source] = round(1 - ber, 4)
+    sources = list(matches)
+    select = track_select_fields(TRACK_LIST_FIELDS)
+    c.execute(f"""SELECT {select}, t.filename AS source
+                 FROM tracks t
+                 JOIN users u ON t.user_id = u.id
+                 WHERE t.filename IN ({','.join('?' * len(sources))}) AND t.id != ?
+                   AND (t.hidden = 0 OR t.user_id = ?)""",
+              sources + [track_id, session['user_id']])
+    result = []
     for row in c.fetchall():
-        track = dict(row)
-        # Проверяем лайкнул ли текущий пользователь
-        if current_user_id:
-            c.execute("SELECT id FROM likes WHERE user_id = ? AND track_id = ?", (current_user_id, track['id']))
-            track['is_liked'] = c.fetchone() is not None
-        else:
-            track['is_liked'] = False
-        tracks.append(track)
+        item = dict(row)
+        item['match'] = matches[item.pop('source')]
+        result.append(item)
+    result.sort(key=lambda item: (-item['match'], item['id']))
+    return jsonify(result)
+
+# Сколько треков можно опросить одним запросом статуса
+INGEST_STATUS_MAX_IDS = 200
+
+@app.route('/api/tracks/status', methods=['GET'])
+@login_required
+def get_tracks_status():
+    """Статус фоновой обработки своих загрузок: ?ids=1,2,3"""
+    try:
+        ids = [int(x) for x in request.args.get('ids', '').split(',') if x.strip()]
+    except ValueError:
+        return jsonify({'error': 'Invalid ids'}), 400
+    ids = ids[:INGEST_STATUS_MAX_IDS]
+    if not ids:
+        return jsonify({'tracks': []})
+    
+    conn = get_db()
+    c = conn.cursor()
+    placeholders = ','.join('?' * len(ids))
+    c.execute(f"""SELECT id, status, ingest_error, title, artist, cover_filename, duration
+                  FROM tracks WHERE user_id = ? AND id IN ({placeholders})""",
+              [session['user_id']] + ids)
+    tracks = [dict(row) for row in c.fetchall()]
+    for track in tracks:
+        track['status'] = track['status'] or ingest.STATUS_READY
+    return jsonify({'tracks': tracks})
+
+@app.route('/api/tracks/<int:track_id>/lyrics', methods=['GET'])
+def get_track_lyrics(track_id):
+    """Получить текст трека"""
+    conn = get_db()
+    c = conn.cursor()
+    track = get_visible_track(c, track_id, ['lyrics', 'created_at', 'updated_at'])
+    if not track:
+        return jsonify({'error': 'Track not found'}), 404
     
-    conn.close()
-    return jsonify(tracks)
+    return conditional_json({'id': track['id'], 'lyrics': track['lyrics'] or ''},
+                            parse_db_timestamp(track['updated_at'] or track['created_at']))
+
+@app.route('/api/tracks/<int:track_id>/lyrics/timeline', methods=['GET'])
+def get_track_lyrics_timeline(track_id):
+    """Получить разобранный LRC (таймкоды + строки) для бинарного поиска в плеере"""
+    conn = get_db()
+    c = conn.cursor()
+    track = get_visible_track(c, track_id, ['lyrics'])
+    if not track:
+        return jsonify({'error': 'Track not found'}), 404
+    
+    c.execute("SELECT lyrics_hash, timeline FROM lyrics_timelines WHERE track_id = ?", (track_id,))
+    row = c.fetchone()
+    if row and row['lyrics_hash'] == lrc.lyrics_hash(track['lyrics']):
+        text_hash, timeline_json = row['lyrics_hash'], row['timeline']
+    else:
+        # Треки, загруженные до появления шкалы, - разбираем при первом запросе
+        text_hash, timeline_json = save_lyrics_timeline(c, track_id, track['lyrics'])
+        conn.commit()
+    
+    response = Response(timeline_json, mimetype='application/json')
+    response.set_etag(f"{text_hash}-v{lrc.TIMELINE_VERSION}")
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.vary.add('Cookie')
+    return response.make_conditional(request)
+
+def insert_track(c, user_id, title, artist, lyrics, slug, sort_order, audio_blob, cover_blob, fill_title):
+    """Строка нового трека, ссылки на файлы и задания фоновой обработки (в транзакции вызывающего)"""
+    status = ingest.STATUS_PROCESSING if ingest.MUTAGEN_AVAILABLE else ingest.STATUS_READY
+    c.execute("""INSERT INTO tracks (user_id, title, artist, filename, cover_filename, lyrics, sort_order, hidden, slug, status) 
+                 VALUES (?, ?, ?, ?, ?, ?, ?, 0, ?, ?)""",
+              (user_id, title, artist, audio_blob.path, cover_blob.path if cover_blob else '',
+               lyrics, sort_order, slug, status))
+    track_id = c.lastrowid
+    blobstore.acquire_blob(c, blob_store, audio_blob)
+    if cover_blob:
+        blobstore.acquire_blob(c, blob_store, cover_blob)
+    save_lyrics_timeline(c, track_id, lyrics)
+    if status == ingest.STATUS_PROCESSING:
+        ingest.add_job(c, track_id, fill_title=fill_title, fill_artist=not artist,
+                       fill_cover=cover_blob is None)
+    transcode.add_job(c, audio_blob.path)
+    return track_id, status
+
+def submit_track_jobs(track_id, status, audio_blob, cover_blob):
+    """После commit: поставить новый трек в очереди обработки"""
+    if status == ingest.STATUS_PROCESSING:
+        ingest_queue.submit(track_id)
+    transcoder.submit(audio_blob.path)
+    if cover_blob:
+        thumb_cache.schedule(cover_blob.path)
 
 @app.route('/api/tracks', methods=['POST'])
 @login_required
@@ -834,102 +1575,204 @@ def upload_track():
     slug = request.form.get('slug', '').strip() or None
 
     if audio and allowed_file(audio.filename):
-        import uuid
-        ext = audio.filename.rsplit('.', 1)[1].lower()
-        # Генерируем UUID имя файла чтобы избежать проблем с кодировкой
-        audio_filename = f"{session['user_id']}_{int(datetime.now().timestamp())}_{uuid.uuid4().hex}.{ext}"
-        audio_path = os.path.join(app.config['UPLOAD_FOLDER'], audio_filename)
-        audio.save(audio_path)
+        # Файл хэшируется при приеме; имя - SHA-256 содержимого (дубликаты хранятся один раз).
+        # Теги, обложка из APIC и длительность разбираются в фоне (ingest_queue)
+        audio_blob = ingest_upload(audio)
         
-        cover_filename = None
+        cover_blob = None
         if cover and allowed_file(cover.filename):
-            cover_ext = cover.filename.rsplit('.', 1)[1].lower()
-            cover_filename = f"{session['user_id']}_{int(datetime.now().timestamp())}_{uuid.uuid4().hex}.{cover_ext}"
-            cover.save(os.path.join(app.config['UPLOAD_FOLDER'], cover_filename))
-        elif MUTAGEN_AVAILABLE and audio_filename.lower().endswith('.mp3'):
-            # Пробуем извлечь обложку из MP3
-            try:
-                try:
-                    audio_meta = MP3(audio_path, ID3=ID3)
-                except ID3NoHeaderError:
-                    audio_meta = MP3(audio_path)
-                
-                if audio_meta.tags:
-                    apic = None
-                    if 'APIC:' in audio_meta.tags:
-                        apic = audio_meta.tags['APIC:']
-                    elif 'APIC' in audio_meta.tags:
-                        apic = audio_meta.tags['APIC']
-                    else:
-                        for key in audio_meta.tags.keys():
-                            if key.startswith('APIC'):
-                                apic = audio_meta.tags[key]
-                                break
-                    
-                    if apic:
-                        apic_data = None
-                        if hasattr(apic, 'data'):
-                            apic_data = apic.data
-                        elif isinstance(apic, list) and len(apic) > 0:
-                            apic_data = apic[0].data if hasattr(apic[0], 'data') else None
-                        
-                        if apic_data:
-                            mime = getattr(apic, 'mime', 'image/jpeg') if hasattr(apic, 'mime') else 'image/jpeg'
-                            if isinstance(apic, list) and len(apic) > 0 and hasattr(apic[0], 'mime'):
-                                mime = apic[0].mime
-                            
-                            ext = '.jpg'
-                            if 'png' in mime.lower():
-                                ext = '.png'
-                            elif 'gif' in mime.lower():
-                                ext = '.gif'
-                            elif 'webp' in mime.lower():
-                                ext = '.webp'
-                            
-                            cover_filename = audio_filename.rsplit('.', 1)[0] + ext
-                            cover_path = os.path.join(app.config['UPLOAD_FOLDER'], cover_filename)
-                            with open(cover_path, 'wb') as f:
-                                f.write(apic_data)
-            except Exception as e:
-                print(f"Error extracting cover from MP3: {e}")
+            cover_blob = ingest_upload(cover)
         
+        fill_title = not title
         if not title:
-            title = audio_filename.rsplit('.', 1)[0]
+            title = secure_filename(audio.filename).rsplit('.', 1)[0] or audio_blob.sha256[:12]
 
-        conn = sqlite3.connect(DB_FILE)
+        conn = get_db()
         c = conn.cursor()
         try:
             c.execute("SELECT MAX(sort_order) FROM tracks WHERE user_id = ?", (session['user_id'],))
             max_order = c.fetchone()[0] or 0
-            c.execute("""INSERT INTO tracks (user_id, title, artist, filename, cover_filename, lyrics, sort_order, hidden, slug) 
-                         VALUES (?, ?, ?, ?, ?, ?, ?, 0, ?)""",
-                      (session['user_id'], title, artist, audio_filename, cover_filename or '', lyrics, max_order + 1, slug))
+            track_id, status = insert_track(c, session['user_id'], title, artist, lyrics, slug, max_order + 1,
+                                            audio_blob, cover_blob, fill_title)
             conn.commit()
-            track_id = c.lastrowid
-            conn.close()
-            return jsonify({'success': True, 'id': track_id})
+            submit_track_jobs(track_id, status, audio_blob, cover_blob)
+            return jsonify({'success': True, 'id': track_id, 'status': status})
         except sqlite3.IntegrityError:
-            conn.close()
             return jsonify({'error': 'Slug already exists'}), 400
+        finally:
+            blob_store.discard(audio_blob)
+            blob_store.discard(cover_blob)
     
     return jsonify({'error': 'Invalid files'}), 400
 
+# === ВОЗОБНОВЛЯЕМАЯ ЗАГРУЗКА ЧАСТЯМИ (см. resumable.py) ===
+
+def get_upload_session(c, upload_id):
+    """Сессия загрузки текущего пользователя или None"""
+    c.execute("SELECT * FROM upload_sessions WHERE id = ? AND user_id = ?", (upload_id, session['user_id']))
+    return c.fetchone()
+
+@app.route('/api/uploads', methods=['POST'])
+@login_required
+def create_uploads():
+    """Завести сессии загрузки: {"files": [{"name": "a.mp3", "size": 123}, ...]}"""
+    files = (request.get_json(silent=True) or {}).get('files')
+    if not isinstance(files, list) or not 0 < len(files) <= resumable.MAX_FILES:
+        return jsonify({'error': f'files must be a list of 1..{resumable.MAX_FILES} items'}), 400
+    specs = []
+    for item in files:
+        name = item.get('name') if isinstance(item, dict) else None
+        size = item.get('size') if isinstance(item, dict) else None
+        if not isinstance(name, str) or not allowed_file(name):
+            return jsonify({'error': f'Invalid file type: {name}'}), 400
+        if not isinstance(size, int) or isinstance(size, bool) or not 0 < size <= resumable.MAX_FILE_SIZE:
+            return jsonify({'error': f'Invalid size: {name}'}), 400
+        specs.append((name, name.rsplit('.', 1)[1].lower(), size))
+    
+    conn = get_db()
+    c = conn.cursor()
+    resumable.expire(c, blob_store)
+    uploads = []
+    for name, ext, size in specs:
+        upload_id = resumable.create(c, blob_store, session['user_id'], name, ext, size)
+        uploads.append({'upload_id': upload_id, 'name': name, 'size': size, 'offset': 0, 'complete': False})
+    conn.commit()
+    return jsonify({'success': True, 'chunk_size': resumable.DEFAULT_CHUNK_SIZE, 'uploads': uploads})
+
+@app.route('/api/uploads/<upload_id>', methods=['GET'])
+@login_required
+def get_upload(upload_id):
+    """Сколько байт уже принято - с этого смещения клиент продолжает после обрыва"""
+    upload = get_upload_session(get_db().cursor(), upload_id)
+    if not upload:
+        return jsonify({'error': 'Upload not found'}), 404
+    return jsonify(resumable.describe(upload))
+
+@app.route('/api/uploads/<upload_id>', methods=['PUT'])
+@login_required
+def append_upload(upload_id):
+    """Дописать часть: тело - байты, заголовок Upload-Offset - позиция части в файле"""
+    conn = get_db()
+    c = conn.cursor()
+    upload = get_upload_session(c, upload_id)
+    if not upload:
+        return jsonify({'error': 'Upload not found'}), 404
+    try:
+        offset = int(request.headers.get('Upload-Offset', ''))
+    except ValueError:
+        return jsonify({'error': 'Upload-Offset header is required'}), 400
+    
+    limit = min(resumable.MAX_CHUNK_SIZE, upload['size'] - upload['received'])
+    if request.content_length is not None and request.content_length > limit:
+        return jsonify({'error': 'Chunk too large', 'offset': upload['received']}), 413
+    new_offset = resumable.append(conn, blob_store, upload, offset, request.stream, limit)
+    if new_offset is None:
+        upload = get_upload_session(c, upload_id)
+        return jsonify({'error': 'Offset mismatch', 'offset': upload['received'] if upload else None}), 409
+    return jsonify({'success': True, 'offset': new_offset, 'complete': new_offset >= upload['size']})
+
+@app.route('/api/uploads/finalize', methods=['POST'])
+@login_required
+def finalize_uploads():
+    """
+    Создать треки из загруженных файлов одной транзакцией:
+    {"tracks": [{"upload_id", "cover_upload_id"?, "title"?, "artist"?, "lyrics"?, "slug"?}, ...]}
+    """
+    items = (request.get_json(silent=True) or {}).get('tracks')
+    if not isinstance(items, list) or not 0 < len(items) <= resumable.MAX_FILES:
+        return jsonify({'error': f'tracks must be a list of 1..{resumable.MAX_FILES} items'}), 400
+    
+    conn = get_db()
+    c = conn.cursor()
+    # Проверка и хэширование файлов - до транзакции
+    prepared = []
+    seen = set()
+    for item in items:
+        if not isinstance(item, dict):
+            return jsonify({'error': 'Invalid track'}), 400
+        uploads = []
+        for key in ('upload_id', 'cover_upload_id'):
+            upload_id = item.get(key)
+            if key == 'cover_upload_id' and not upload_id:
+                uploads.append(None)
+                continue
+            upload = get_upload_session(c, upload_id) if isinstance(upload_id, str) else None
+            if not upload or upload_id in seen:
+                return jsonify({'error': 'Upload not found', 'upload_id': upload_id}), 404
+            if upload['received'] < upload['size']:
+                return jsonify({'error': 'Upload incomplete', 'upload_id': upload_id,
+                                'offset': upload['received']}), 409
+            seen.add(upload_id)
+            uploads.append(upload)
+        prepared.append((item, uploads[0], uploads[1]))
+    
+    slugs = [(item.get('slug') or '').strip() or None for item, _, _ in prepared]
+    named = [slug for slug in slugs if slug]
+    if len(set(named)) != len(named):
+        return jsonify({'error': 'Slug already exists'}), 400
+    
+    # Хэширование файлов - до транзакции. Файлы сессий остаются на месте до acquire_blob,
+    # поэтому при ошибке клиент может повторить finalize
+    blobs = []
+    for _, audio_upload, cover_upload in prepared:
+        adopted = []
+        for upload in (audio_upload, cover_upload):
+            blob = resumable.adopt(blob_store, upload) if upload else None
+            if upload and blob is None:
+                offset = resumable.rewind(c, blob_store, upload)
+                conn.commit()
+                return jsonify({'error': 'Upload incomplete', 'upload_id': upload['id'], 'offset': offset}), 409
+            adopted.append(blob)
+        blobs.append(tuple(adopted))
+    
+    created = []
+    c.execute("BEGIN IMMEDIATE")
+    try:
+        # Занятые slug проверяются заранее: файлы не должны переехать в хранилище до отказа транзакции
+        for i in range(0, len(named), LIKED_IDS_CHUNK):
+            chunk = named[i:i + LIKED_IDS_CHUNK]
+            c.execute(f"SELECT 1 FROM tracks WHERE slug IN ({','.join('?' * len(chunk))}) LIMIT 1", chunk)
+            if c.fetchone():
+                conn.rollback()
+                return jsonify({'error': 'Slug already exists'}), 400
+        c.execute("SELECT MAX(sort_order) FROM tracks WHERE user_id = ?", (session['user_id'],))
+        max_order = c.fetchone()[0] or 0
+        for i, ((item, audio_upload, cover_upload), (audio_blob, cover_blob)) in enumerate(zip(prepared, blobs)):
+            title = (item.get('title') or '').strip()
+            fill_title = not title
+            if not title:
+                title = secure_filename(audio_upload['name']).rsplit('.', 1)[0] or audio_blob.sha256[:12]
+            track_id, status = insert_track(c, session['user_id'], title, item.get('artist') or '',
+                                            item.get('lyrics') or '', slugs[i], max_order + 1 + i,
+                                            audio_blob, cover_blob, fill_title)
+            created.append((track_id, status, audio_blob, cover_blob))
+            for upload in (audio_upload, cover_upload):
+                if upload:
+                    resumable.remove(c, blob_store, upload['id'])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    
+    for track_id, status, audio_blob, cover_blob in created:
+        submit_track_jobs(track_id, status, audio_blob, cover_blob)
+    return jsonify({'success': True,
+                    'tracks': [{'id': track_id, 'status': status} for track_id, status, _, _ in created]})
+
 @app.route('/api/tracks/<int:track_id>', methods=['PUT'])
 @login_required
 def update_track(track_id):
     """Обновить трек"""
-    conn = sqlite3.connect(DB_FILE)
+    conn = get_db()
     c = conn.cursor()
     
     # Проверяем владельца
     c.execute("SELECT * FROM tracks WHERE id = ?", (track_id,))
     track = c.fetchone()
     if not track:
-        conn.close()
         return jsonify({'error': 'Track not found'}), 404
     
     if track[1] != session['user_id']:  # user_id в индексе 1
-        conn.close()
         return jsonify({'error': 'Forbidden'}), 403
     
     title = request.form.get('title')
@@ -937,126 +1780,121 @@ def update_track(track_id):
     lyrics = request.form.get('lyrics')
     slug = request.form.get('slug', '').strip() or None
     
-    audio_filename = None
+    audio_blob = None
     if 'audio' in request.files and request.files['audio'].filename:
         audio = request.files['audio']
         if allowed_file(audio.filename):
-            import uuid
-            ext = audio.filename.rsplit('.', 1)[1].lower()
-            audio_filename = f"{session['user_id']}_{int(datetime.now().timestamp())}_{uuid.uuid4().hex}.{ext}"
-            audio.save(os.path.join(app.config['UPLOAD_FOLDER'], audio_filename))
-            # Cleanup old
-            if track[3]:  # filename в индексе 3
-                old_path = os.path.join(app.config['UPLOAD_FOLDER'], track[3])
-                if os.path.exists(old_path):
-                    os.remove(old_path)
-    
-    cover_filename = None
+            audio_blob = ingest_upload(audio)
+    
+    cover_blob = None
     if 'cover' in request.files and request.files['cover'].filename:
         cover = request.files['cover']
         if allowed_file(cover.filename):
-            import uuid
-            cover_ext = cover.filename.rsplit('.', 1)[1].lower()
-            cover_filename = f"{session['user_id']}_{int(datetime.now().timestamp())}_{uuid.uuid4().hex}.{cover_ext}"
-            cover.save(os.path.join(app.config['UPLOAD_FOLDER'], cover_filename))
-            # Cleanup old
-            if track[4]:  # cover_filename в индексе 4
-                old_path = os.path.join(app.config['UPLOAD_FOLDER'], track[4])
-                if os.path.exists(old_path):
-                    os.remove(old_path)
-    
-    query = "UPDATE tracks SET title=?, artist=?, lyrics=?, slug=?"
+            cover_blob = ingest_upload(cover)
+    
+    query = "UPDATE tracks SET title=?, artist=?, lyrics=?, slug=?, updated_at=datetime('now')"
     params = [title, artist, lyrics, slug]
     
-    if audio_filename:
-        query += ", filename=?"
-        params.append(audio_filename)
-    if cover_filename:
+    reingest = audio_blob is not None and ingest.MUTAGEN_AVAILABLE
+    if audio_blob:
+        query += (", filename=?, duration=NULL, sample_rate=NULL, bitrate=NULL, loudness=NULL, segmented=0,"
+                  " gain=NULL, peak=NULL, encoder_delay=NULL, encoder_padding=NULL")
+        params.append(audio_blob.path)
+    if reingest:
+        query += ", status=?"
+        params.append(ingest.STATUS_PROCESSING)
+    if cover_blob:
         query += ", cover_filename=?"
-        params.append(cover_filename)
+        params.append(cover_blob.path)
         
     query += " WHERE id=?"
     params.append(track_id)
     
     try:
         c.execute(query, params)
+        # Сначала +1 новому файлу, потом -1 старому: при повторной загрузке того же файла он не пропадет
+        if audio_blob:
+            blobstore.acquire_blob(c, blob_store, audio_blob)
+            blobstore.release_blob(c, blob_store, track['filename'])
+        if cover_blob:
+            blobstore.acquire_blob(c, blob_store, cover_blob)
+            blobstore.release_blob(c, blob_store, track['cover_filename'])
+        save_lyrics_timeline(c, track_id, lyrics)
+        if reingest:
+            # Новое аудио - заново определяем длительность, метаданные пользователя не трогаем
+            ingest.add_job(c, track_id)
+        if audio_blob:
+            transcode.add_job(c, audio_blob.path)
         conn.commit()
-        conn.close()
+        if reingest:
+            ingest_queue.submit(track_id)
+        if audio_blob:
+            transcoder.submit(audio_blob.path)
+        if cover_blob:
+            thumb_cache.schedule(cover_blob.path)
         return jsonify({'success': True})
     except sqlite3.IntegrityError:
-        conn.close()
         return jsonify({'error': 'Slug already exists'}), 400
+    finally:
+        blob_store.discard(audio_blob)
+        blob_store.discard(cover_blob)
 
 @app.route('/api/tracks/<int:track_id>', methods=['DELETE'])
 @login_required
 def delete_track(track_id):
     """Удалить трек"""
-    conn = sqlite3.connect(DB_FILE)
+    conn = get_db()
     c = conn.cursor()
     c.execute("SELECT user_id, filename, cover_filename FROM tracks WHERE id = ?", (track_id,))
     track = c.fetchone()
     
     if not track:
-        conn.close()
         return jsonify({'error': 'Track not found'}), 404
     
     if track[0] != session['user_id']:
-        conn.close()
         return jsonify({'error': 'Forbidden'}), 403
     
-    # Удаляем файлы
-    if track[1] and os.path.exists(os.path.join(app.config['UPLOAD_FOLDER'], track[1])):
-        os.remove(os.path.join(app.config['UPLOAD_FOLDER'], track[1]))
-    if track[2] and os.path.exists(os.path.join(app.config['UPLOAD_FOLDER'], track[2])):
-        os.remove(os.path.join(app.config['UPLOAD_FOLDER'], track[2]))
-    
     c.execute("DELETE FROM tracks WHERE id = ?", (track_id,))
+    c.execute("DELETE FROM lyrics_timelines WHERE track_id = ?", (track_id,))
+    # Файлы удаляются, только если на них больше никто не ссылается
+    blobstore.release_blob(c, blob_store, track[1])
+    blobstore.release_blob(c, blob_store, track[2])
     conn.commit()
-    conn.close()
     return jsonify({'success': True})
 
 @app.route('/api/tracks/<int:track_id>/toggle-visibility', methods=['POST'])
 @login_required
 def toggle_track_visibility(track_id):
     """Переключить видимость трека"""
-    conn = sqlite3.connect(DB_FILE)
+    conn = get_db()
     c = conn.cursor()
     c.execute("SELECT user_id FROM tracks WHERE id = ?", (track_id,))
     track = c.fetchone()
     
     if not track or track[0] != session['user_id']:
-        conn.close()
         return jsonify({'error': 'Forbidden'}), 403
     
     data = request.get_json() or {}
     hidden = 1 if data.get('hidden') else 0
-    c.execute("UPDATE tracks SET hidden = ? WHERE id = ?", (hidden, track_id))
+    c.execute("UPDATE tracks SET hidden = ?, updated_at = datetime('now') WHERE id = ?", (hidden, track_id))
     conn.commit()
-    conn.close()
     return jsonify({'success': True})
 
 @app.route('/api/tracks/<int:track_id>/play', methods=['POST'])
 def count_play(track_id):
-    """Увеличить счетчик прослушиваний"""
-    conn = sqlite3.connect(DB_FILE)
+    """Увеличить счетчик прослушиваний (запись в БД - пачками в фоне)"""
+    conn = get_db()
     c = conn.cursor()
+    c.execute("SELECT COALESCE(plays_count, 0) as plays_count FROM tracks WHERE id = ?", (track_id,))
+    row = c.fetchone()
+    if not row:
+        return jsonify({'error': 'Track not found'}), 404
     
-    # Обновляем общий счетчик трека
-    c.execute("UPDATE tracks SET plays_count = COALESCE(plays_count, 0) + 1 WHERE id = ?", (track_id,))
-    
-    # Записываем прослушивание пользователем (если авторизован)
-    current_user_id = session.get('user_id')
-    if current_user_id:
-        c.execute("""INSERT INTO track_plays (user_id, track_id, play_count, last_played_at) 
-                     VALUES (?, ?, 1, datetime('now'))
-                     ON CONFLICT(user_id, track_id) DO UPDATE SET 
-                     play_count = play_count + 1,
-                     last_played_at = datetime('now')""", (current_user_id, track_id))
+    # Записываем прослушивание (и пользователя, если авторизован) в буфер
+    play_counter.record_track_play(track_id, session.get('user_id'))
     
-    conn.commit()
-    c.execute("SELECT COALESCE(plays_count, 0) as plays_count FROM tracks WHERE id = ?", (track_id,))
-    count = c.fetchone()[0] or 0
-    conn.close()
+    # Приблизительное значение: уже сброшенное в БД + ожидающее сброса
+    count = (row[0] or 0) + play_counter.pending_track_plays(track_id)
     return jsonify({'success': True, 'plays_count': count})
 
 @app.route('/api/tracks/<int:track_id>/like', methods=['GET', 'POST'])
@@ -1066,18 +1904,14 @@ def toggle_like(track_id):
         # Получить статус лайка
         current_user_id = session.get('user_id')
         liked = False
+        conn = get_db()
+        c = conn.cursor()
         if current_user_id:
-            conn = sqlite3.connect(DB_FILE)
-            c = conn.cursor()
             c.execute("SELECT id FROM likes WHERE user_id = ? AND track_id = ?", (current_user_id, track_id))
             liked = c.fetchone() is not None
-            conn.close()
         
-        conn = sqlite3.connect(DB_FILE)
-        c = conn.cursor()
         c.execute("SELECT COALESCE(likes_count, 0) as likes_count FROM tracks WHERE id = ?", (track_id,))
         count = c.fetchone()[0] or 0
-        conn.close()
         
         return jsonify({'success': True, 'liked': liked, 'likes_count': count})
     
@@ -1102,23 +1936,27 @@ def toggle_like(track_id):
             'auth_url': bot_url
         }), 401
     
-    conn = sqlite3.connect(DB_FILE)
+    conn = get_db()
     c = conn.cursor()
     
     # Проверяем лайк пользователя
-    c.execute("SELECT id FROM likes WHERE user_id = ? AND track_id = ?", (user_id, track_id))
+    c.execute("SELECT id, created_at FROM likes WHERE user_id = ? AND track_id = ?", (user_id, track_id))
     like = c.fetchone()
     
     if like:
         # Удаляем лайк
         c.execute("DELETE FROM likes WHERE id = ?", (like[0],))
-        c.execute("UPDATE tracks SET likes_count = COALESCE(likes_count, 0) - 1 WHERE id = ?", (track_id,))
+        c.execute("UPDATE tracks SET likes_count = MAX(COALESCE(likes_count, 0) - 1, 0) WHERE id = ?", (track_id,))
         liked = False
+        liked_at = like[1]
     else:
         # Добавляем лайк
         c.execute("INSERT INTO likes (user_id, track_id) VALUES (?, ?)", (user_id, track_id))
+        c.execute("SELECT created_at FROM likes WHERE id = ?", (c.lastrowid,))
+        liked_at = c.fetchone()[0]
         c.execute("UPDATE tracks SET likes_count = COALESCE(likes_count, 0) + 1 WHERE id = ?", (track_id,))
         liked = True
+    trending.record_like(c, 'tracks', track_id, liked, liked_at)
     
     conn.commit()
     
@@ -1126,19 +1964,20 @@ def toggle_like(track_id):
     c.execute("SELECT COALESCE(likes_count, 0) as likes_count FROM tracks WHERE id = ?", (track_id,))
     count = c.fetchone()[0] or 0
     
-    conn.close()
     return jsonify({'success': True, 'liked': liked, 'likes_count': count})
 
 @app.route('/api/albums/<int:album_id>/play', methods=['POST'])
 def count_album_play(album_id):
-    """Увеличить счетчик прослушиваний альбома"""
-    conn = sqlite3.connect(DB_FILE)
+    """Увеличить счетчик прослушиваний альбома (запись в БД - пачками в фоне)"""
+    conn = get_db()
     c = conn.cursor()
-    c.execute("UPDATE albums SET plays_count = COALESCE(plays_count, 0) + 1 WHERE id = ?", (album_id,))
-    conn.commit()
     c.execute("SELECT COALESCE(plays_count, 0) as plays_count FROM albums WHERE id = ?", (album_id,))
-    count = c.fetchone()[0] or 0
-    conn.close()
+    row = c.fetchone()
+    if not row:
+        return jsonify({'error': 'Album not found'}), 404
+    
+    play_counter.record_album_play(album_id)
+    count = (row[0] or 0) + play_counter.pending_album_plays(album_id)
     return jsonify({'success': True, 'plays_count': count})
 
 @app.route('/api/albums/<int:album_id>/like', methods=['POST'])
@@ -1149,23 +1988,23 @@ def toggle_album_like(album_id):
     if not user_id:
         return jsonify({'error': 'Auth required'}), 401
     
-    conn = sqlite3.connect(DB_FILE)
+    conn = get_db()
     c = conn.cursor()
     
     try:
         # Проверяем существование альбома
         c.execute("SELECT id FROM albums WHERE id = ?", (album_id,))
         if not c.fetchone():
-            conn.close()
             return jsonify({'error': 'Album not found'}), 404
         
         # Проверяем лайк пользователя
-        c.execute("SELECT id FROM album_likes WHERE user_id = ? AND album_id = ?", (user_id, album_id))
+        c.execute("SELECT id, created_at FROM album_likes WHERE user_id = ? AND album_id = ?", (user_id, album_id))
         like = c.fetchone()
         
         if like:
             # Удаляем лайк
             c.execute("DELETE FROM album_likes WHERE id = ?", (like[0],))
+            liked_at = like[1]
             # Обновляем счетчик с защитой от отрицательных значений
             c.execute("UPDATE albums SET likes_count = CASE WHEN COALESCE(likes_count, 0) > 0 THEN likes_count - 1 ELSE 0 END WHERE id = ?", (album_id,))
             liked = False
@@ -1173,13 +2012,15 @@ def toggle_album_like(album_id):
             # Добавляем лайк (с защитой от дубликатов)
             try:
                 c.execute("INSERT INTO album_likes (user_id, album_id) VALUES (?, ?)", (user_id, album_id))
+                c.execute("SELECT created_at FROM album_likes WHERE id = ?", (c.lastrowid,))
+                liked_at = c.fetchone()[0]
                 c.execute("UPDATE albums SET likes_count = COALESCE(likes_count, 0) + 1 WHERE id = ?", (album_id,))
                 liked = True
             except sqlite3.IntegrityError:
                 # Если дубликат (не должно произойти, но на всякий случай)
                 conn.rollback()
-                conn.close()
                 return jsonify({'error': 'Like already exists'}), 400
+        trending.record_like(c, 'albums', album_id, liked, liked_at)
         
         conn.commit()
         
@@ -1191,11 +2032,9 @@ def toggle_album_like(album_id):
         c.execute("UPDATE albums SET likes_count = ? WHERE id = ?", (actual_count, album_id))
         conn.commit()
         
-        conn.close()
         return jsonify({'success': True, 'liked': liked, 'likes_count': actual_count})
     except Exception as e:
         conn.rollback()
-        conn.close()
         print(f"Error toggling album like: {e}")
         import traceback
         traceback.print_exc()
@@ -1208,41 +2047,29 @@ def get_albums():
     user_id = request.args.get('user_id', type=int)
     current_user_id = session.get('user_id')
     
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     c = conn.cursor()
     
-    query = """SELECT a.*, u.nickname, u.display_name, u.avatar_url,
-              COALESCE(a.plays_count, 0) as plays_count,
-              COALESCE(a.likes_count, 0) as likes_count
-               FROM albums a 
-               JOIN users u ON a.user_id = u.id 
-               WHERE a.hidden = 0"""
-    params = []
-    if user_id:
-        query += " AND a.user_id = ?"
-        params.append(user_id)
-    query += " ORDER BY a.is_pinned DESC, a.created_at DESC"
-    c.execute(query, params)
-    
-    albums = []
-    for row in c.fetchall():
-        album = dict(row)
-        # Проверяем лайкнул ли текущий пользователь
-        if current_user_id:
-            c.execute("SELECT id FROM album_likes WHERE user_id = ? AND album_id = ?", (current_user_id, album['id']))
-            album['is_liked'] = c.fetchone() is not None
-        else:
-            album['is_liked'] = False
-        albums.append(album)
+    def build():
+        query = """SELECT a.*, u.nickname, u.display_name, u.avatar_url,
+                  COALESCE(a.plays_count, 0) as plays_count,
+                  COALESCE(a.likes_count, 0) as likes_count
+                   FROM albums a 
+                   JOIN users u ON a.user_id = u.id 
+                   WHERE a.hidden = 0"""
+        params = []
+        if user_id:
+            query += " AND a.user_id = ?"
+            params.append(user_id)
+        query += f" ORDER BY {FEED_ORDERS[feed_sort()][1]}"
+        c.execute(query, params)
+        return fill_is_liked(c, [dict(row) for row in c.fetchall()], current_user_id, 'album')
     
-    conn.close()
-    return jsonify(albums)
+    return generation_json(generation_etag(c, names=[generations.API_ALBUMS]), build)
     """Получить альбомы"""
     user_id = request.args.get('user_id', type=int)
     
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     c = conn.cursor()
     
     query = """SELECT a.*, u.nickname, u.display_name, u.avatar_url 
@@ -1257,7 +2084,6 @@ def get_albums():
     c.execute(query, params)
     
     albums = [dict(row) for row in c.fetchall()]
-    conn.close()
     return jsonify(albums)
 
 @app.route('/api/albums', methods=['POST'])
@@ -1278,39 +2104,40 @@ def create_album():
     if not title:
         return jsonify({'error': 'Title is required'}), 400
     
-    cover_filename = None
+    cover_blob = None
     if 'cover' in request.files and request.files['cover'].filename:
         cover = request.files['cover']
         if allowed_file(cover.filename):
-            cover_filename = secure_filename(cover.filename)
-            cover_filename = f"{session['user_id']}_{int(datetime.now().timestamp())}_{cover_filename}"
-            cover.save(os.path.join(app.config['UPLOAD_FOLDER'], cover_filename))
+            cover_blob = ingest_upload(cover)
     
-    conn = sqlite3.connect(DB_FILE)
+    conn = get_db()
     c = conn.cursor()
     try:
         c.execute("""INSERT INTO albums (user_id, title, description, slug, cover_filename) 
                      VALUES (?, ?, ?, ?, ?)""",
-                  (session['user_id'], title, description, slug, cover_filename))
-        conn.commit()
+                  (session['user_id'], title, description, slug, cover_blob.path if cover_blob else None))
         album_id = c.lastrowid
-        conn.close()
+        if cover_blob:
+            blobstore.acquire_blob(c, blob_store, cover_blob)
+        conn.commit()
+        if cover_blob:
+            thumb_cache.schedule(cover_blob.path)
         return jsonify({'success': True, 'id': album_id, 'album_id': album_id})
     except sqlite3.IntegrityError:
-        conn.close()
         return jsonify({'error': 'Slug already exists'}), 400
+    finally:
+        blob_store.discard(cover_blob)
 
 @app.route('/api/albums/<int:album_id>', methods=['PUT'])
 @login_required
 def update_album(album_id):
     """Обновить альбом"""
-    conn = sqlite3.connect(DB_FILE)
+    conn = get_db()
     c = conn.cursor()
     c.execute("SELECT user_id FROM albums WHERE id = ?", (album_id,))
     album = c.fetchone()
     
     if not album or album[0] != session['user_id']:
-        conn.close()
         return jsonify({'error': 'Forbidden'}), 403
     
     # Поддерживаем как JSON, так и FormData
@@ -1324,54 +2151,102 @@ def update_album(album_id):
         description = request.form.get('description', '').strip()
         slug = request.form.get('slug', '').strip() or None
     
-    cover_filename = None
+    cover_blob = None
     if 'cover' in request.files and request.files['cover'].filename:
         cover = request.files['cover']
         if allowed_file(cover.filename):
-            import uuid
-            cover_ext = cover.filename.rsplit('.', 1)[1].lower()
-            cover_filename = f"{session['user_id']}_{int(datetime.now().timestamp())}_{uuid.uuid4().hex}.{cover_ext}"
-            cover.save(os.path.join(app.config['UPLOAD_FOLDER'], cover_filename))
-            # Удаляем старую обложку
-            c.execute("SELECT cover_filename FROM albums WHERE id = ?", (album_id,))
-            old_cover = c.fetchone()
-            if old_cover and old_cover[0]:
-                old_path = os.path.join(app.config['UPLOAD_FOLDER'], old_cover[0])
-                if os.path.exists(old_path):
-                    os.remove(old_path)
+            cover_blob = ingest_upload(cover)
     
     try:
-        if cover_filename:
+        if cover_blob:
+            c.execute("SELECT cover_filename FROM albums WHERE id = ?", (album_id,))
+            old_cover = c.fetchone()[0]
             c.execute("UPDATE albums SET title=?, description=?, slug=?, cover_filename=? WHERE id=?",
-                      (title, description, slug, cover_filename, album_id))
+                      (title, description, slug, cover_blob.path, album_id))
+            # Старую обложку освобождаем после новой (если это тот же файл, он останется)
+            blobstore.acquire_blob(c, blob_store, cover_blob)
+            blobstore.release_blob(c, blob_store, old_cover)
         else:
             c.execute("UPDATE albums SET title=?, description=?, slug=? WHERE id=?",
                       (title, description, slug, album_id))
         conn.commit()
-        conn.close()
+        if cover_blob:
+            thumb_cache.schedule(cover_blob.path)
         return jsonify({'success': True})
     except sqlite3.IntegrityError:
-        conn.close()
         return jsonify({'error': 'Slug already exists'}), 400
+    finally:
+        blob_store.discard(cover_blob)
 
 @app.route('/api/albums/<int:album_id>', methods=['DELETE'])
 @login_required
 def delete_album(album_id):
     """Удалить альбом"""
-    conn = sqlite3.connect(DB_FILE)
+    conn = get_db()
     c = conn.cursor()
-    c.execute("SELECT user_id FROM albums WHERE id = ?", (album_id,))
+    c.execute("SELECT user_id, cover_filename FROM albums WHERE id = ?", (album_id,))
     album = c.fetchone()
     
     if not album or album[0] != session['user_id']:
-        conn.close()
         return jsonify({'error': 'Forbidden'}), 403
     
     c.execute("DELETE FROM albums WHERE id = ?", (album_id,))
+    blobstore.release_blob(c, blob_store, album[1])
     conn.commit()
-    conn.close()
     return jsonify({'success': True})
 
+# === ПОРЯДОК ТРЕКОВ В АЛЬБОМЕ ===
+
+# Ключи sort_order идут с шагом ALBUM_ORDER_GAP: перемещение трека - одна запись
+# ключа посередине между соседями, перенумерация альбома - только когда промежуток кончился
+ALBUM_ORDER_GAP = 1024
+ALBUM_ORDER_MAX_TRACKS = 10000
+
+def album_track_ids(c, album_id):
+    """id треков альбома в текущем порядке"""
+    c.execute("""SELECT track_id FROM album_tracks WHERE album_id = ?
+                 ORDER BY sort_order ASC, track_id ASC""", (album_id,))
+    return [row[0] for row in c.fetchall()]
+
+def renumber_album(c, album_id, track_ids):
+    """Записать порядок track_ids ключами с шагом ALBUM_ORDER_GAP (меняются только отличающиеся)"""
+    c.execute("SELECT track_id, sort_order FROM album_tracks WHERE album_id = ?", (album_id,))
+    current = {row[0]: row[1] for row in c.fetchall()}
+    updates = [((i + 1) * ALBUM_ORDER_GAP, album_id, track_id)
+               for i, track_id in enumerate(track_ids) if current.get(track_id) != (i + 1) * ALBUM_ORDER_GAP]
+    c.executemany("UPDATE album_tracks SET sort_order = ? WHERE album_id = ? AND track_id = ?", updates)
+    return len(updates)
+
+def parse_track_ids(data):
+    """track_ids из тела запроса: список уникальных целых id или None"""
+    track_ids = data.get('track_ids')
+    if (not isinstance(track_ids, list) or len(track_ids) > ALBUM_ORDER_MAX_TRACKS
+            or not all(isinstance(t, int) and not isinstance(t, bool) for t in track_ids)
+            or len(set(track_ids)) != len(track_ids)):
+        return None
+    return track_ids
+
+def album_track_list(c, album_id):
+    """Видимые треки альбома в порядке альбома (выдача /api/albums/<id>/tracks)"""
+    c.execute("""SELECT t.*, at.sort_order 
+                 FROM tracks t 
+                 JOIN album_tracks at ON t.id = at.track_id 
+                 WHERE at.album_id = ? AND t.hidden = 0 
+                 ORDER BY at.sort_order ASC, t.id ASC""", (album_id,))
+    return fill_album_gain([dict(row) for row in c.fetchall()])
+
+def fill_album_gain(tracks):
+    """Общее усиление альбома в каждом треке (album_gain) - плеер применяет его вместо gain"""
+    gain = analysis.album_gain(tracks)
+    for track in tracks:
+        track['album_gain'] = gain
+    return tracks
+
+def next_album_order(c, album_id):
+    """Ключ для трека в конец альбома"""
+    c.execute("SELECT MAX(sort_order) FROM album_tracks WHERE album_id = ?", (album_id,))
+    return (c.fetchone()[0] or 0) + ALBUM_ORDER_GAP
+
 @app.route('/api/albums/<int:album_id>/tracks', methods=['POST'])
 @login_required
 def add_track_to_album(album_id):
@@ -1382,180 +2257,253 @@ def add_track_to_album(album_id):
     if not track_id:
         return jsonify({'error': 'track_id is required'}), 400
     
-    conn = sqlite3.connect(DB_FILE)
+    conn = get_db()
     c = conn.cursor()
     
     # Проверяем владельца альбома
     c.execute("SELECT user_id FROM albums WHERE id = ?", (album_id,))
     album = c.fetchone()
     if not album or album[0] != session['user_id']:
-        conn.close()
         return jsonify({'error': 'Forbidden'}), 403
     
     # Проверяем владельца трека
     c.execute("SELECT user_id FROM tracks WHERE id = ?", (track_id,))
     track = c.fetchone()
     if not track or track[0] != session['user_id']:
-        conn.close()
         return jsonify({'error': 'Forbidden'}), 403
     
     try:
-        c.execute("SELECT MAX(sort_order) FROM album_tracks WHERE album_id = ?", (album_id,))
-        max_order = c.fetchone()[0] or 0
         c.execute("INSERT INTO album_tracks (album_id, track_id, sort_order) VALUES (?, ?, ?)",
-                  (album_id, track_id, max_order + 1))
+                  (album_id, track_id, next_album_order(c, album_id)))
         conn.commit()
-        conn.close()
         return jsonify({'success': True})
     except sqlite3.IntegrityError:
-        conn.close()
         return jsonify({'error': 'Track already in album'}), 400
 
+@app.route('/api/albums/<int:album_id>/tracks/batch', methods=['POST'])
+@login_required
+def add_tracks_to_album_batch(album_id):
+    """Добавить в альбом список треков {"track_ids": [...]}; уже добавленные пропускаются"""
+    track_ids = parse_track_ids(request.get_json(silent=True) or {})
+    if not track_ids:
+        return jsonify({'error': 'track_ids must be a non-empty list of unique track ids'}), 400
+    
+    conn = get_db()
+    c = conn.cursor()
+    c.execute("SELECT user_id FROM albums WHERE id = ?", (album_id,))
+    album = c.fetchone()
+    if not album or album[0] != session['user_id']:
+        return jsonify({'error': 'Forbidden'}), 403
+    
+    # Владелец всех треков - одним запросом на пачку id
+    owned = set()
+    for i in range(0, len(track_ids), LIKED_IDS_CHUNK):
+        chunk = track_ids[i:i + LIKED_IDS_CHUNK]
+        c.execute(f"SELECT id FROM tracks WHERE user_id = ? AND id IN ({','.join('?' * len(chunk))})",
+                  [session['user_id']] + chunk)
+        owned.update(row[0] for row in c.fetchall())
+    if len(owned) != len(track_ids):
+        return jsonify({'error': 'Forbidden'}), 403
+    
+    c.execute("BEGIN IMMEDIATE")
+    try:
+        present = set(album_track_ids(c, album_id))
+        new_ids = [t for t in track_ids if t not in present]
+        base = next_album_order(c, album_id)
+        c.executemany("INSERT INTO album_tracks (album_id, track_id, sort_order) VALUES (?, ?, ?)",
+                      [(album_id, track_id, base + i * ALBUM_ORDER_GAP) for i, track_id in enumerate(new_ids)])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return jsonify({'success': True, 'added': len(new_ids), 'tracks': album_track_list(c, album_id)})
+
+@app.route('/api/albums/<int:album_id>/tracks/batch', methods=['DELETE'])
+@login_required
+def remove_tracks_from_album_batch(album_id):
+    """Удалить из альбома список треков {"track_ids": [...]}"""
+    track_ids = parse_track_ids(request.get_json(silent=True) or {})
+    if not track_ids:
+        return jsonify({'error': 'track_ids must be a non-empty list of unique track ids'}), 400
+    
+    conn = get_db()
+    c = conn.cursor()
+    c.execute("SELECT user_id FROM albums WHERE id = ?", (album_id,))
+    album = c.fetchone()
+    if not album or album[0] != session['user_id']:
+        return jsonify({'error': 'Forbidden'}), 403
+    
+    c.executemany("DELETE FROM album_tracks WHERE album_id = ? AND track_id = ?",
+                  [(album_id, track_id) for track_id in track_ids])
+    removed = c.rowcount
+    conn.commit()
+    return jsonify({'success': True, 'removed': removed, 'tracks': album_track_list(c, album_id)})
+
 @app.route('/api/albums/<int:album_id>/tracks/<int:track_id>', methods=['DELETE'])
 @login_required
 def remove_track_from_album(album_id, track_id):
     """Удалить трек из альбома"""
-    conn = sqlite3.connect(DB_FILE)
+    conn = get_db()
     c = conn.cursor()
     c.execute("SELECT user_id FROM albums WHERE id = ?", (album_id,))
     album = c.fetchone()
     
     if not album or album[0] != session['user_id']:
-        conn.close()
         return jsonify({'error': 'Forbidden'}), 403
     
     c.execute("DELETE FROM album_tracks WHERE album_id = ? AND track_id = ?", (album_id, track_id))
     conn.commit()
-    conn.close()
     return jsonify({'success': True})
 
 @app.route('/api/albums/<int:album_id>/tracks/<int:track_id>/move', methods=['POST'])
 @login_required
 def move_track_in_album(album_id, track_id):
     """Переместить трек в альбоме (вверх/вниз)"""
-    conn = sqlite3.connect(DB_FILE)
+    conn = get_db()
     c = conn.cursor()
     c.execute("SELECT user_id FROM albums WHERE id = ?", (album_id,))
     album = c.fetchone()
     
     if not album or album[0] != session['user_id']:
-        conn.close()
         return jsonify({'error': 'Forbidden'}), 403
     
     data = request.get_json() or {}
     direction = data.get('direction', 'down')  # 'up' or 'down'
     
-    # Получаем текущий sort_order
+    c.execute("BEGIN IMMEDIATE")
     c.execute("SELECT sort_order FROM album_tracks WHERE album_id = ? AND track_id = ?", (album_id, track_id))
     current = c.fetchone()
     if not current:
-        conn.close()
+        conn.rollback()
         return jsonify({'error': 'Track not in album'}), 404
     
-    current_order = current[0]
-    
+    # Два ближайших трека в сторону перемещения: новый ключ - между ними
     if direction == 'up':
-        # Находим трек с меньшим sort_order
-        c.execute("""SELECT track_id, sort_order FROM album_tracks 
-                     WHERE album_id = ? AND sort_order < ? 
-                     ORDER BY sort_order DESC LIMIT 1""", (album_id, current_order))
-        prev_track = c.fetchone()
-        if prev_track:
-            # Меняем местами
-            c.execute("UPDATE album_tracks SET sort_order = ? WHERE album_id = ? AND track_id = ?", 
-                     (prev_track[1], album_id, track_id))
-            c.execute("UPDATE album_tracks SET sort_order = ? WHERE album_id = ? AND track_id = ?", 
-                     (current_order, album_id, prev_track[0]))
-    else:  # down
-        # Находим трек с большим sort_order
-        c.execute("""SELECT track_id, sort_order FROM album_tracks 
-                     WHERE album_id = ? AND sort_order > ? 
-                     ORDER BY sort_order ASC LIMIT 1""", (album_id, current_order))
-        next_track = c.fetchone()
-        if next_track:
-            # Меняем местами
-            c.execute("UPDATE album_tracks SET sort_order = ? WHERE album_id = ? AND track_id = ?", 
-                     (next_track[1], album_id, track_id))
-            c.execute("UPDATE album_tracks SET sort_order = ? WHERE album_id = ? AND track_id = ?", 
-                     (current_order, album_id, next_track[0]))
+        c.execute("""SELECT sort_order FROM album_tracks
+                     WHERE album_id = ? AND (sort_order < ? OR (sort_order = ? AND track_id < ?))
+                     ORDER BY sort_order DESC, track_id DESC LIMIT 2""",
+                  (album_id, current[0], current[0], track_id))
+    else:
+        c.execute("""SELECT sort_order FROM album_tracks
+                     WHERE album_id = ? AND (sort_order > ? OR (sort_order = ? AND track_id > ?))
+                     ORDER BY sort_order ASC, track_id ASC LIMIT 2""",
+                  (album_id, current[0], current[0], track_id))
+    neighbours = [row[0] for row in c.fetchall()]
+    if neighbours:
+        near = neighbours[0]
+        step = -ALBUM_ORDER_GAP if direction == 'up' else ALBUM_ORDER_GAP
+        far = neighbours[1] if len(neighbours) > 1 else near + 2 * step
+        if abs(far - near) >= 2:
+            c.execute("UPDATE album_tracks SET sort_order = ? WHERE album_id = ? AND track_id = ?",
+                      ((near + far) // 2, album_id, track_id))
+        else:
+            # Промежуток исчерпан (или старые ключи 1, 2, 3...) - перенумеровываем альбом целиком
+            track_ids = album_track_ids(c, album_id)
+            pos = track_ids.index(track_id)
+            track_ids.pop(pos)
+            track_ids.insert(pos - 1 if direction == 'up' else pos + 1, track_id)
+            renumber_album(c, album_id, track_ids)
     
     conn.commit()
-    conn.close()
     return jsonify({'success': True})
 
+@app.route('/api/albums/<int:album_id>/order', methods=['PUT'])
+@login_required
+def set_album_order(album_id):
+    """
+    Задать порядок треков альбома целиком: {"track_ids": [...]}.
+    Треки, которых нет в списке (например, скрытые), сохраняют взаимный порядок и идут после.
+    """
+    track_ids = parse_track_ids(request.get_json(silent=True) or {})
+    if track_ids is None:
+        return jsonify({'error': 'track_ids must be a list of unique track ids'}), 400
+    
+    conn = get_db()
+    c = conn.cursor()
+    c.execute("SELECT user_id FROM albums WHERE id = ?", (album_id,))
+    album = c.fetchone()
+    if not album or album[0] != session['user_id']:
+        return jsonify({'error': 'Forbidden'}), 403
+    
+    c.execute("BEGIN IMMEDIATE")
+    try:
+        current = album_track_ids(c, album_id)
+        listed = set(track_ids)
+        if not listed.issubset(current):
+            conn.rollback()
+            return jsonify({'error': 'Track not in album'}), 400
+        updated = renumber_album(c, album_id, track_ids + [t for t in current if t not in listed])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return jsonify({'success': True, 'updated': updated})
+
 @app.route('/api/albums/<int:album_id>/tracks', methods=['GET'])
 def get_album_tracks(album_id):
     """Получить треки альбома"""
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     c = conn.cursor()
-    c.execute("""SELECT t.*, at.sort_order 
-                 FROM tracks t 
-                 JOIN album_tracks at ON t.id = at.track_id 
-                 WHERE at.album_id = ? AND t.hidden = 0 
-                 ORDER BY at.sort_order ASC, t.id ASC""", (album_id,))
-    tracks = [dict(row) for row in c.fetchall()]
-    conn.close()
-    return jsonify(tracks)
+    
+    def build():
+        return album_track_list(c, album_id)
+    
+    # Выдача не зависит от пользователя
+    etag = generation_etag(c, entities=[(generations.API_ALBUM, album_id)], per_user=False)
+    return generation_json(etag, build)
 
 @app.route('/api/album/<album_identifier>')
 def api_get_album(album_identifier):
     """API: Получить альбом с треками"""
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     c = conn.cursor()
     
     if album_identifier.isdigit():
-        c.execute("""SELECT a.*, u.nickname, u.display_name, u.avatar_url,
-                        COALESCE(a.plays_count, 0) as plays_count,
-                        COALESCE(a.likes_count, 0) as likes_count
-                     FROM albums a 
-                     JOIN users u ON a.user_id = u.id 
-                     WHERE a.id = ? AND a.hidden = 0""", (int(album_identifier),))
+        album_id = int(album_identifier)
     else:
+        # Для ETag нужен id; поиск по индексу slug
+        c.execute("SELECT id FROM albums WHERE slug = ?", (album_identifier,))
+        row = c.fetchone()
+        if not row:
+            return jsonify({'error': 'Album not found'}), 404
+        album_id = row[0]
+    
+    current_user_id = session.get('user_id')
+    
+    def build():
         c.execute("""SELECT a.*, u.nickname, u.display_name, u.avatar_url,
                         COALESCE(a.plays_count, 0) as plays_count,
                         COALESCE(a.likes_count, 0) as likes_count
                      FROM albums a 
                      JOIN users u ON a.user_id = u.id 
-                     WHERE a.slug = ? AND a.hidden = 0""", (album_identifier,))
-    
-    album = c.fetchone()
-    if not album:
-        conn.close()
-        return jsonify({'error': 'Album not found'}), 404
-    
-    album = dict(album)
-    
-    # Проверяем лайк текущего пользователя
-    current_user_id = session.get('user_id')
-    if current_user_id:
-        c.execute("SELECT id FROM album_likes WHERE user_id = ? AND album_id = ?", (current_user_id, album['id']))
-        album['is_liked'] = c.fetchone() is not None
-    else:
-        album['is_liked'] = False
-    
-    # Получаем треки альбома
-    c.execute("""SELECT t.*, at.sort_order, u.nickname,
-                    COALESCE(t.plays_count, 0) as plays_count,
-                    COALESCE(t.likes_count, 0) as likes_count
-                 FROM tracks t 
-                 JOIN album_tracks at ON t.id = at.track_id 
-                 JOIN users u ON t.user_id = u.id
-                 WHERE at.album_id = ? AND t.hidden = 0 
-                 ORDER BY at.sort_order ASC, t.id ASC""", (album['id'],))
-    tracks = [dict(row) for row in c.fetchall()]
-    
-    # Проверяем лайки для треков
-    for track in tracks:
-        if current_user_id:
-            c.execute("SELECT id FROM likes WHERE user_id = ? AND track_id = ?", (current_user_id, track['id']))
-            track['is_liked'] = c.fetchone() is not None
-        else:
-            track['is_liked'] = False
+                     WHERE a.id = ? AND a.hidden = 0""", (album_id,))
+        album = c.fetchone()
+        if not album:
+            return jsonify({'error': 'Album not found'}), 404
+        
+        album = dict(album)
+        
+        # Проверяем лайк текущего пользователя
+        fill_is_liked(c, [album], current_user_id, 'album')
+        
+        # Получаем треки альбома
+        c.execute("""SELECT t.*, at.sort_order, u.nickname,
+                        COALESCE(t.plays_count, 0) as plays_count,
+                        COALESCE(t.likes_count, 0) as likes_count
+                     FROM tracks t 
+                     JOIN album_tracks at ON t.id = at.track_id 
+                     JOIN users u ON t.user_id = u.id
+                     WHERE at.album_id = ? AND t.hidden = 0 
+                     ORDER BY at.sort_order ASC, t.id ASC""", (album_id,))
+        tracks = fill_album_gain([dict(row) for row in c.fetchall()])
+        
+        # Проверяем лайки для треков
+        fill_is_liked(c, tracks, current_user_id)
+        
+        return {'album': album, 'tracks': tracks}
     
-    conn.close()
-    return jsonify({'album': album, 'tracks': tracks})
+    etag = generation_etag(c, entities=[(generations.API_ALBUM, album_id)])
+    return generation_json(etag, build)
 
 # Админка
 @app.route('/admin/login', methods=['GET', 'POST'])
@@ -1566,11 +2514,10 @@ def admin_login():
         username = data.get('username', '').strip()
         password = data.get('password', '')
         
-        conn = sqlite3.connect(DB_FILE)
+        conn = get_db()
         c = conn.cursor()
         c.execute("SELECT * FROM admins WHERE username = ?", (username,))
         admin = c.fetchone()
-        conn.close()
         
         if admin and check_password_hash(admin[2], password):
             session['admin'] = True
@@ -1598,8 +2545,7 @@ def admin_logout():
 @admin_required
 def admin_get_tracks():
     """Получить все треки для админки"""
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     c = conn.cursor()
     c.execute("""SELECT t.*, u.nickname, u.display_name,
                  GROUP_CONCAT(a.title, ', ') as album_names
@@ -1614,15 +2560,13 @@ def admin_get_tracks():
         track = dict(row)
         track['is_pinned'] = bool(track.get('is_pinned', 0))
         tracks.append(track)
-    conn.close()
     return jsonify(tracks)
 
 @app.route('/admin/api/albums', methods=['GET'])
 @admin_required
 def admin_get_albums():
     """Получить все альбомы для админки"""
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     c = conn.cursor()
     c.execute("""SELECT a.*, u.nickname, u.display_name 
                  FROM albums a 
@@ -1633,155 +2577,295 @@ def admin_get_albums():
         album = dict(row)
         album['is_pinned'] = bool(album.get('is_pinned', 0))
         albums.append(album)
-    conn.close()
     return jsonify(albums)
 
 @app.route('/admin/api/albums/<int:album_id>/toggle-visibility', methods=['POST'])
 @admin_required
 def admin_toggle_album_visibility(album_id):
     """Скрыть/показать альбом (админ)"""
-    conn = sqlite3.connect(DB_FILE)
+    conn = get_db()
     c = conn.cursor()
     data = request.get_json() or {}
     hidden = 1 if data.get('hidden') else 0
     c.execute("UPDATE albums SET hidden = ? WHERE id = ?", (hidden, album_id))
     conn.commit()
-    conn.close()
     return jsonify({'success': True})
 
+@app.route('/admin/api/db-stats', methods=['GET'])
+@admin_required
+def admin_db_stats():
+    """Статистика пула соединений (админ)"""
+    return jsonify(db_pool.stats())
+
+@app.route('/admin/api/play-counter-stats', methods=['GET'])
+@admin_required
+def admin_play_counter_stats():
+    """Статистика буфера прослушиваний (админ)"""
+    return jsonify(play_counter.stats())
+
+@app.route('/admin/api/ingest-stats', methods=['GET'])
+@admin_required
+def admin_ingest_stats():
+    """Статистика очереди обработки загрузок (админ)"""
+    return jsonify(ingest_queue.stats())
+
+@app.route('/admin/api/blob-stats', methods=['GET'])
+@admin_required
+def admin_blob_stats():
+    """Статистика сборщика файлов без ссылок (админ)"""
+    return jsonify(blob_collector.stats())
+
+@app.route('/admin/api/thumbnail-stats', methods=['GET'])
+@admin_required
+def admin_thumbnail_stats():
+    """Статистика кэша миниатюр (админ)"""
+    return jsonify(thumb_cache.stats())
+
+@app.route('/admin/api/page-cache-stats', methods=['GET'])
+@admin_required
+def admin_page_cache_stats():
+    """Статистика кэша публичных страниц (админ)"""
+    return jsonify(page_cache.stats())
+
+# Названия объектов для топа статистики
+STATS_NAMES_SQL = {
+    'track': "SELECT id, title, artist FROM tracks WHERE id IN ({ids})",
+    'album': "SELECT id, title FROM albums WHERE id IN ({ids})",
+    'artist': "SELECT id, nickname, display_name FROM users WHERE id IN ({ids})",
+}
+
+def stats_period_args():
+    """Общие параметры /admin/api/stats: kind, bucket и число корзин (из days)"""
+    kind = request.args.get('kind', 'track')
+    bucket = request.args.get('bucket', 'day')
+    days = request.args.get('days', 30, type=int)
+    if kind not in playstats.KINDS or bucket not in playstats.BUCKETS or days < 1:
+        return None
+    points = days * 24 if bucket == 'hour' else days
+    return kind, bucket, min(points, playstats.MAX_POINTS[bucket])
+
+def bucket_iso(ts):
+    return datetime.fromtimestamp(ts, timezone.utc).isoformat()
+
+@app.route('/admin/api/stats', methods=['GET'])
+@admin_required
+def admin_stats():
+    """
+    Прослушивания по часам/дням из агрегатов (админ):
+    ?kind=track|album|artist&id=<id>&bucket=hour|day&days=30; без id - сумма по всем
+    """
+    args = stats_period_args()
+    if not args:
+        return jsonify({'error': 'Invalid parameters'}), 400
+    kind, bucket, points = args
+    item_id = request.args.get('id', type=int)
+    
+    conn = get_db()
+    c = conn.cursor()
+    data = playstats.series(c, kind, bucket, points, item_id)
+    return jsonify({
+        'kind': kind,
+        'id': item_id,
+        'bucket': bucket,
+        'total': sum(plays for _, plays in data),
+        'points': [{'t': bucket_iso(ts), 'plays': plays} for ts, plays in data],
+    })
+
+@app.route('/admin/api/stats/top', methods=['GET'])
+@admin_required
+def admin_stats_top():
+    """Самые прослушиваемые треки/альбомы/исполнители за период (админ): ?kind=&bucket=&days=7&limit=20"""
+    args = stats_period_args()
+    if not args:
+        return jsonify({'error': 'Invalid parameters'}), 400
+    kind, bucket, points = args
+    limit = max(1, min(request.args.get('limit', 20, type=int), 100))
+    
+    conn = get_db()
+    c = conn.cursor()
+    rows = playstats.top(c, kind, bucket, points, limit)
+    names = {}
+    if rows:
+        ids = [item_id for item_id, _ in rows]
+        c.execute(STATS_NAMES_SQL[kind].format(ids=','.join('?' * len(ids))), ids)
+        names = {row['id']: dict(row) for row in c.fetchall()}
+    items = [dict(names.get(item_id, {'id': item_id}), plays=plays) for item_id, plays in rows]
+    return jsonify({'kind': kind, 'bucket': bucket, 'items': items})
+
+@app.route('/admin/api/transcode-stats', methods=['GET'])
+@admin_required
+def admin_transcode_stats():
+    """Состояние перекодирования и число готовых версий по качеству (админ)"""
+    c = get_db().cursor()
+    c.execute("SELECT quality, COUNT(*), COALESCE(SUM(size), 0) FROM audio_renditions GROUP BY quality")
+    renditions = {row[0]: {'count': row[1], 'bytes': row[2]} for row in c.fetchall()}
+    c.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM hls_playlists")
+    row = c.fetchone()
+    renditions[transcode.HLS_FOLDER] = {'count': row[0], 'bytes': row[1]}
+    c.execute("SELECT COUNT(*), COALESCE(SUM(attempts > 0), 0), COALESCE(SUM(attempts >= ?), 0) FROM transcode_jobs",
+              (transcode.MAX_ATTEMPTS,))
+    pending, failed, abandoned = c.fetchone()
+    return jsonify({**transcoder.stats(), 'renditions': renditions,
+                    'pending_jobs': pending, 'failed_jobs': failed, 'abandoned_jobs': abandoned})
+
+@app.route('/admin/api/similarity-stats', methods=['GET'])
+@admin_required
+def admin_similarity_stats():
+    """Состояние индекса похожих треков (админ)"""
+    return jsonify(similarity_index.stats())
+
+@app.route('/admin/api/play-rollup-stats', methods=['GET'])
+@admin_required
+def admin_play_rollup_stats():
+    """Состояние фонового сворачивания журнала прослушиваний (админ)"""
+    return jsonify(play_rollup.stats())
+
+@app.route('/admin/api/counter-stats', methods=['GET'])
+@admin_required
+def admin_counter_stats():
+    """Статистика сверки счетчиков и последние исправления (админ)"""
+    return jsonify(counter_reconciler.stats())
+
+@app.route('/admin/api/counters/reconcile', methods=['POST'])
+@admin_required
+def admin_reconcile_counters():
+    """Запустить сверку счетчиков сейчас; отчет об исправленных строках (админ)"""
+    return jsonify(counter_reconciler.run_once())
+
 @app.route('/admin/api/users', methods=['GET'])
 @admin_required
 def admin_get_users():
     """Получить всех пользователей для админки"""
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     c = conn.cursor()
     c.execute("""SELECT * FROM users ORDER BY created_at DESC""")
     users = [dict(row) for row in c.fetchall()]
-    conn.close()
     return jsonify(users)
 
 @app.route('/admin/api/albums/<int:album_id>', methods=['DELETE'])
 @admin_required
 def admin_delete_album(album_id):
     """Удалить альбом (админ)"""
-    conn = sqlite3.connect(DB_FILE)
+    conn = get_db()
     c = conn.cursor()
     c.execute("SELECT cover_filename FROM albums WHERE id = ?", (album_id,))
     album = c.fetchone()
     
     if not album:
-        conn.close()
         return jsonify({'error': 'Album not found'}), 404
     
-    # Удаляем обложку если есть
-    if album[0] and os.path.exists(os.path.join(app.config['UPLOAD_FOLDER'], album[0])):
-        os.remove(os.path.join(app.config['UPLOAD_FOLDER'], album[0]))
-    
     c.execute("DELETE FROM albums WHERE id = ?", (album_id,))
+    # Удаляем обложку, если на нее больше никто не ссылается
+    blobstore.release_blob(c, blob_store, album[0])
     conn.commit()
-    conn.close()
     return jsonify({'success': True})
 
 @app.route('/admin/api/tracks/<int:track_id>/toggle-visibility', methods=['POST'])
 @admin_required
 def admin_toggle_track_visibility(track_id):
     """Скрыть/показать трек (админ)"""
-    conn = sqlite3.connect(DB_FILE)
+    conn = get_db()
     c = conn.cursor()
     data = request.get_json() or {}
     hidden = 1 if data.get('hidden') else 0
-    c.execute("UPDATE tracks SET hidden = ? WHERE id = ?", (hidden, track_id))
+    c.execute("UPDATE tracks SET hidden = ?, updated_at = datetime('now') WHERE id = ?", (hidden, track_id))
     conn.commit()
-    conn.close()
     return jsonify({'success': True})
 
 @app.route('/admin/api/tracks/<int:track_id>', methods=['DELETE'])
 @admin_required
 def admin_delete_track(track_id):
     """Удалить трек (админ)"""
-    conn = sqlite3.connect(DB_FILE)
+    conn = get_db()
     c = conn.cursor()
     c.execute("SELECT filename, cover_filename FROM tracks WHERE id = ?", (track_id,))
     track = c.fetchone()
     
     if not track:
-        conn.close()
         return jsonify({'error': 'Track not found'}), 404
     
-    # Удаляем файлы
-    if track[0] and os.path.exists(os.path.join(app.config['UPLOAD_FOLDER'], track[0])):
-        os.remove(os.path.join(app.config['UPLOAD_FOLDER'], track[0]))
-    if track[1] and os.path.exists(os.path.join(app.config['UPLOAD_FOLDER'], track[1])):
-        os.remove(os.path.join(app.config['UPLOAD_FOLDER'], track[1]))
-    
     c.execute("DELETE FROM tracks WHERE id = ?", (track_id,))
+    c.execute("DELETE FROM lyrics_timelines WHERE track_id = ?", (track_id,))
+    # Файлы удаляются, только если на них больше никто не ссылается
+    blobstore.release_blob(c, blob_store, track[0])
+    blobstore.release_blob(c, blob_store, track[1])
     conn.commit()
-    conn.close()
     return jsonify({'success': True})
 
 @app.route('/api/tracks/<int:track_id>/pin', methods=['POST'])
 @admin_required
 def toggle_track_pin(track_id):
     """Закрепить/открепить трек (админ)"""
-    conn = sqlite3.connect(DB_FILE)
+    conn = get_db()
     c = conn.cursor()
     data = request.get_json() or {}
     is_pinned = 1 if data.get('is_pinned') else 0
     
     c.execute("UPDATE tracks SET is_pinned = ? WHERE id = ?", (is_pinned, track_id))
     conn.commit()
-    conn.close()
     return jsonify({'success': True, 'is_pinned': bool(is_pinned)})
 
 @app.route('/api/albums/<int:album_id>/pin', methods=['POST'])
 @admin_required
 def toggle_album_pin(album_id):
     """Закрепить/открепить альбом (админ)"""
-    conn = sqlite3.connect(DB_FILE)
+    conn = get_db()
     c = conn.cursor()
     data = request.get_json() or {}
     is_pinned = 1 if data.get('is_pinned') else 0
     
     c.execute("UPDATE albums SET is_pinned = ? WHERE id = ?", (is_pinned, album_id))
     conn.commit()
-    conn.close()
     return jsonify({'success': True, 'is_pinned': bool(is_pinned)})
 
+# Версии аудио (?quality=) для стриминга
+@app.after_request
+def request_client_hints(response):
+    """Просим браузер присылать ECT/Downlink - по ним ?quality=auto выбирает версию аудио"""
+    if response.mimetype == 'text/html':
+        response.headers.setdefault('Accept-CH', ', '.join(transcode.CLIENT_HINTS))
+    return response
+
+def requested_quality():
+    """Ступень лестницы для ?quality= (original|low|medium|high|auto) или None - оригинал"""
+    quality = request.args.get('quality')
+    if quality not in transcode.QUALITIES or quality == 'original':
+        return None
+    if quality == 'auto':
+        quality = transcode.auto_quality(request.headers)
+    return quality
+
+def select_rendition(filename):
+    """Версия аудио для ?quality= или None - оригинал"""
+    quality = requested_quality()
+    return transcode.choose_rendition(get_db().cursor(), filename, quality) if quality else None
+
 # Статические файлы
-@app.route('/uploads/<filename>')
+@app.route('/uploads/<path:filename>')
 def uploaded_file(filename):
-    """Отдача загруженных файлов"""
+    """Отдача загруженных файлов (Range, ETag, кэширование, X-Accel/X-Sendfile)"""
     try:
-        upload_folder = app.config['UPLOAD_FOLDER']
-        file_path = os.path.join(upload_folder, filename)
-        
-        # Проверяем существование файла
-        if not os.path.exists(file_path):
-            print(f"File not found: {file_path}")
+        rendition = select_rendition(filename) if 'quality' in request.args else None
+        response = None
+        if rendition:
+            response = streaming.send_upload(RENDITIONS_FOLDER, rendition)
+        if response is None:
+            response = streaming.send_upload(app.config['UPLOAD_FOLDER'], filename,
+                                             offload=UPLOADS_OFFLOAD, accel_prefix=UPLOADS_ACCEL_PREFIX)
+        if response is None:
+            print(f"File not found: {filename}")
             return "File not found", 404
         
-        # Определяем MIME тип
-        mime_type = None
-        if filename.lower().endswith(('.jpg', '.jpeg')):
-            mime_type = 'image/jpeg'
-        elif filename.lower().endswith('.png'):
-            mime_type = 'image/png'
-        elif filename.lower().endswith('.mp3'):
-            mime_type = 'audio/mpeg'
-        elif filename.lower().endswith('.wav'):
-            mime_type = 'audio/wav'
-        elif filename.lower().endswith('.ogg'):
-            mime_type = 'audio/ogg'
-        
-        response = send_from_directory(upload_folder, filename)
-        if mime_type:
-            response.headers['Content-Type'] = mime_type
-        
         # CORS headers
         response.headers['Access-Control-Allow-Origin'] = '*'
         response.headers['Access-Control-Allow-Methods'] = 'GET, OPTIONS'
-        response.headers['Access-Control-Allow-Headers'] = 'Content-Type'
+        response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Range'
+        response.headers['Access-Control-Expose-Headers'] = 'Content-Length, Content-Range, Accept-Ranges, ETag'
+        if request.args.get('quality', 'original') != 'original':
+            # Выбор версии меняется, когда перекодирование догонит загрузку
+            response.headers['Cache-Control'] = streaming.DEFAULT_CACHE_CONTROL
+            if request.args.get('quality') == 'auto':
+                response.vary.update(transcode.CLIENT_HINTS)
         
         return response
     except Exception as e:
@@ -1790,6 +2874,15 @@ def uploaded_file(filename):
         traceback.print_exc()
         return f"Error serving file: {str(e)}", 500
 
+@app.route('/hls/<path:filename>')
+def hls_file(filename):
+    """Плейлист и сегменты HLS длинных треков (/hls/<файл>/index.m3u8)"""
+    response = streaming.send_upload(os.path.join(RENDITIONS_FOLDER, transcode.HLS_FOLDER), filename)
+    if response is None:
+        return "File not found", 404
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    return response
+
 @app.route('/static/<path:filename>')
 def static_file(filename):
     return send_from_directory('static', filename)
@@ -1798,6 +2891,25 @@ def static_file(filename):
 def favicon():
     return '', 204
 
+@app.route('/thumbs/<int:size>/<path:filename>')
+def cover_thumbnail(size, filename):
+    """Миниатюра обложки; формат - ?format=webp|jpg или по Accept. Без Pillow - исходный файл"""
+    fmt = request.args.get('format')
+    if fmt not in thumbnails.FORMATS:
+        fmt = thumbnails.negotiate_format(request.headers.get('Accept'))
+    
+    thumb = thumb_cache.get(filename, thumbnails.snap_size(size), fmt)
+    if thumb:
+        response = streaming.send_upload(THUMB_CACHE_FOLDER, thumb)
+    else:
+        response = streaming.send_upload(app.config['UPLOAD_FOLDER'], filename)
+    if response is None:
+        return "File not found", 404
+    
+    response.vary.add('Accept')
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    return response
+
 @app.route('/api/extract-metadata', methods=['POST'])
 def extract_metadata():
     """Извлечь метаданные из аудио файла"""
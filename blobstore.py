@@ -0,0 +1,259 @@
+"""
+Контентно-адресуемое хранилище загрузок.
+
+Файл хэшируется (SHA-256) прямо во время приема и кладется в
+uploads/ab/cd/<sha256>.<ext>. Одинаковые MP3 и обложки от разных
+пользователей хранятся один раз, а таблица blobs считает ссылки:
+байты удаляются, только когда на них больше никто не ссылается.
+
+Порядок работы в роуте:
+    blob = store.ingest(file, ext)      # во временный файл + хэш
+    acquire_blob(c, store, blob)        # +1 ссылка и перенос на место
+    ...
+    release_blob(c, store, old_path)    # -1 ссылка (файл остается)
+    conn.commit()
+
+acquire/release выполняются внутри транзакции. release только уменьшает
+счетчик: если транзакция откатится, строки по-прежнему указывают на
+существующий файл. Файлы без ссылок удаляет сборщик (BlobCollector, collect)
+под блокировкой записи SQLite, поэтому удаление и повторная загрузка того же
+файла не могут разойтись. Он же удаляет файлы, перенесенные на место
+транзакцией, которая затем не прошла (строки blobs для них нет), - старше
+ORPHAN_GRACE, чтобы не задеть еще не закоммиченную загрузку.
+"""
+import hashlib
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+import db
+
+CHUNK_SIZE = 1024 * 1024
+TEMP_FOLDER = '.tmp'
+DEFAULT_SWEEP_INTERVAL = 600
+ORPHAN_GRACE = 3600
+
+
+def init_schema(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS blobs
+                 (path TEXT PRIMARY KEY,
+                  sha256 TEXT,
+                  size INTEGER,
+                  refcount INTEGER DEFAULT 0,
+                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+
+
+class PendingBlob:
+    """Принятый, но еще не размещенный файл"""
+
+    def __init__(self, temp_path, path, sha256, size):
+        self.temp_path = temp_path
+        self.path = path
+        self.sha256 = sha256
+        self.size = size
+
+
+class BlobStore:
+    def __init__(self, root):
+        self.root = root
+        self.temp_dir = os.path.join(root, TEMP_FOLDER)
+        os.makedirs(self.temp_dir, exist_ok=True)
+        # Вызываются с путем удаленного файла (например, чистка миниатюр)
+        self.on_remove = []
+
+    @staticmethod
+    def blob_path(sha256, ext):
+        """ab/cd/<sha256>.<ext> - относительный путь (он же хранится в БД)"""
+        ext = ext.lower().lstrip('.')
+        return f"{sha256[:2]}/{sha256[2:4]}/{sha256}.{ext}" if ext else f"{sha256[:2]}/{sha256[2:4]}/{sha256}"
+
+    def full_path(self, path):
+        return os.path.join(self.root, *path.split('/'))
+
+    def ingest(self, stream, ext):
+        """Записать поток во временный файл, считая SHA-256 по ходу"""
+        digest = hashlib.sha256()
+        size = 0
+        fd, temp_path = tempfile.mkstemp(dir=self.temp_dir)
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+                    digest.update(chunk)
+                    out.write(chunk)
+                    size += len(chunk)
+        except Exception:
+            os.remove(temp_path)
+            raise
+        sha256 = digest.hexdigest()
+        return PendingBlob(temp_path, self.blob_path(sha256, ext), sha256, size)
+
+    def ingest_bytes(self, data, ext):
+        """То же для данных в памяти (например, обложка из APIC)"""
+        sha256 = hashlib.sha256(data).hexdigest()
+        fd, temp_path = tempfile.mkstemp(dir=self.temp_dir)
+        with os.fdopen(fd, 'wb') as out:
+            out.write(data)
+        return PendingBlob(temp_path, self.blob_path(sha256, ext), sha256, len(data))
+
+    def place(self, blob):
+        """Перенести временный файл на место (атомарно, содержимое одинаковое)"""
+        target = self.full_path(blob.path)
+        if os.path.exists(target):
+            self.discard(blob)
+            return
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(blob.temp_path, target)
+        blob.temp_path = None
+
+    def discard(self, blob):
+        """Удалить временный файл, если он не понадобился"""
+        if blob and blob.temp_path and os.path.exists(blob.temp_path):
+            os.remove(blob.temp_path)
+        if blob:
+            blob.temp_path = None
+
+    def remove(self, path):
+        target = self.full_path(path)
+        if os.path.exists(target):
+            os.remove(target)
+        for callback in self.on_remove:
+            callback(path)
+
+
+def acquire_blob(c, store, blob):
+    """+1 ссылка на файл и размещение байтов; возвращает путь для БД"""
+    c.execute("""INSERT INTO blobs (path, sha256, size, refcount) VALUES (?, ?, ?, 1)
+                 ON CONFLICT(path) DO UPDATE SET refcount = refcount + 1""",
+              (blob.path, blob.sha256, blob.size))
+    store.place(blob)
+    return blob.path
+
+
+def release_blob(c, store, path):
+    """
+    -1 ссылка. Файл не трогается: когда ссылок не осталось, его удалит
+    сборщик после commit. Возвращает True, если ссылка была последней.
+    """
+    if not path:
+        return False
+    c.execute("UPDATE blobs SET refcount = refcount - 1 WHERE path = ?", (path,))
+    if c.rowcount == 0:
+        # Файл из старой плоской схемы uploads/ - у него единственный владелец
+        if '/' not in path:
+            c.execute("INSERT OR IGNORE INTO blobs (path, refcount) VALUES (?, 0)", (path,))
+            return True
+        return False
+
+    c.execute("SELECT refcount FROM blobs WHERE path = ?", (path,))
+    row = c.fetchone()
+    return bool(row and row[0] <= 0)
+
+
+def _orphan_candidates(store, grace):
+    """Файлы ab/cd/<sha256>.<ext> старше grace секунд (кандидаты в осиротевшие)"""
+    deadline = time.time() - grace
+    found = []
+    for first in os.listdir(store.root):
+        top = os.path.join(store.root, first)
+        if len(first) != 2 or first == TEMP_FOLDER or not os.path.isdir(top):
+            continue
+        for second in os.listdir(top):
+            folder = os.path.join(top, second)
+            if len(second) != 2 or not os.path.isdir(folder):
+                continue
+            for name in os.listdir(folder):
+                try:
+                    if os.path.getmtime(os.path.join(folder, name)) < deadline:
+                        found.append(f"{first}/{second}/{name}")
+                except OSError:
+                    pass
+    return found
+
+
+def collect(conn, store, orphan_grace=ORPHAN_GRACE):
+    """
+    Удалить файлы без ссылок (refcount <= 0) и осиротевшие файлы без строки
+    blobs. Возвращает число удаленных файлов.
+    """
+    c = conn.cursor()
+    # Обход диска - без блокировки; решение по каждому файлу - под ней
+    candidates = _orphan_candidates(store, orphan_grace) if orphan_grace is not None else []
+    removed = 0
+    c.execute("BEGIN IMMEDIATE")
+    try:
+        c.execute("SELECT path FROM blobs WHERE refcount <= 0")
+        paths = [row[0] for row in c.fetchall()]
+        orphans = []
+        for path in candidates:
+            c.execute("SELECT 1 FROM blobs WHERE path = ?", (path,))
+            if not c.fetchone():
+                orphans.append(path)
+        # acquire_blob того же файла ждет commit, поэтому не получит удаленный файл
+        for path in paths + orphans:
+            try:
+                store.remove(path)
+                removed += 1
+            except OSError as e:
+                print(f"Error deleting file {path}: {e}")
+        c.executemany("DELETE FROM blobs WHERE path = ?", [(path,) for path in paths])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return removed
+
+
+class BlobCollector:
+    """Фоновое удаление файлов без ссылок раз в interval секунд"""
+
+    def __init__(self, db_file, store, interval=DEFAULT_SWEEP_INTERVAL, orphan_grace=ORPHAN_GRACE):
+        self.db_file = db_file
+        self.store = store
+        self.interval = interval
+        self.orphan_grace = orphan_grace
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._stats = {'runs': 0, 'removed': 0, 'errors': 0, 'last_run_at': None}
+
+    def run_once(self):
+        conn = db.connect(self.db_file)
+        try:
+            removed = collect(conn, self.store, self.orphan_grace)
+        finally:
+            conn.close()
+        with self._lock:
+            self._stats['runs'] += 1
+            self._stats['removed'] += removed
+            self._stats['last_run_at'] = int(time.time())
+        return removed
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='blob-collector', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.run_once()
+            except (sqlite3.Error, OSError) as e:
+                print(f"Blob collector error: {e}")
+                with self._lock:
+                    self._stats['errors'] += 1
+
+    def stop(self, timeout=5):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout=timeout)
+            self._thread = None
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['interval'] = self.interval
+        return stats
@@ -0,0 +1,271 @@
+"""
+Сверка денормализованных счетчиков (likes_count, plays_count).
+
+Счетчики на tracks/albums меняются инкрементами в роутах и под
+конкурентной нагрузкой расходятся с таблицами likes/album_likes (или
+уходят в минус). Полный пересчет - тяжелый GROUP BY по всем лайкам, поэтому
+сверка инкрементальная:
+
+    counter_changes - журнал затронутых объектов: триггеры на likes и
+                      album_likes (и на отрицательные значения счетчиков)
+                      добавляют туда (kind, id);
+    обход           - медленный проход по всем трекам/альбомам пачками
+                      от сохраненной отметки last_id (counter_reconcile_state),
+                      чтобы найти расхождения, случившиеся до появления журнала.
+
+Каждая пачка - отдельная короткая транзакция, пересчитываются только ее
+объекты (по индексам на track_id/album_id), исправленные строки попадают в
+отчет. Запуск - фоновым потоком (CounterReconciler.start) или из консоли:
+
+    python counters.py [--db music.db] [--full] [--batch 500]
+
+likes_count пересчитывается точно. Для plays_count источника истины нет
+(анонимные прослушивания нигде не хранятся поштучно), поэтому счетчик
+трека только поднимается до суммы track_plays, а отрицательные и NULL
+значения сбрасываются в 0.
+"""
+import collections
+import sqlite3
+import threading
+import time
+
+import db
+
+DEFAULT_INTERVAL = 60
+DEFAULT_BATCH_SIZE = 500
+RECENT_CORRECTIONS = 50
+
+TRACK = 'track'
+ALBUM = 'album'
+
+# Тип объекта -> (таблица, SQL ожидаемых значений счетчиков для id IN (...))
+EXPECTED_SQL = {
+    TRACK: ('tracks', """SELECT t.id, t.likes_count, t.plays_count,
+                                (SELECT COUNT(*) FROM likes l WHERE l.track_id = t.id) AS expected_likes,
+                                MAX(COALESCE(t.plays_count, 0),
+                                    (SELECT COALESCE(SUM(tp.play_count), 0) FROM track_plays tp
+                                     WHERE tp.track_id = t.id)) AS expected_plays
+                         FROM tracks t WHERE t.id IN ({ids})"""),
+    ALBUM: ('albums', """SELECT a.id, a.likes_count, a.plays_count,
+                                (SELECT COUNT(*) FROM album_likes l WHERE l.album_id = a.id) AS expected_likes,
+                                MAX(COALESCE(a.plays_count, 0), 0) AS expected_plays
+                         FROM albums a WHERE a.id IN ({ids})"""),
+}
+
+
+def init_schema(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS counter_changes
+                 (kind TEXT,
+                  id INTEGER,
+                  PRIMARY KEY (kind, id))''')
+    c.execute('''CREATE TABLE IF NOT EXISTS counter_reconcile_state
+                 (kind TEXT PRIMARY KEY,
+                  last_id INTEGER DEFAULT 0,
+                  sweeps INTEGER DEFAULT 0)''')
+    # Пересчет одного объекта - по индексу, а не сканом таблицы лайков
+    c.execute("CREATE INDEX IF NOT EXISTS idx_likes_track_id ON likes(track_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_album_likes_album_id ON album_likes(album_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_track_plays_track_id ON track_plays(track_id)")
+
+    triggers = {
+        'cnt_likes_ai': f"AFTER INSERT ON likes BEGIN {_mark(TRACK, 'new.track_id')} END",
+        'cnt_likes_ad': f"AFTER DELETE ON likes BEGIN {_mark(TRACK, 'old.track_id')} END",
+        'cnt_album_likes_ai': f"AFTER INSERT ON album_likes BEGIN {_mark(ALBUM, 'new.album_id')} END",
+        'cnt_album_likes_ad': f"AFTER DELETE ON album_likes BEGIN {_mark(ALBUM, 'old.album_id')} END",
+        # Сверка сама пишет только неотрицательные значения - повторно строка не помечается
+        'cnt_tracks_negative': f"""AFTER UPDATE OF likes_count, plays_count ON tracks
+                                   WHEN new.likes_count < 0 OR new.plays_count < 0
+                                   BEGIN {_mark(TRACK, 'new.id')} END""",
+        'cnt_albums_negative': f"""AFTER UPDATE OF likes_count, plays_count ON albums
+                                   WHEN new.likes_count < 0 OR new.plays_count < 0
+                                   BEGIN {_mark(ALBUM, 'new.id')} END""",
+    }
+    for name, body in triggers.items():
+        c.execute(f"DROP TRIGGER IF EXISTS {name}")
+        c.execute(f"CREATE TRIGGER {name} {body}")
+
+
+def _mark(kind, id_expr):
+    return f"INSERT OR IGNORE INTO counter_changes (kind, id) VALUES ('{kind}', {id_expr});"
+
+
+def _fix_batch(c, kind, ids):
+    """Пересчитать счетчики объектов (внутри транзакции); возвращает список исправлений"""
+    table, expected_sql = EXPECTED_SQL[kind]
+    corrections = []
+    if not ids:
+        return corrections
+    c.execute(expected_sql.format(ids=','.join('?' * len(ids))), ids)
+    for row in c.fetchall():
+        for column, expected in (('likes_count', row['expected_likes']), ('plays_count', row['expected_plays'])):
+            if row[column] != expected:
+                corrections.append({'kind': kind, 'id': row['id'], 'column': column,
+                                    'old': row[column], 'new': expected})
+    for fix in corrections:
+        c.execute(f"UPDATE {table} SET {fix['column']} = ? WHERE id = ?", (fix['new'], fix['id']))
+    return corrections
+
+
+def reconcile_changes(conn, batch_size=DEFAULT_BATCH_SIZE):
+    """Разобрать журнал counter_changes пачками; возвращает (проверено, исправления)"""
+    checked = 0
+    corrections = []
+    c = conn.cursor()
+    for kind in EXPECTED_SQL:
+        while True:
+            c.execute("BEGIN IMMEDIATE")
+            try:
+                c.execute("SELECT id FROM counter_changes WHERE kind = ? ORDER BY id LIMIT ?", (kind, batch_size))
+                ids = [row[0] for row in c.fetchall()]
+                corrections.extend(_fix_batch(c, kind, ids))
+                c.executemany("DELETE FROM counter_changes WHERE kind = ? AND id = ?", [(kind, i) for i in ids])
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            checked += len(ids)
+            if len(ids) < batch_size:
+                break
+    return checked, corrections
+
+
+def sweep_step(conn, kind, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Проверить следующую пачку обхода от отметки last_id.
+    Возвращает (проверено, исправления, обход завершен).
+    """
+    table = EXPECTED_SQL[kind][0]
+    c = conn.cursor()
+    c.execute("BEGIN IMMEDIATE")
+    try:
+        c.execute("INSERT OR IGNORE INTO counter_reconcile_state (kind, last_id) VALUES (?, 0)", (kind,))
+        c.execute("SELECT last_id FROM counter_reconcile_state WHERE kind = ?", (kind,))
+        last_id = c.fetchone()[0]
+        c.execute(f"SELECT id FROM {table} WHERE id > ? ORDER BY id LIMIT ?", (last_id, batch_size))
+        ids = [row[0] for row in c.fetchall()]
+        corrections = _fix_batch(c, kind, ids)
+        finished = len(ids) < batch_size
+        if finished:
+            c.execute("UPDATE counter_reconcile_state SET last_id = 0, sweeps = sweeps + 1 WHERE kind = ?", (kind,))
+        else:
+            c.execute("UPDATE counter_reconcile_state SET last_id = ? WHERE kind = ?", (ids[-1], kind))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return len(ids), corrections, finished
+
+
+class CounterReconciler:
+    """Фоновая сверка: журнал изменений целиком плюс одна пачка обхода за проход"""
+
+    def __init__(self, db_file, interval=DEFAULT_INTERVAL, batch_size=DEFAULT_BATCH_SIZE):
+        self.db_file = db_file
+        self.interval = interval
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._recent = collections.deque(maxlen=RECENT_CORRECTIONS)
+        self._stats = {'runs': 0, 'checked': 0, 'corrected': 0, 'errors': 0, 'last_run_at': None}
+
+    def run_once(self, sweep=True):
+        """Один проход; возвращает отчет {'checked', 'corrected', 'corrections'}"""
+        conn = db.connect(self.db_file)
+        try:
+            checked, corrections = reconcile_changes(conn, self.batch_size)
+            if sweep:
+                for kind in EXPECTED_SQL:
+                    swept, fixed, _ = sweep_step(conn, kind, self.batch_size)
+                    checked += swept
+                    corrections.extend(fixed)
+        finally:
+            conn.close()
+
+        with self._lock:
+            self._stats['runs'] += 1
+            self._stats['checked'] += checked
+            self._stats['corrected'] += len(corrections)
+            self._stats['last_run_at'] = int(time.time())
+            self._recent.extend(corrections)
+        if corrections:
+            print(f"Counter reconciler corrected {len(corrections)} value(s)")
+        return {'checked': checked, 'corrected': len(corrections), 'corrections': corrections}
+
+    # === Фоновый поток ===
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='counter-reconciler', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.run_once()
+            except sqlite3.Error as e:
+                print(f"Counter reconciler error: {e}")
+                with self._lock:
+                    self._stats['errors'] += 1
+
+    def stop(self, timeout=5):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout=timeout)
+            self._thread = None
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['recent_corrections'] = list(self._recent)
+        stats['interval'] = self.interval
+        stats['batch_size'] = self.batch_size
+        return stats
+
+
+def reconcile_all(db_file, batch_size=DEFAULT_BATCH_SIZE):
+    """Полный обход всех треков и альбомов пачками (для консоли)"""
+    checked = 0
+    corrections = []
+    conn = db.connect(db_file)
+    try:
+        count, fixed = reconcile_changes(conn, batch_size)
+        checked += count
+        corrections.extend(fixed)
+        for kind in EXPECTED_SQL:
+            # Начинаем обход с начала, а не с сохраненной отметки
+            conn.execute("UPDATE counter_reconcile_state SET last_id = 0 WHERE kind = ?", (kind,))
+            conn.commit()
+            finished = False
+            while not finished:
+                count, fixed, finished = sweep_step(conn, kind, batch_size)
+                checked += count
+                corrections.extend(fixed)
+    finally:
+        conn.close()
+    return {'checked': checked, 'corrected': len(corrections), 'corrections': corrections}
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Сверка likes_count/plays_count с таблицами лайков и прослушиваний')
+    parser.add_argument('--db', default='music.db', help='файл базы данных')
+    parser.add_argument('--full', action='store_true', help='проверить все треки и альбомы, а не только журнал')
+    parser.add_argument('--batch', type=int, default=DEFAULT_BATCH_SIZE, help='размер пачки')
+    args = parser.parse_args()
+
+    setup = db.connect(args.db)
+    init_schema(setup)
+    setup.commit()
+    setup.close()
+
+    if args.full:
+        report = reconcile_all(args.db, args.batch)
+    else:
+        report = CounterReconciler(args.db, batch_size=args.batch).run_once(sweep=False)
+    for fix in report['corrections']:
+        print(f"{fix['kind']} {fix['id']}: {fix['column']} {fix['old']} -> {fix['new']}")
+    print(f"Checked {report['checked']}, corrected {report['corrected']}")
@@ -0,0 +1,111 @@
+"""
+Пул соединений SQLite для SwagPlayer.
+
+Вместо sqlite3.connect() в каждом роуте соединения берутся из общего пула
+и возвращаются в него в конце запроса. Каждое соединение один раз
+настраивается PRAGMA-ми (WAL, synchronous=NORMAL, mmap), поэтому писатели
+(count_play и т.п.) не блокируют читателей главной страницы.
+"""
+import queue
+import sqlite3
+import threading
+
+# Размер пула и PRAGMA для каждого нового соединения
+DEFAULT_POOL_SIZE = 8
+DEFAULT_STATEMENT_CACHE = 256
+DEFAULT_MMAP_SIZE = 256 * 1024 * 1024
+DEFAULT_BUSY_TIMEOUT = 5000
+
+
+def connect(db_file, statement_cache=DEFAULT_STATEMENT_CACHE, mmap_size=DEFAULT_MMAP_SIZE,
+            busy_timeout=DEFAULT_BUSY_TIMEOUT):
+    """Открыть и настроить новое соединение (WAL, NORMAL, mmap, кэш запросов)"""
+    conn = sqlite3.connect(db_file, check_same_thread=False,
+                           cached_statements=statement_cache,
+                           timeout=busy_timeout / 1000)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA mmap_size={int(mmap_size)}")
+    conn.execute(f"PRAGMA busy_timeout={int(busy_timeout)}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
+
+class ConnectionPool:
+    """Потокобезопасный пул соединений SQLite"""
+
+    def __init__(self, db_file, size=DEFAULT_POOL_SIZE, **connect_kwargs):
+        self.db_file = db_file
+        self.size = size
+        self.connect_kwargs = connect_kwargs
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._stats = {
+            'created': 0,
+            'reused': 0,
+            'released': 0,
+            'discarded': 0,
+            'in_use': 0,
+            'peak_in_use': 0,
+        }
+
+    def acquire(self):
+        """Взять соединение из пула (или открыть новое)"""
+        try:
+            conn = self._idle.get_nowait()
+            reused = True
+        except queue.Empty:
+            conn = connect(self.db_file, **self.connect_kwargs)
+            reused = False
+
+        with self._lock:
+            self._stats['reused' if reused else 'created'] += 1
+            self._stats['in_use'] += 1
+            self._stats['peak_in_use'] = max(self._stats['peak_in_use'], self._stats['in_use'])
+        return conn
+
+    def release(self, conn):
+        """Вернуть соединение в пул; незакоммиченная транзакция откатывается"""
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            self._discard(conn)
+            return
+
+        with self._lock:
+            self._stats['in_use'] -= 1
+            keep = self._idle.qsize() < self.size
+            self._stats['released' if keep else 'discarded'] += 1
+
+        if keep:
+            self._idle.put(conn)
+        else:
+            conn.close()
+
+    def _discard(self, conn):
+        with self._lock:
+            self._stats['in_use'] -= 1
+            self._stats['discarded'] += 1
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+    def close_all(self):
+        """Закрыть все простаивающие соединения"""
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+
+    def stats(self):
+        """Статистика пула для админки"""
+        with self._lock:
+            stats = dict(self._stats)
+        stats['idle'] = self._idle.qsize()
+        stats['size'] = self.size
+        return stats
@@ -0,0 +1,239 @@
+"""
+Счетчики поколений для инвалидации кэшей.
+
+Каждый кэш (снапшот главной и т.п.) привязан к именованному счетчику в
+таблице cache_generations. Счетчики увеличивают триггеры SQLite на
+изменениях, которые влияют на закэшированные данные, поэтому любой путь
+записи (роуты, админка, бот, другие процессы gunicorn) сбрасывает кэш без
+явных вызовов. Проверка актуальности - один SELECT по первичному ключу.
+
+Кроме общих счетчиков есть версии отдельных объектов (entity_versions):
+изменение трека увеличивает версию самого трека, его владельца и альбомов,
+где он лежит; изменение профиля - версии пользователя и всех его треков и
+альбомов. Так кэш страницы /track/<id> сбрасывается только при изменении
+именно этого трека (или его автора).
+
+JSON API (/api/tracks, /api/albums, /api/album/<id>) отдает строки целиком,
+updated_at и is_liked, поэтому для ETag у него свои счетчики: api_tracks/
+api_albums на списки (UPDATE любой колонки, кроме COUNTER_COLUMNS), версии
+api_track/api_album на отдельные объекты и версия likes на пользователя
+(его лайки треков и альбомов). Счетчики прослушиваний/лайков и рейтинг
+меняются на каждом прослушивании и сбросе буфера - от них ETag не зависит,
+в ответах они могут устареть (как в снапшоте главной; срок - в app.py).
+"""
+
+HOME_FEED = 'home_feed'
+API_TRACKS = 'api_tracks'
+API_ALBUMS = 'api_albums'
+
+# Поля автора, которые попадают в выдачу вместе с треками/альбомами
+USER_COLUMNS = ('nickname', 'display_name', 'avatar_url')
+
+# Колонки, которые часто меняются фоновыми записями и не сбрасывают кэши API
+COUNTER_COLUMNS = {
+    'tracks': ('plays_count', 'likes_count', 'trend_score'),
+    'albums': ('plays_count', 'likes_count', 'trend_score'),
+}
+
+# Счетчик -> [(таблица, колонки для UPDATE OF или None - любая колонка,
+# кроме COUNTER_COLUMNS)]; INSERT и DELETE учитываются всегда
+TRIGGERS = {
+    HOME_FEED: [
+        ('tracks', ('title', 'artist', 'lyrics', 'filename', 'cover_filename', 'hidden',
+                    'is_pinned', 'slug', 'status', 'duration')),
+        ('albums', ('title', 'description', 'cover_filename', 'hidden', 'is_pinned', 'slug')),
+        ('users', USER_COLUMNS),
+    ],
+    # API отдает t.* / a.* целиком, поэтому учитываются все колонки, кроме счетчиков
+    API_TRACKS: [
+        ('tracks', None),
+        ('users', USER_COLUMNS),
+    ],
+    API_ALBUMS: [
+        ('albums', None),
+        ('users', USER_COLUMNS),
+    ],
+}
+
+
+TRACK = 'track'
+ALBUM = 'album'
+USER = 'user'
+API_TRACK = 'api_track'
+API_ALBUM = 'api_album'
+LIKES = 'likes'
+
+# Колонки, от которых зависят публичные страницы объектов
+ENTITY_COLUMNS = {
+    'tracks': ('user_id', 'title', 'artist', 'lyrics', 'filename', 'cover_filename', 'hidden',
+               'is_pinned', 'slug', 'sort_order', 'status', 'duration'),
+    'albums': ('user_id', 'title', 'description', 'cover_filename', 'hidden', 'is_pinned', 'slug'),
+    'album_tracks': ('album_id', 'track_id', 'sort_order'),
+    'users': USER_COLUMNS,
+}
+
+# То же для версий объектов JSON API (None - любая колонка, кроме COUNTER_COLUMNS)
+API_ENTITY_COLUMNS = {
+    'tracks': None,
+    'albums': None,
+    'album_tracks': None,
+    'users': USER_COLUMNS,
+    'likes': None,
+    'album_likes': None,
+}
+
+
+def _bump_entity(kind, id_expr):
+    return (f"INSERT INTO entity_versions (kind, id, version) VALUES ('{kind}', {id_expr}, 1) "
+            f"ON CONFLICT(kind, id) DO UPDATE SET version = version + 1;")
+
+
+def _bump_entities(kind, select_sql):
+    # WHERE в SELECT обязателен - иначе ON CONFLICT парсится как часть JOIN
+    return (f"INSERT INTO entity_versions (kind, id, version) {select_sql} "
+            f"ON CONFLICT(kind, id) DO UPDATE SET version = version + 1;")
+
+
+def _entity_trigger_bodies(row):
+    """Что увеличивать при изменении строки (row - 'new' или 'old')"""
+    return {
+        'tracks': [
+            _bump_entity(TRACK, f'{row}.id'),
+            _bump_entity(USER, f'{row}.user_id'),
+            _bump_entities(ALBUM, f"SELECT '{ALBUM}', album_id, 1 FROM album_tracks WHERE track_id = {row}.id"),
+        ],
+        'albums': [
+            _bump_entity(ALBUM, f'{row}.id'),
+            _bump_entity(USER, f'{row}.user_id'),
+        ],
+        'album_tracks': [
+            _bump_entity(ALBUM, f'{row}.album_id'),
+        ],
+        'users': [
+            _bump_entity(USER, f'{row}.id'),
+            _bump_entities(TRACK, f"SELECT '{TRACK}', id, 1 FROM tracks WHERE user_id = {row}.id"),
+            _bump_entities(ALBUM, f"SELECT '{ALBUM}', id, 1 FROM albums WHERE user_id = {row}.id"),
+        ],
+    }
+
+
+def _api_trigger_bodies(row):
+    """Версии объектов JSON API: трек входит в выдачу своих альбомов, автор - в выдачу своих треков"""
+    return {
+        'tracks': [
+            _bump_entity(API_TRACK, f'{row}.id'),
+            _bump_entities(API_ALBUM, f"SELECT '{API_ALBUM}', album_id, 1 FROM album_tracks WHERE track_id = {row}.id"),
+        ],
+        'albums': [
+            _bump_entity(API_ALBUM, f'{row}.id'),
+        ],
+        'album_tracks': [
+            _bump_entity(API_ALBUM, f'{row}.album_id'),
+        ],
+        'users': [
+            _bump_entities(API_TRACK, f"SELECT '{API_TRACK}', id, 1 FROM tracks WHERE user_id = {row}.id"),
+            _bump_entities(API_ALBUM, f"SELECT '{API_ALBUM}', id, 1 FROM albums WHERE user_id = {row}.id"),
+            _bump_entities(API_ALBUM, f"""SELECT '{API_ALBUM}', at.album_id, 1 FROM album_tracks at
+                                          JOIN tracks t ON t.id = at.track_id WHERE t.user_id = {row}.id"""),
+        ],
+        'likes': [
+            _bump_entity(LIKES, f'{row}.user_id'),
+        ],
+        'album_likes': [
+            _bump_entity(LIKES, f'{row}.user_id'),
+        ],
+    }
+
+
+def _watched_columns(c, table, columns):
+    """None -> все колонки таблицы, кроме COUNTER_COLUMNS (None, если исключать нечего)"""
+    if columns is not None or table not in COUNTER_COLUMNS:
+        return columns
+    c.execute(f"PRAGMA table_info({table})")
+    return tuple(row[1] for row in c.fetchall() if row[1] not in COUNTER_COLUMNS[table])
+
+
+def _update_trigger(name, table, columns, body):
+    """AFTER UPDATE: по списку колонок с проверкой, что значение поменялось, или на любое UPDATE"""
+    if columns is None:
+        return f"CREATE TRIGGER {name} AFTER UPDATE ON {table} BEGIN {body} END"
+    # WHEN - только если значение действительно поменялось (логин перезаписывает avatar_url тем же)
+    changed = ' OR '.join(f"old.{col} IS NOT new.{col}" for col in columns)
+    return f"""CREATE TRIGGER {name} AFTER UPDATE OF {', '.join(columns)} ON {table}
+               WHEN {changed}
+               BEGIN {body} END"""
+
+
+def _create_entity_triggers(c, prefix, columns_map, bodies):
+    new_bodies = bodies('new')
+    old_bodies = bodies('old')
+    for table, columns in columns_map.items():
+        name = f"{prefix}_{table}"
+        for suffix in ('ai', 'ad', 'au'):
+            c.execute(f"DROP TRIGGER IF EXISTS {name}_{suffix}")
+        c.execute(f"CREATE TRIGGER {name}_ai AFTER INSERT ON {table} BEGIN {' '.join(new_bodies[table])} END")
+        c.execute(f"CREATE TRIGGER {name}_ad AFTER DELETE ON {table} BEGIN {' '.join(old_bodies[table])} END")
+        # При смене владельца/альбома версию получают и старый, и новый
+        c.execute(_update_trigger(f"{name}_au", table, _watched_columns(c, table, columns),
+                                  ' '.join(old_bodies[table] + new_bodies[table])))
+
+
+def init_schema(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS cache_generations
+                 (name TEXT PRIMARY KEY,
+                  generation INTEGER DEFAULT 0)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS entity_versions
+                 (kind TEXT,
+                  id INTEGER,
+                  version INTEGER DEFAULT 0,
+                  PRIMARY KEY (kind, id))''')
+    _create_entity_triggers(c, 'ver', ENTITY_COLUMNS, _entity_trigger_bodies)
+    _create_entity_triggers(c, 'apiver', API_ENTITY_COLUMNS, _api_trigger_bodies)
+    for name, tables in TRIGGERS.items():
+        c.execute("INSERT OR IGNORE INTO cache_generations (name, generation) VALUES (?, 0)", (name,))
+        bump_sql = f"UPDATE cache_generations SET generation = generation + 1 WHERE name = '{name}';"
+        for table, columns in tables:
+            prefix = f"gen_{name}_{table}"
+            # Пересоздаем при каждом запуске - список колонок мог измениться
+            for suffix in ('ai', 'ad', 'au'):
+                c.execute(f"DROP TRIGGER IF EXISTS {prefix}_{suffix}")
+            c.execute(f"CREATE TRIGGER {prefix}_ai AFTER INSERT ON {table} BEGIN {bump_sql} END")
+            c.execute(f"CREATE TRIGGER {prefix}_ad AFTER DELETE ON {table} BEGIN {bump_sql} END")
+            c.execute(_update_trigger(f"{prefix}_au", table, _watched_columns(c, table, columns), bump_sql))
+
+
+def get(c, name):
+    c.execute("SELECT generation FROM cache_generations WHERE name = ?", (name,))
+    row = c.fetchone()
+    return row[0] if row else 0
+
+
+def entity_version(c, kind, entity_id):
+    """Версия объекта (0 - объект еще ни разу не менялся)"""
+    c.execute("SELECT version FROM entity_versions WHERE kind = ? AND id = ?", (kind, entity_id))
+    row = c.fetchone()
+    return row[0] if row else 0
+
+
+def snapshot(c, names=(), entities=()):
+    """
+    Текущие значения нескольких счетчиков и версий одним запросом
+    (для ETag). entities - [(kind, id)].
+    """
+    parts = []
+    params = []
+    for name in names:
+        parts.append("SELECT COALESCE((SELECT generation FROM cache_generations WHERE name = ?), 0)")
+        params.append(name)
+    for kind, entity_id in entities:
+        parts.append("SELECT COALESCE((SELECT version FROM entity_versions WHERE kind = ? AND id = ?), 0)")
+        params.extend([kind, entity_id])
+    if not parts:
+        return ()
+    c.execute(' UNION ALL '.join(parts), params)
+    return tuple(row[0] for row in c.fetchall())
+
+
+def bump(c, name):
+    """Ручная инвалидация (для изменений, которые триггеры не видят)"""
+    c.execute("UPDATE cache_generations SET generation = generation + 1 WHERE name = ?", (name,))
@@ -0,0 +1,292 @@
+"""
+Фоновая обработка загруженных треков.
+
+upload_track только принимает файл (хэш по ходу записи), кладет его в
+хранилище и создает строку трека со статусом 'processing'. Разбор тегов,
+извлечение обложки из APIC и определение длительности выполняют рабочие
+потоки, поэтому время ответа не зависит от размера и формата файла.
+
+Там же считаются отпечаток, громкость с усилением и задержка кодера (analysis.py).
+
+Задания лежат в таблице ingest_jobs и удаляются в той же транзакции, что
+и запись результата, - после перезапуска недоделанные задания
+подхватываются заново (recover), повторная обработка ничего не ломает.
+"""
+import os
+import queue
+import threading
+
+try:
+    import mutagen
+    from mutagen.mp3 import MP3
+    from mutagen.id3 import ID3, ID3NoHeaderError
+    MUTAGEN_AVAILABLE = True
+except ImportError:
+    MUTAGEN_AVAILABLE = False
+
+import analysis
+import blobstore
+import db
+
+DEFAULT_WORKERS = 2
+ERROR_MAX_LENGTH = 200
+
+STATUS_PROCESSING = 'processing'
+STATUS_READY = 'ready'
+STATUS_FAILED = 'failed'
+
+
+def init_schema(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS ingest_jobs
+                 (track_id INTEGER PRIMARY KEY,
+                  fill_title INTEGER DEFAULT 0,
+                  fill_artist INTEGER DEFAULT 0,
+                  fill_cover INTEGER DEFAULT 0,
+                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+
+
+def add_job(c, track_id, fill_title=False, fill_artist=False, fill_cover=False):
+    """Поставить трек в очередь (в транзакции роута; после commit - IngestQueue.submit)"""
+    c.execute("""INSERT OR REPLACE INTO ingest_jobs (track_id, fill_title, fill_artist, fill_cover)
+                 VALUES (?, ?, ?, ?)""",
+              (track_id, int(bool(fill_title)), int(bool(fill_artist)), int(bool(fill_cover))))
+
+
+def _find_apic(tags):
+    if 'APIC:' in tags:
+        return tags['APIC:']
+    if 'APIC' in tags:
+        return tags['APIC']
+    for key in tags.keys():
+        if key.startswith('APIC'):
+            return tags[key]
+    return None
+
+
+def _cover_ext(mime):
+    mime = (mime or '').lower()
+    if 'png' in mime:
+        return 'png'
+    if 'gif' in mime:
+        return 'gif'
+    if 'webp' in mime:
+        return 'webp'
+    return 'jpg'
+
+
+def read_audio_metadata(path):
+    """
+    Теги и длительность файла.
+
+    Возвращает dict: title, artist, duration (сек или None),
+    sample_rate (Гц), bitrate (кбит/с), cover_data/cover_ext (обложка из APIC, только для MP3).
+    """
+    meta = {'title': '', 'artist': '', 'duration': None, 'sample_rate': None, 'bitrate': None,
+            'cover_data': None, 'cover_ext': None}
+    if not MUTAGEN_AVAILABLE:
+        return meta
+
+    try:
+        audio = mutagen.File(path)
+        if audio is not None and audio.info is not None:
+            if getattr(audio.info, 'length', None):
+                meta['duration'] = round(float(audio.info.length), 3)
+            meta['sample_rate'] = getattr(audio.info, 'sample_rate', None) or None
+            bitrate = getattr(audio.info, 'bitrate', None)
+            meta['bitrate'] = bitrate // 1000 if bitrate else None
+    except Exception as e:
+        print(f"Error probing duration of {path}: {e}")
+
+    if not path.lower().endswith('.mp3'):
+        return meta
+
+    try:
+        try:
+            audio = MP3(path, ID3=ID3)
+        except ID3NoHeaderError:
+            audio = MP3(path)
+    except Exception as e:
+        print(f"Error reading tags of {path}: {e}")
+        return meta
+
+    if audio.tags:
+        if 'TIT2' in audio.tags:
+            meta['title'] = str(audio.tags['TIT2'][0])
+        if 'TPE1' in audio.tags:
+            meta['artist'] = str(audio.tags['TPE1'][0])
+
+        apic = _find_apic(audio.tags)
+        if isinstance(apic, list):
+            apic = apic[0] if apic else None
+        if apic is not None and getattr(apic, 'data', None):
+            meta['cover_data'] = apic.data
+            meta['cover_ext'] = _cover_ext(getattr(apic, 'mime', 'image/jpeg'))
+    return meta
+
+
+class IngestQueue:
+    """Очередь обработки загрузок с пулом рабочих потоков"""
+
+    def __init__(self, db_file, store, workers=DEFAULT_WORKERS, thumbnails=None, ffmpeg=None):
+        self.db_file = db_file
+        self.store = store
+        self.workers = workers
+        self.thumbnails = thumbnails
+        # Декодер для отпечатка и громкости (analysis.py); без него - только WAV
+        self.ffmpeg = ffmpeg
+        self._queue = queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+        self._stats = {'submitted': 0, 'processed': 0, 'failed': 0, 'in_progress': 0}
+
+    def submit(self, track_id):
+        with self._lock:
+            self._stats['submitted'] += 1
+        self._queue.put(track_id)
+
+    def recover(self):
+        """Поставить в очередь задания, не доделанные до перезапуска"""
+        conn = db.connect(self.db_file)
+        try:
+            track_ids = [row[0] for row in conn.execute("SELECT track_id FROM ingest_jobs ORDER BY created_at")]
+        finally:
+            conn.close()
+        for track_id in track_ids:
+            self.submit(track_id)
+        return len(track_ids)
+
+    # === Рабочие потоки ===
+
+    def start(self):
+        if self._threads:
+            return
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f'ingest-worker-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _run(self):
+        while True:
+            track_id = self._queue.get()
+            if track_id is None:
+                break
+            with self._lock:
+                self._stats['in_progress'] += 1
+            try:
+                self.process(track_id)
+                outcome = 'processed'
+            except Exception as e:
+                print(f"Error ingesting track {track_id}: {e}")
+                self._mark_failed(track_id, e)
+                outcome = 'failed'
+            with self._lock:
+                self._stats['in_progress'] -= 1
+                self._stats[outcome] += 1
+
+    def stop(self, timeout=5):
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join(timeout=timeout)
+        self._threads = []
+
+    # === Обработка одного трека ===
+
+    def process(self, track_id):
+        conn = db.connect(self.db_file)
+        try:
+            c = conn.cursor()
+            c.execute("SELECT * FROM ingest_jobs WHERE track_id = ?", (track_id,))
+            job = c.fetchone()
+            c.execute("SELECT filename FROM tracks WHERE id = ?", (track_id,))
+            track = c.fetchone()
+            if not job or not track:
+                # Уже обработан другим процессом или трек удален
+                c.execute("DELETE FROM ingest_jobs WHERE track_id = ?", (track_id,))
+                conn.commit()
+                return
+
+            # Медленная часть - вне транзакции
+            path = self.store.full_path(track['filename'])
+            meta = read_audio_metadata(path)
+            known = analysis.load(c, track['filename'])
+            if known is not None:
+                # Тот же файл уже анализировался (дубликат загрузки)
+                for key in ('loudness', 'peak', 'encoder_delay', 'encoder_padding', 'fingerprint'):
+                    meta[key] = known[key]
+            else:
+                try:
+                    meta.update(analysis.analyze(path, self.ffmpeg))
+                except Exception as e:
+                    print(f"Error analyzing {path}: {e}")
+                    meta.update(loudness=None, peak=None, fingerprint=None)
+                    meta['encoder_delay'], meta['encoder_padding'] = analysis.gapless(path)
+            cover_blob = None
+            cover_path = None
+            if job['fill_cover'] and meta['cover_data']:
+                cover_blob = self.store.ingest_bytes(meta['cover_data'], meta['cover_ext'])
+
+            try:
+                c.execute("BEGIN IMMEDIATE")
+                c.execute("SELECT 1 FROM ingest_jobs WHERE track_id = ?", (track_id,))
+                if not c.fetchone():
+                    conn.rollback()
+                    return
+                c.execute("SELECT filename, cover_filename FROM tracks WHERE id = ?", (track_id,))
+                current = c.fetchone()
+                if not current:
+                    c.execute("DELETE FROM ingest_jobs WHERE track_id = ?", (track_id,))
+                    conn.commit()
+                    return
+                if current['filename'] != track['filename']:
+                    # Аудио заменено во время разбора - задание обработает следующий проход
+                    conn.rollback()
+                    return
+
+                sets = ["status = ?", "duration = ?", "sample_rate = ?", "bitrate = ?", "loudness = ?",
+                        "gain = ?", "peak = ?", "encoder_delay = ?", "encoder_padding = ?",
+                        "ingest_error = NULL", "updated_at = datetime('now')"]
+                params = [STATUS_READY, meta['duration'], meta['sample_rate'], meta['bitrate'], meta['loudness'],
+                          analysis.replay_gain(meta['loudness'], meta['peak']), meta['peak'],
+                          meta['encoder_delay'], meta['encoder_padding']]
+                if job['fill_title'] and meta['title']:
+                    sets.append("title = ?")
+                    params.append(meta['title'])
+                if job['fill_artist'] and meta['artist']:
+                    sets.append("artist = ?")
+                    params.append(meta['artist'])
+                if cover_blob and not current['cover_filename']:
+                    cover_path = blobstore.acquire_blob(c, self.store, cover_blob)
+                    sets.append("cover_filename = ?")
+                    params.append(cover_path)
+                c.execute(f"UPDATE tracks SET {', '.join(sets)} WHERE id = ?", params + [track_id])
+                if known is None:
+                    analysis.save(c, track['filename'], meta)
+                c.execute("DELETE FROM ingest_jobs WHERE track_id = ?", (track_id,))
+                conn.commit()
+            finally:
+                self.store.discard(cover_blob)
+
+            if cover_path and self.thumbnails:
+                self.thumbnails.pregenerate(cover_path)
+        finally:
+            conn.close()
+
+    def _mark_failed(self, track_id, error):
+        conn = db.connect(self.db_file)
+        try:
+            conn.execute("UPDATE tracks SET status = ?, ingest_error = ? WHERE id = ?",
+                         (STATUS_FAILED, str(error)[:ERROR_MAX_LENGTH], track_id))
+            conn.execute("DELETE FROM ingest_jobs WHERE track_id = ?", (track_id,))
+            conn.commit()
+        except Exception as e:
+            print(f"Error marking track {track_id} as failed: {e}")
+        finally:
+            conn.close()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['queued'] = self._queue.qsize()
+        stats['workers'] = len(self._threads)
+        return stats
@@ -0,0 +1,97 @@
+"""
+Разбор LRC-текстов на сервере.
+
+Текст трека парсится один раз при сохранении (upload_track / update_track),
+а клиенту отдается готовая временная шкала: отсортированный массив
+таймкодов в миллисекундах и параллельный массив строк. Плеер ищет
+активную строку бинарным поиском, не разбирая LRC заново.
+"""
+import hashlib
+import json
+import re
+
+TIMELINE_VERSION = 1
+
+# [mm:ss], [mm:ss.xx], [mm:ss:xx]
+TIMESTAMP_RE = re.compile(r'\[(\d{1,3}):(\d{1,2})(?:[.:](\d{1,3}))?\]')
+OFFSET_RE = re.compile(r'^\[offset:\s*([+-]?\d+)\s*\]$', re.IGNORECASE)
+
+
+def _timestamp_ms(minutes, seconds, fraction):
+    ms = (int(minutes) * 60 + int(seconds)) * 1000
+    if fraction:
+        # .5 -> 500, .05 -> 50, .005 -> 5
+        ms += int(fraction.ljust(3, '0')[:3])
+    return ms
+
+
+def lyrics_hash(text):
+    """Хэш исходного текста - чтобы понять, что шкала устарела"""
+    return hashlib.sha1((text or '').encode('utf-8')).hexdigest()
+
+
+def parse_lrc(text):
+    """
+    Разобрать LRC в временную шкалу.
+
+    Возвращает dict:
+        times - таймкоды строк в мс, по возрастанию
+        lines - текст строк (параллельно times)
+        gaps  - сколько пустых строк-отступов стоит перед каждой строкой
+        tail  - пустые строки после последней
+    Строки с несколькими таймкодами ([00:10][01:20]припев) повторяются
+    на каждом таймкоде. Метаданные ([ar:], [ti:] ...) пропускаются,
+    [offset:] применяется ко всем таймкодам.
+    """
+    entries = []
+    offset = 0
+    pending_gap = 0
+
+    for order, raw_line in enumerate((text or '').splitlines()):
+        line = raw_line.strip()
+        if not line:
+            pending_gap += 1
+            continue
+
+        offset_match = OFFSET_RE.match(line)
+        if offset_match:
+            offset = int(offset_match.group(1))
+            continue
+
+        stamps = []
+        pos = 0
+        while True:
+            match = TIMESTAMP_RE.match(line, pos)
+            if not match:
+                break
+            stamps.append(_timestamp_ms(*match.groups()))
+            pos = match.end()
+
+        if not stamps:
+            # Метаданные или строка без таймкода
+            continue
+
+        content = line[pos:].strip()
+        if not content:
+            # Пустая строка с таймкодом - отступ, как в плеере
+            pending_gap += 1
+            continue
+
+        for i, ms in enumerate(stamps):
+            entries.append((ms, order, content, pending_gap if i == 0 else 0))
+        pending_gap = 0
+
+    entries.sort(key=lambda e: (e[0], e[1]))
+    # offset в LRC: положительный - текст появляется раньше
+    return {
+        'version': TIMELINE_VERSION,
+        'times': [max(0, ms - offset) for ms, _, _, _ in entries],
+        'lines': [content for _, _, content, _ in entries],
+        'gaps': [gap for _, _, _, gap in entries],
+        'tail': pending_gap,
+    }
+
+
+def dump_timeline(timeline):
+    """Компактный JSON для хранения в БД"""
+    return json.dumps(timeline, ensure_ascii=False, separators=(',', ':'))
@@ -0,0 +1,100 @@
+"""
+Кэш отрисованных публичных страниц (/track, /album, /user).
+
+Ссылки на эти страницы расходятся по Telegram и соцсетям, и всплеск
+анонимных переходов превращался в тысячи одинаковых рендеров. Для
+анонимов готовый HTML хранится в памяти по ключу (страница, идентификатор)
+вместе с версией объекта из entity_versions. Запись считается актуальной,
+пока версия не изменилась и не истек TTL (счетчики прослушиваний и лайков
+на странице триггеры не отслеживают).
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_MAX_ENTRIES = 2000
+DEFAULT_TTL = 60
+
+
+class CachedPage:
+    def __init__(self, kind, entity_id, version, body):
+        self.kind = kind
+        self.entity_id = entity_id
+        self.version = version
+        self.body = body
+        self.etag = hashlib.sha1(body.encode('utf-8')).hexdigest()
+        self.created_at = time.monotonic()
+
+
+class PageCache:
+    """LRU-кэш страниц с проверкой версии объекта и TTL"""
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, ttl=DEFAULT_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'stale': 0, 'expired': 0, 'evicted': 0, 'not_modified': 0}
+
+    def get(self, key, current_version):
+        """
+        Страница из кэша или None.
+        current_version(kind, entity_id) -> текущая версия объекта из БД.
+        """
+        with self._lock:
+            page = self._entries.get(key)
+        if page is None:
+            self._count('misses')
+            return None
+
+        if time.monotonic() - page.created_at >= self.ttl:
+            self._drop(key, page, 'expired')
+            return None
+        if current_version(page.kind, page.entity_id) != page.version:
+            self._drop(key, page, 'stale')
+            return None
+
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+            self._stats['hits'] += 1
+        return page
+
+    def put(self, key, kind, entity_id, version, body):
+        page = CachedPage(kind, entity_id, version, body)
+        with self._lock:
+            self._entries[key] = page
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats['evicted'] += 1
+        return page
+
+    def _drop(self, key, page, reason):
+        with self._lock:
+            if self._entries.get(key) is page:
+                del self._entries[key]
+            self._stats[reason] += 1
+            self._stats['misses'] += 1
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def count_not_modified(self):
+        self._count('not_modified')
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = round(stats['hits'] / lookups, 3) if lookups else None
+        stats['max_entries'] = self.max_entries
+        stats['ttl'] = self.ttl
+        return stats
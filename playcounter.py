@@ -0,0 +1,337 @@
+"""
+Отложенная запись прослушиваний (write-behind).
+
+count_play и count_album_play больше не пишут в SQLite на каждый запрос:
+события копятся в памяти, суммируются по треку/альбому/пользователю и
+сбрасываются одной транзакцией раз в N мс или после M событий.
+
+Чтобы счетчики пережили падение процесса, каждое событие сначала
+дописывается в spill-файл. При сбросе файл ротируется, а id пачки
+записывается в play_flush_batches в той же транзакции, что и счетчики, -
+при восстановлении уже примененные пачки повторно не учитываются. Строки
+старше BATCH_RETENTION_DAYS удаляются после recover и раз в PRUNE_INTERVAL:
+spill-файлы так долго на диске не лежат.
+
+Кроме счетчиков каждая пачка дописывает сами события в журнал play_events
+(одним executemany в той же транзакции) - из него playstats строит
+почасовые и посуточные агрегаты - и добавляет их к рейтингу trending.
+"""
+import glob
+import json
+import os
+import threading
+import time
+import uuid
+
+try:
+    import fcntl
+except ImportError:  # Windows - без межпроцессной блокировки spill-файлов
+    fcntl = None
+
+import db
+import trending
+
+DEFAULT_FLUSH_INTERVAL_MS = 1000
+DEFAULT_FLUSH_MAX_EVENTS = 500
+BATCH_RETENTION_DAYS = 7
+PRUNE_INTERVAL = 3600
+
+
+def init_schema(c):
+    """Таблица примененных пачек (для идемпотентного восстановления)"""
+    c.execute('''CREATE TABLE IF NOT EXISTS play_flush_batches
+                 (batch_id TEXT PRIMARY KEY,
+                  events INTEGER,
+                  flushed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+    # Журнал прослушиваний (только добавление): kind - 'track' или 'album', played_at - unix-время
+    c.execute('''CREATE TABLE IF NOT EXISTS play_events
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  kind TEXT,
+                  item_id INTEGER,
+                  user_id INTEGER,
+                  played_at INTEGER)''')
+
+
+# Тип события в spill-файле -> kind в play_events
+EVENT_KINDS = {'t': 'track', 'a': 'album'}
+
+
+class PlayBatch:
+    """
+    Агрегированные прослушивания: трек -> n, альбом -> n, (юзер, трек) -> (n, время),
+    плюс сами события для журнала play_events.
+    """
+
+    def __init__(self):
+        self.tracks = {}
+        self.albums = {}
+        self.user_plays = {}
+        self.log = []
+        self.events = 0
+
+    def add(self, event):
+        """Учесть событие; возвращает накопленное число прослушиваний объекта"""
+        self.log.append((EVENT_KINDS[event['k']], event['id'], event.get('u'), event['ts']))
+        self.events += 1
+        if event['k'] == 'a':
+            self.albums[event['id']] = self.albums.get(event['id'], 0) + 1
+            return self.albums[event['id']]
+
+        track_id = event['id']
+        self.tracks[track_id] = self.tracks.get(track_id, 0) + 1
+        if event.get('u'):
+            key = (event['u'], track_id)
+            count, last_ts = self.user_plays.get(key, (0, 0))
+            self.user_plays[key] = (count + 1, max(last_ts, event['ts']))
+        return self.tracks[track_id]
+
+    def merge(self, other):
+        for track_id, n in other.tracks.items():
+            self.tracks[track_id] = self.tracks.get(track_id, 0) + n
+        for album_id, n in other.albums.items():
+            self.albums[album_id] = self.albums.get(album_id, 0) + n
+        for key, (n, last_ts) in other.user_plays.items():
+            count, ts = self.user_plays.get(key, (0, 0))
+            self.user_plays[key] = (count + n, max(ts, last_ts))
+        self.log.extend(other.log)
+        self.events += other.events
+
+
+class PlayCounter:
+    """Буфер прослушиваний с периодическим сбросом в БД"""
+
+    def __init__(self, db_file, spill_dir, flush_interval_ms=DEFAULT_FLUSH_INTERVAL_MS,
+                 flush_max_events=DEFAULT_FLUSH_MAX_EVENTS):
+        self.db_file = db_file
+        self.spill_dir = spill_dir
+        self.flush_interval = flush_interval_ms / 1000
+        self.flush_max_events = flush_max_events
+
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._spill = None
+        self._spill_path = None
+        self._pending = PlayBatch()
+        # Пачки, которые не удалось записать: (batch_id, batch, spill_path)
+        self._retry = []
+
+        self._last_prune = time.monotonic()
+
+        self._stats = {'events': 0, 'flushes': 0, 'flushed_events': 0, 'recovered_events': 0,
+                       'pruned_batches': 0, 'errors': 0}
+        os.makedirs(spill_dir, exist_ok=True)
+
+    # === Запись событий ===
+
+    def record_track_play(self, track_id, user_id=None):
+        """Учесть прослушивание трека; возвращает число еще не сброшенных прослушиваний"""
+        return self._record({'k': 't', 'id': track_id, 'u': user_id, 'ts': int(time.time())})
+
+    def record_album_play(self, album_id):
+        """Учесть прослушивание альбома; возвращает число еще не сброшенных прослушиваний"""
+        return self._record({'k': 'a', 'id': album_id, 'ts': int(time.time())})
+
+    def _record(self, event):
+        with self._lock:
+            self._write_spill(event)
+            pending = self._pending.add(event)
+            self._stats['events'] += 1
+            full = self._pending.events >= self.flush_max_events
+        if full:
+            self._wakeup.set()
+        return pending
+
+    def pending_track_plays(self, track_id):
+        with self._lock:
+            batches = [self._pending] + [batch for _, batch, _ in self._retry]
+            return sum(batch.tracks.get(track_id, 0) for batch in batches)
+
+    def pending_album_plays(self, album_id):
+        with self._lock:
+            batches = [self._pending] + [batch for _, batch, _ in self._retry]
+            return sum(batch.albums.get(album_id, 0) for batch in batches)
+
+    # === Spill-файл ===
+
+    def _open_spill(self):
+        self._spill_path = os.path.join(self.spill_dir, f"{uuid.uuid4().hex}.log")
+        self._spill = open(self._spill_path, 'a', encoding='utf-8')
+        if fcntl:
+            fcntl.flock(self._spill, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+    def _write_spill(self, event):
+        if self._spill is None:
+            self._open_spill()
+        self._spill.write(json.dumps(event, separators=(',', ':')) + '\n')
+        self._spill.flush()
+
+    def _rotate_spill(self):
+        """Забрать текущий spill-файл под сброс; новые события пойдут в новый файл"""
+        spill, path = self._spill, self._spill_path
+        self._spill = None
+        self._spill_path = None
+        return spill, path
+
+    # === Сброс в БД ===
+
+    def flush(self):
+        """Сбросить накопленные счетчики одной транзакцией на пачку"""
+        with self._flush_lock:
+            with self._lock:
+                pending = self._retry
+                self._retry = []
+                if self._pending.events:
+                    spill, spill_path = self._rotate_spill()
+                    if spill:
+                        spill.close()
+                    batch_id = os.path.basename(spill_path).rsplit('.', 1)[0] if spill_path else uuid.uuid4().hex
+                    pending.append((batch_id, self._pending, spill_path))
+                    self._pending = PlayBatch()
+
+            flushed = 0
+            for batch_id, batch, spill_path in pending:
+                try:
+                    self._write_batch(batch_id, batch)
+                except Exception as e:
+                    # Не получилось - повторим при следующем сбросе, spill-файл остается на диске
+                    print(f"Error flushing play counters: {e}")
+                    with self._lock:
+                        self._stats['errors'] += 1
+                        self._retry.append((batch_id, batch, spill_path))
+                    continue
+
+                if spill_path:
+                    try:
+                        os.remove(spill_path)
+                    except OSError:
+                        pass
+                flushed += batch.events
+
+            with self._lock:
+                if flushed:
+                    self._stats['flushes'] += 1
+                    self._stats['flushed_events'] += flushed
+            return flushed
+
+    def _write_batch(self, batch_id, batch):
+        conn = db.connect(self.db_file)
+        try:
+            c = conn.cursor()
+            c.execute("BEGIN IMMEDIATE")
+            c.execute("SELECT 1 FROM play_flush_batches WHERE batch_id = ?", (batch_id,))
+            if c.fetchone():
+                # Пачка уже применена (падение между commit и удалением spill-файла)
+                conn.rollback()
+                return
+            c.executemany("UPDATE tracks SET plays_count = COALESCE(plays_count, 0) + ? WHERE id = ?",
+                          [(n, track_id) for track_id, n in batch.tracks.items()])
+            c.executemany("UPDATE albums SET plays_count = COALESCE(plays_count, 0) + ? WHERE id = ?",
+                          [(n, album_id) for album_id, n in batch.albums.items()])
+            c.executemany("""INSERT INTO track_plays (user_id, track_id, play_count, last_played_at)
+                             VALUES (?, ?, ?, datetime(?, 'unixepoch'))
+                             ON CONFLICT(user_id, track_id) DO UPDATE SET
+                             play_count = play_count + excluded.play_count,
+                             last_played_at = MAX(last_played_at, excluded.last_played_at)""",
+                          [(user_id, track_id, n, last_ts)
+                           for (user_id, track_id), (n, last_ts) in batch.user_plays.items()])
+            c.executemany("INSERT INTO play_events (kind, item_id, user_id, played_at) VALUES (?, ?, ?, ?)",
+                          batch.log)
+            # Рейтинг "в тренде" - по времени каждого события
+            for kind, table in (('track', 'tracks'), ('album', 'albums')):
+                trending.apply_events(c, table, [(item_id, trending.PLAY_WEIGHT, ts)
+                                                 for event_kind, item_id, _, ts in batch.log if event_kind == kind])
+            c.execute("INSERT INTO play_flush_batches (batch_id, events) VALUES (?, ?)", (batch_id, batch.events))
+            conn.commit()
+        finally:
+            conn.close()
+
+    # === Восстановление после падения ===
+
+    def recover(self):
+        """Применить spill-файлы, оставшиеся от упавших процессов"""
+        recovered = 0
+        for path in sorted(glob.glob(os.path.join(self.spill_dir, '*.log'))):
+            if path == self._spill_path or path in {p for _, _, p in self._retry}:
+                continue
+            with open(path, 'r', encoding='utf-8') as f:
+                if fcntl:
+                    try:
+                        # Файл живого процесса заблокирован - не трогаем
+                        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except OSError:
+                        continue
+                batch = PlayBatch()
+                for line in f:
+                    try:
+                        batch.add(json.loads(line))
+                    except (ValueError, KeyError):
+                        # Недописанная последняя строка
+                        continue
+                try:
+                    if batch.events:
+                        self._write_batch(os.path.basename(path).rsplit('.', 1)[0], batch)
+                except Exception as e:
+                    print(f"Error recovering play counters from {path}: {e}")
+                    continue
+            os.remove(path)
+            recovered += batch.events
+
+        with self._lock:
+            self._stats['recovered_events'] += recovered
+        self.prune_batches()
+        return recovered
+
+    def prune_batches(self, retention_days=BATCH_RETENTION_DAYS):
+        """Удалить id пачек, spill-файлы которых уже не могут быть применены повторно"""
+        self._last_prune = time.monotonic()
+        conn = db.connect(self.db_file)
+        try:
+            c = conn.cursor()
+            c.execute("DELETE FROM play_flush_batches WHERE flushed_at < datetime('now', ?)",
+                      (f'-{int(retention_days)} days',))
+            pruned = c.rowcount
+            conn.commit()
+        finally:
+            conn.close()
+        with self._lock:
+            self._stats['pruned_batches'] += pruned
+        return pruned
+
+    # === Фоновый поток ===
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='play-counter-flush', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+                if time.monotonic() - self._last_prune >= PRUNE_INTERVAL:
+                    self.prune_batches()
+            except Exception as e:
+                print(f"Play counter flush loop error: {e}")
+
+    def stop(self):
+        """Остановить поток и сбросить остаток"""
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+        self.flush()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['pending_events'] = self._pending.events + sum(batch.events for _, batch, _ in self._retry)
+            stats['pending_tracks'] = len(self._pending.tracks)
+            stats['pending_albums'] = len(self._pending.albums)
+        return stats
@@ -0,0 +1,182 @@
+"""
+Почасовая и посуточная статистика прослушиваний.
+
+PlayCounter пишет каждое прослушивание в журнал play_events (пачками при
+сбросе). Журнал только растет, поэтому графики по нему не строятся:
+фоновый поток сворачивает новые события в play_rollups -
+
+    (bucket 'hour'/'day', kind 'track'/'album'/'artist', item_id, bucket_start) -> plays
+
+Обработанная часть журнала отмечается last_event_id (playstats_state) и
+сдвигается в той же транзакции, что и запись агрегатов, поэтому события не
+учитываются дважды. Исполнитель (artist) - владелец трека (tracks.user_id).
+Границы суток - по UTC. /admin/api/stats читает только play_rollups.
+"""
+import threading
+import time
+
+import db
+
+DEFAULT_INTERVAL = 60
+DEFAULT_BATCH_SIZE = 5000
+
+# Размер корзины в секундах и максимум корзин в одном ответе
+BUCKETS = {'hour': 3600, 'day': 86400}
+MAX_POINTS = {'hour': 24 * 31, 'day': 366}
+KINDS = ('track', 'album', 'artist')
+
+# kind агрегата -> SELECT из play_events (параметры: размер корзины дважды, границы id)
+ROLLUP_SOURCES = {
+    'track': """SELECT ?, 'track', item_id, (played_at / ?) * ? AS bucket_start, COUNT(*)
+                FROM play_events
+                WHERE id > ? AND id <= ? AND kind = 'track'
+                GROUP BY item_id, bucket_start""",
+    'album': """SELECT ?, 'album', item_id, (played_at / ?) * ? AS bucket_start, COUNT(*)
+                FROM play_events
+                WHERE id > ? AND id <= ? AND kind = 'album'
+                GROUP BY item_id, bucket_start""",
+    'artist': """SELECT ?, 'artist', t.user_id, (e.played_at / ?) * ? AS bucket_start, COUNT(*)
+                 FROM play_events e
+                 JOIN tracks t ON t.id = e.item_id
+                 WHERE e.id > ? AND e.id <= ? AND e.kind = 'track'
+                 GROUP BY t.user_id, bucket_start""",
+}
+
+
+def init_schema(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS play_rollups
+                 (bucket TEXT,
+                  kind TEXT,
+                  item_id INTEGER,
+                  bucket_start INTEGER,
+                  plays INTEGER DEFAULT 0,
+                  PRIMARY KEY (bucket, kind, item_id, bucket_start))''')
+    # Сумма по всем объектам и топ за период
+    c.execute("CREATE INDEX IF NOT EXISTS idx_play_rollups_period ON play_rollups(bucket, kind, bucket_start)")
+    c.execute('''CREATE TABLE IF NOT EXISTS playstats_state
+                 (name TEXT PRIMARY KEY,
+                  last_event_id INTEGER DEFAULT 0)''')
+    c.execute("INSERT OR IGNORE INTO playstats_state (name, last_event_id) VALUES ('rollup', 0)")
+
+
+def rollup_batch(conn, batch_size=DEFAULT_BATCH_SIZE):
+    """Свернуть следующую пачку событий; возвращает число обработанных событий"""
+    c = conn.cursor()
+    c.execute("BEGIN IMMEDIATE")
+    try:
+        c.execute("SELECT last_event_id FROM playstats_state WHERE name = 'rollup'")
+        last_id = c.fetchone()[0]
+        c.execute("""SELECT COUNT(*), MAX(id) FROM
+                     (SELECT id FROM play_events WHERE id > ? ORDER BY id LIMIT ?)""", (last_id, batch_size))
+        count, upper_id = c.fetchone()
+        if not count:
+            conn.rollback()
+            return 0
+        for bucket, size in BUCKETS.items():
+            for source in ROLLUP_SOURCES.values():
+                c.execute(f"""INSERT INTO play_rollups (bucket, kind, item_id, bucket_start, plays)
+                              {source}
+                              ON CONFLICT(bucket, kind, item_id, bucket_start)
+                              DO UPDATE SET plays = plays + excluded.plays""",
+                          (bucket, size, size, last_id, upper_id))
+        c.execute("UPDATE playstats_state SET last_event_id = ? WHERE name = 'rollup'", (upper_id,))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return count
+
+
+def period_start(bucket, points, now=None):
+    """Начало первой корзины периода из points корзин, заканчивающегося текущей"""
+    size = BUCKETS[bucket]
+    now = int(now if now is not None else time.time())
+    return (now // size - points + 1) * size
+
+
+def series(c, kind, bucket, points, item_id=None, now=None):
+    """
+    Прослушивания по корзинам: [(bucket_start, plays)] с нулями для пустых корзин.
+    Без item_id - сумма по всем объектам вида.
+    """
+    size = BUCKETS[bucket]
+    start = period_start(bucket, points, now)
+    if item_id is None:
+        c.execute("""SELECT bucket_start, SUM(plays) FROM play_rollups
+                     WHERE bucket = ? AND kind = ? AND bucket_start >= ?
+                     GROUP BY bucket_start""", (bucket, kind, start))
+    else:
+        c.execute("""SELECT bucket_start, plays FROM play_rollups
+                     WHERE bucket = ? AND kind = ? AND item_id = ? AND bucket_start >= ?""",
+                  (bucket, kind, item_id, start))
+    found = {row[0]: row[1] for row in c.fetchall()}
+    return [(start + i * size, found.get(start + i * size, 0)) for i in range(points)]
+
+
+def top(c, kind, bucket, points, limit, now=None):
+    """Самые прослушиваемые объекты за период: [(item_id, plays)]"""
+    c.execute("""SELECT item_id, SUM(plays) AS plays FROM play_rollups
+                 WHERE bucket = ? AND kind = ? AND bucket_start >= ?
+                 GROUP BY item_id
+                 ORDER BY plays DESC, item_id ASC
+                 LIMIT ?""", (bucket, kind, period_start(bucket, points, now), limit))
+    return [(row[0], row[1]) for row in c.fetchall()]
+
+
+class PlayRollup:
+    """Фоновое сворачивание журнала прослушиваний в агрегаты"""
+
+    def __init__(self, db_file, interval=DEFAULT_INTERVAL, batch_size=DEFAULT_BATCH_SIZE):
+        self.db_file = db_file
+        self.interval = interval
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._stats = {'runs': 0, 'events': 0, 'errors': 0, 'last_run_at': None}
+
+    def run_once(self):
+        """Свернуть все накопившиеся события; возвращает их число"""
+        conn = db.connect(self.db_file)
+        try:
+            total = 0
+            while True:
+                count = rollup_batch(conn, self.batch_size)
+                total += count
+                if count < self.batch_size:
+                    break
+        finally:
+            conn.close()
+        with self._lock:
+            self._stats['runs'] += 1
+            self._stats['events'] += total
+            self._stats['last_run_at'] = int(time.time())
+        return total
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='play-rollup', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f"Play rollup error: {e}")
+                with self._lock:
+                    self._stats['errors'] += 1
+
+    def stop(self, timeout=5):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout=timeout)
+            self._thread = None
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['interval'] = self.interval
+        return stats
@@ -0,0 +1,211 @@
+"""
+Похожие треки по совместным прослушиваниям и лайкам (item-to-item).
+
+Каждый трек - разреженный вектор по пользователям:
+
+    w(user, track) = log2(1 + play_count) + LIKE_WEIGHT (если лайкнут)
+
+Сходство двух треков - косинус между их векторами, умноженный на
+co / (co + SHRINK), где co - число общих слушателей (чтобы пара из одного
+случайного совпадения не обгоняла устойчивые). Скалярные произведения
+считаются обходом пользователей: каждый добавляет вклад только в пары
+своих треков, т.е. работа пропорциональна числу ненулевых элементов, а не
+квадрату каталога. У очень активных пользователей берутся MAX_USER_TRACKS
+треков с наибольшим весом.
+
+Для каждого трека хранится TOP_K соседей в track_similar
+(track_id, rank) -> (similar_id, score): запрос /api/tracks/<id>/similar -
+чтение по первичному ключу. Индекс пересобирается фоновым потоком, если
+лайки или прослушивания изменились, или из консоли:
+
+    python recommend.py [--db music.db]
+"""
+import heapq
+import math
+import threading
+import time
+
+import db
+
+DEFAULT_INTERVAL = 3600
+TOP_K = 20
+LIKE_WEIGHT = 2.0
+SHRINK = 3.0
+MAX_USER_TRACKS = 300
+
+
+def init_schema(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS track_similar
+                 (track_id INTEGER,
+                  rank INTEGER,
+                  similar_id INTEGER,
+                  score REAL,
+                  PRIMARY KEY (track_id, rank)) WITHOUT ROWID''')
+    c.execute('''CREATE TABLE IF NOT EXISTS recommend_state
+                 (name TEXT PRIMARY KEY,
+                  value TEXT)''')
+
+
+def data_signature(c):
+    """Отпечаток входных данных: индекс пересобирается, только если он изменился"""
+    c.execute("SELECT COUNT(*), COALESCE(MAX(id), 0) FROM likes")
+    likes = tuple(c.fetchone())
+    c.execute("SELECT COUNT(*), COALESCE(SUM(play_count), 0) FROM track_plays")
+    plays = tuple(c.fetchone())
+    return f"{likes[0]}:{likes[1]}:{plays[0]}:{plays[1]}"
+
+
+def load_vectors(c):
+    """Векторы пользователей: user_id -> {track_id: вес}"""
+    users = {}
+    c.execute("SELECT user_id, track_id, play_count FROM track_plays WHERE play_count > 0")
+    for user_id, track_id, play_count in c.fetchall():
+        users.setdefault(user_id, {})[track_id] = math.log2(1 + play_count)
+    c.execute("SELECT user_id, track_id FROM likes")
+    for user_id, track_id in c.fetchall():
+        items = users.setdefault(user_id, {})
+        items[track_id] = items.get(track_id, 0.0) + LIKE_WEIGHT
+    return users
+
+
+def compute_neighbours(users, top_k=TOP_K):
+    """Соседи каждого трека: track_id -> [(similar_id, score)] по убыванию score"""
+    norms = {}
+    dots = {}
+    common = {}
+    for items in users.values():
+        if len(items) > MAX_USER_TRACKS:
+            items = dict(heapq.nlargest(MAX_USER_TRACKS, items.items(), key=lambda kv: kv[1]))
+        entries = sorted(items.items())
+        for track_id, weight in entries:
+            norms[track_id] = norms.get(track_id, 0.0) + weight * weight
+        for pos, (a, wa) in enumerate(entries):
+            row_dots = dots.setdefault(a, {})
+            row_common = common.setdefault(a, {})
+            for b, wb in entries[pos + 1:]:
+                row_dots[b] = row_dots.get(b, 0.0) + wa * wb
+                row_common[b] = row_common.get(b, 0) + 1
+
+    # Пары хранятся один раз (a < b) - разворачиваем в обе стороны
+    scored = {}
+    for a, row in dots.items():
+        for b, dot in row.items():
+            co = common[a][b]
+            score = dot / math.sqrt(norms[a] * norms[b]) * (co / (co + SHRINK))
+            scored.setdefault(a, []).append((b, score))
+            scored.setdefault(b, []).append((a, score))
+    return {track_id: heapq.nlargest(top_k, pairs, key=lambda p: (p[1], -p[0]))
+            for track_id, pairs in scored.items()}
+
+
+def write_index(conn, neighbours, signature):
+    """Заменить индекс целиком одной транзакцией"""
+    c = conn.cursor()
+    c.execute("BEGIN IMMEDIATE")
+    try:
+        c.execute("DELETE FROM track_similar")
+        c.executemany("INSERT INTO track_similar (track_id, rank, similar_id, score) VALUES (?, ?, ?, ?)",
+                      [(track_id, rank, similar_id, round(score, 6))
+                       for track_id, pairs in neighbours.items()
+                       for rank, (similar_id, score) in enumerate(pairs)])
+        c.execute("INSERT OR REPLACE INTO recommend_state (name, value) VALUES ('signature', ?)", (signature,))
+        c.execute("INSERT OR REPLACE INTO recommend_state (name, value) VALUES ('built_at', ?)",
+                  (str(int(time.time())),))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+class SimilarityIndex:
+    """Периодическая пересборка индекса похожих треков"""
+
+    def __init__(self, db_file, interval=DEFAULT_INTERVAL, top_k=TOP_K):
+        self.db_file = db_file
+        self.interval = interval
+        self.top_k = top_k
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._stats = {'builds': 0, 'skipped': 0, 'errors': 0, 'tracks': 0, 'pairs': 0,
+                       'users': 0, 'last_build_seconds': None, 'last_build_at': None}
+
+    def rebuild(self, force=False):
+        """Пересобрать индекс; False - данные не менялись с прошлой сборки"""
+        conn = db.connect(self.db_file)
+        try:
+            c = conn.cursor()
+            signature = data_signature(c)
+            c.execute("SELECT value FROM recommend_state WHERE name = 'signature'")
+            row = c.fetchone()
+            if not force and row and row[0] == signature:
+                with self._lock:
+                    self._stats['skipped'] += 1
+                return False
+
+            started = time.monotonic()
+            users = load_vectors(c)
+            neighbours = compute_neighbours(users, self.top_k)
+            write_index(conn, neighbours, signature)
+        finally:
+            conn.close()
+
+        with self._lock:
+            self._stats['builds'] += 1
+            self._stats['users'] = len(users)
+            self._stats['tracks'] = len(neighbours)
+            self._stats['pairs'] = sum(len(pairs) for pairs in neighbours.values())
+            self._stats['last_build_seconds'] = round(time.monotonic() - started, 3)
+            self._stats['last_build_at'] = int(time.time())
+        return True
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='similarity-index', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        # Первая сборка сразу после запуска (если данные изменились)
+        while True:
+            try:
+                self.rebuild()
+            except Exception as e:
+                print(f"Similarity index rebuild error: {e}")
+                with self._lock:
+                    self._stats['errors'] += 1
+            if self._stopped.wait(self.interval):
+                break
+
+    def stop(self, timeout=5):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout=timeout)
+            self._thread = None
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['interval'] = self.interval
+        stats['top_k'] = self.top_k
+        return stats
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Пересборка индекса похожих треков')
+    parser.add_argument('--db', default='music.db', help='файл базы данных')
+    args = parser.parse_args()
+
+    setup = db.connect(args.db)
+    init_schema(setup)
+    setup.commit()
+    setup.close()
+
+    index = SimilarityIndex(args.db)
+    index.rebuild(force=True)
+    stats = index.stats()
+    print(f"Users {stats['users']}, tracks {stats['tracks']}, neighbour pairs {stats['pairs']}, "
+          f"{stats['last_build_seconds']}s")
@@ -0,0 +1,164 @@
+"""
+Возобновляемая загрузка файлов частями.
+
+POST /api/tracks принимает файл целиком одним запросом: на мобильной сети
+обрыв на 90% означает повторную передачу всего файла. Здесь загрузка идет
+сессиями:
+
+    POST /api/uploads             - завести сессии (имя и размер каждого файла)
+    PUT  /api/uploads/<id>        - дописать часть с заголовком Upload-Offset
+    GET  /api/uploads/<id>        - узнать, сколько байт уже принято (после обрыва)
+    POST /api/uploads/finalize    - создать треки из готовых файлов одной транзакцией
+
+Части пишутся сразу в файл uploads/.tmp/upload-<id>.part по смещению;
+принятое смещение хранится в upload_sessions.received и сдвигается только
+после записи. Запись, обрезка и сдвиг смещения идут под flock файла части.
+Часть с чужим смещением (или пока ту же сессию дописывает другой запрос -
+повтор после таймаута) отклоняется (409) - клиент перезапрашивает смещение
+и продолжает с него. При финализации файл
+хэшируется и становится обычным PendingBlob хранилища (os.replace в
+пределах одного каталога), т.е. дальше работает как загрузка через форму.
+Брошенные сессии удаляются через SESSION_TTL.
+"""
+import hashlib
+import os
+import time
+import uuid
+
+try:
+    import fcntl
+except ImportError:  # Windows - без flock, остается только условный UPDATE смещения
+    fcntl = None
+
+import blobstore
+
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024
+MAX_CHUNK_SIZE = 16 * 1024 * 1024
+MAX_FILE_SIZE = 512 * 1024 * 1024
+MAX_FILES = 200
+SESSION_TTL = 24 * 3600
+NAME_MAX_LENGTH = 255
+
+
+def init_schema(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS upload_sessions
+                 (id TEXT PRIMARY KEY,
+                  user_id INTEGER,
+                  name TEXT,
+                  ext TEXT,
+                  size INTEGER,
+                  received INTEGER DEFAULT 0,
+                  created_at INTEGER,
+                  updated_at INTEGER)''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_upload_sessions_updated ON upload_sessions(updated_at)")
+
+
+def part_path(store, upload_id):
+    return os.path.join(store.temp_dir, f"upload-{upload_id}.part")
+
+
+def create(c, store, user_id, name, ext, size):
+    """Новая сессия и пустой файл под нее; возвращает id"""
+    upload_id = uuid.uuid4().hex
+    now = int(time.time())
+    with open(part_path(store, upload_id), 'wb'):
+        pass
+    c.execute("""INSERT INTO upload_sessions (id, user_id, name, ext, size, received, created_at, updated_at)
+                 VALUES (?, ?, ?, ?, ?, 0, ?, ?)""",
+              (upload_id, user_id, name[:NAME_MAX_LENGTH], ext, size, now, now))
+    return upload_id
+
+
+def append(conn, store, upload, offset, stream, limit):
+    """
+    Дописать часть с позиции offset (она должна совпадать с принятым смещением).
+    Возвращает новое смещение или None, если смещение не совпало или ту же
+    сессию сейчас дописывает другой запрос.
+    """
+    if offset != upload['received']:
+        return None
+    path = part_path(store, upload['id'])
+    written = 0
+    with open(path, 'r+b') as out:
+        if fcntl:
+            try:
+                fcntl.flock(out, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return None
+        # Под блокировкой - свежее смещение: upload мог устареть, пока ждал предыдущий запрос
+        row = conn.execute("SELECT received FROM upload_sessions WHERE id = ?", (upload['id'],)).fetchone()
+        if row is None or row[0] != offset:
+            return None
+        limit = min(limit, upload['size'] - offset)
+        out.seek(offset)
+        for chunk in iter(lambda: stream.read(min(blobstore.CHUNK_SIZE, limit - written)), b''):
+            out.write(chunk)
+            written += len(chunk)
+            if written >= limit:
+                break
+        # Хвост от прерванной раньше записи не должен попасть в файл
+        out.truncate(offset + written)
+        out.flush()
+        cur = conn.execute("""UPDATE upload_sessions SET received = ?, updated_at = ?
+                              WHERE id = ? AND received = ?""",
+                           (offset + written, int(time.time()), upload['id'], offset))
+        conn.commit()
+    if cur.rowcount == 0:
+        # Сессия удалена (истекла) во время записи
+        return None
+    return offset + written
+
+
+def adopt(store, upload):
+    """Готовый файл сессии -> PendingBlob хранилища (хэш читается с диска); None - размер не совпал"""
+    path = part_path(store, upload['id'])
+    if not os.path.isfile(path) or os.path.getsize(path) != upload['size']:
+        return None
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(blobstore.CHUNK_SIZE), b''):
+            digest.update(chunk)
+    sha256 = digest.hexdigest()
+    return blobstore.PendingBlob(path, store.blob_path(sha256, upload['ext']), sha256, upload['size'])
+
+
+def rewind(c, store, upload):
+    """
+    Файл части не совпал с принятым смещением (adopt вернул None): смещение
+    сдвигается к фактическому размеру файла, клиент дописывает с него.
+    """
+    path = part_path(store, upload['id'])
+    if not os.path.isfile(path):
+        with open(path, 'wb'):
+            pass
+    with open(path, 'r+b') as f:
+        if fcntl:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        received = min(os.fstat(f.fileno()).st_size, upload['size'])
+        f.truncate(received)
+    c.execute("UPDATE upload_sessions SET received = ?, updated_at = ? WHERE id = ?",
+              (received, int(time.time()), upload['id']))
+    return received
+
+
+def remove(c, store, upload_id):
+    """Удалить сессию и ее файл (если файл не забран в хранилище)"""
+    c.execute("DELETE FROM upload_sessions WHERE id = ?", (upload_id,))
+    path = part_path(store, upload_id)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def expire(c, store, ttl=SESSION_TTL):
+    """Удалить сессии без активности дольше ttl; возвращает их число"""
+    c.execute("SELECT id FROM upload_sessions WHERE updated_at < ?", (int(time.time()) - ttl,))
+    stale = [row[0] for row in c.fetchall()]
+    for upload_id in stale:
+        remove(c, store, upload_id)
+    return len(stale)
+
+
+def describe(upload):
+    """Состояние сессии для ответа API"""
+    return {'upload_id': upload['id'], 'name': upload['name'], 'size': upload['size'],
+            'offset': upload['received'], 'complete': upload['received'] >= upload['size']}
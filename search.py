@@ -0,0 +1,94 @@
+"""
+Полнотекстовый поиск (SQLite FTS5).
+
+Вместо LIKE '%q%' (полный проход по tracks/albums на каждый запрос)
+ищем по индексам FTS5:
+
+    tracks_fts - title, artist, lyrics
+    albums_fts - title, description
+    users_fts  - nickname, display_name
+
+Индексы внешние (content=...): текст хранится только в основных
+таблицах, а FTS держит лишь инвертированный индекс. Синхронизация -
+триггерами на INSERT/UPDATE/DELETE, так что роуты об индексе не знают.
+Запрос пользователя разбивается на слова, каждое ищется по префиксу
+("лю*" найдет "любовь"), результаты ранжируются по bm25.
+"""
+import re
+import sqlite3
+
+# Слова запроса: буквы/цифры любого алфавита
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+MAX_TOKENS = 8
+
+TOKENIZE = "unicode61 remove_diacritics 2"
+# Префиксные индексы для коротких префиксов - поиск "по мере ввода"
+PREFIX = "2 3"
+
+# Веса колонок для bm25: совпадение в названии важнее, чем в тексте песни
+TRACK_WEIGHTS = (10.0, 5.0, 1.0)
+ALBUM_WEIGHTS = (10.0, 2.0)
+USER_WEIGHTS = (5.0, 5.0)
+
+# Таблица -> (FTS-таблица, индексируемые колонки)
+INDEXES = {
+    'tracks': ('tracks_fts', ('title', 'artist', 'lyrics')),
+    'albums': ('albums_fts', ('title', 'description')),
+    'users': ('users_fts', ('nickname', 'display_name')),
+}
+
+
+def _create_index(c, table, fts_table, columns):
+    cols = ', '.join(columns)
+    old_cols = ', '.join(f'old.{col}' for col in columns)
+    new_cols = ', '.join(f'new.{col}' for col in columns)
+
+    c.execute(f"""CREATE VIRTUAL TABLE {fts_table} USING fts5(
+                      {cols}, content='{table}', content_rowid='id',
+                      tokenize='{TOKENIZE}', prefix='{PREFIX}')""")
+    c.execute(f"""CREATE TRIGGER IF NOT EXISTS {fts_table}_ai AFTER INSERT ON {table} BEGIN
+                      INSERT INTO {fts_table}(rowid, {cols}) VALUES (new.id, {new_cols});
+                  END""")
+    c.execute(f"""CREATE TRIGGER IF NOT EXISTS {fts_table}_ad AFTER DELETE ON {table} BEGIN
+                      INSERT INTO {fts_table}({fts_table}, rowid, {cols}) VALUES ('delete', old.id, {old_cols});
+                  END""")
+    c.execute(f"""CREATE TRIGGER IF NOT EXISTS {fts_table}_au AFTER UPDATE OF {cols} ON {table} BEGIN
+                      INSERT INTO {fts_table}({fts_table}, rowid, {cols}) VALUES ('delete', old.id, {old_cols});
+                      INSERT INTO {fts_table}(rowid, {cols}) VALUES (new.id, {new_cols});
+                  END""")
+    # Индекс для уже существующих строк
+    c.execute(f"INSERT INTO {fts_table}({fts_table}) VALUES ('rebuild')")
+
+
+def init_schema(c):
+    """Создать FTS-индексы и триггеры; False - SQLite собран без FTS5 (остается LIKE)"""
+    try:
+        for table, (fts_table, columns) in INDEXES.items():
+            c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (fts_table,))
+            if not c.fetchone():
+                _create_index(c, table, fts_table, columns)
+    except sqlite3.OperationalError as e:
+        if 'fts5' not in str(e):
+            raise
+        print(f"FTS5 is not available, falling back to LIKE search: {e}")
+        return False
+    return True
+
+
+def match_query(text):
+    """
+    Строка пользователя -> выражение MATCH.
+
+    Каждое слово берется в кавычки (операторы FTS5 в запросе не работают)
+    и ищется по префиксу; слова объединяются через AND.
+    None - в запросе нет ни одного слова.
+    """
+    tokens = TOKEN_RE.findall(text or '')[:MAX_TOKENS]
+    if not tokens:
+        return None
+    return ' '.join(f'"{token}"*' for token in tokens)
+
+
+def bm25(fts_table, weights):
+    """Выражение ранжирования для ORDER BY (меньше - релевантнее)"""
+    return f"bm25({fts_table}, {', '.join(str(w) for w in weights)})"
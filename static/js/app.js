@@ -338,21 +338,31 @@ async function loadUserData() {
     console.log('loadUserData completed');
 }
 
+const MY_TRACKS_PAGE_SIZE = 200;
+
 async function loadMyTracks() {
     try {
         if (!window.currentUser || !window.currentUser.id) {
             console.warn('Cannot load tracks: user not authenticated');
             return;
         }
-        const res = await fetch(`/api/tracks?user_id=${window.currentUser.id}&show_hidden=true`);
-        if (res.ok) {
-            const tracks = await res.json();
-            // Синхронизируем и локальные, и window переменные
-            myTracks = tracks;
-            window.myTracks = tracks;
-            renderMyTracks();
-            updateStats();
-        }
+        // Страницами по next_cursor; lyrics в списке нет - editTrack берет его отдельно
+        const tracks = [];
+        let cursor = null;
+        do {
+            const params = new URLSearchParams({ user_id: window.currentUser.id, show_hidden: 'true', limit: MY_TRACKS_PAGE_SIZE });
+            if (cursor) params.set('cursor', cursor);
+            const res = await fetch(`/api/tracks?${params}`);
+            if (!res.ok) return;
+            const page = await res.json();
+            tracks.push(...page.tracks);
+            cursor = page.next_cursor;
+        } while (cursor);
+        // Синхронизируем и локальные, и window переменные
+        myTracks = tracks;
+        window.myTracks = tracks;
+        renderMyTracks();
+        updateStats();
     } catch(e) {
         console.error('Error loading tracks:', e);
     }
@@ -445,7 +455,7 @@ window.renderMyTracks = function renderMyTracks() {
     emptyState.style.display = 'none';
     container.innerHTML = tracksToRender.map(track => `
         <div class="track-card ${track.hidden ? 'track-hidden' : ''}">
-            <img src="/uploads/${track.cover_filename || ''}" 
+            <img src="${thumbUrl(track.cover_filename)}" 
                  class="track-card-cover" 
                  onerror="this.style.display='none'; this.nextElementSibling.style.display='flex';">
             <div style="display:none; width:100%; aspect-ratio:1/1; background:#333; align-items:center; justify-content:center;">
@@ -498,7 +508,7 @@ window.renderMyAlbums = function renderMyAlbums() {
         <div class="album-card">
             <div onclick="viewAlbum(${album.id})" style="cursor:pointer;">
                 ${album.cover_filename ? 
-                    `<img src="/uploads/${album.cover_filename}" class="album-card-cover">` :
+                    `<img src="${thumbUrl(album.cover_filename)}" class="album-card-cover">` :
                     `<div style="width:100%; aspect-ratio:1/1; background:linear-gradient(135deg, #333 0%, #1c1c1e 100%); display:flex; align-items:center; justify-content:center; border-radius:8px; margin-bottom:12px;">
                         <ion-icon name="albums" style="font-size:48px; color:#666;"></ion-icon>
                     </div>`
@@ -630,8 +640,8 @@ async function loadProfileStats() {
     if (!window.currentUser || !window.currentUser.id) return;
     
     try {
-        // Получаем все треки пользователя
-        const tracksRes = await fetch(`/api/tracks?user_id=${window.currentUser.id}`);
+        // Получаем счетчики треков пользователя (без lyrics и прочих тяжелых полей)
+        const tracksRes = await fetch(`/api/tracks?user_id=${window.currentUser.id}&fields=plays_count,likes_count`);
         const tracks = await tracksRes.json();
         
         // Получаем все альбомы пользователя
@@ -912,81 +922,174 @@ function resetUpload() {
     document.getElementById('audio-files-input').value = '';
 }
 
+// Возобновляемая загрузка частями: обрыв сети стоит одной части, а не всего файла
+const UPLOAD_MAX_RETRIES = 8;
+const UPLOAD_RETRY_DELAY = 1000;
+const UPLOAD_DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024;
+
+async function uploadInChunks(upload, file, chunkSize, onProgress) {
+    let offset = upload.offset;
+    let failures = 0;
+    while (offset < file.size) {
+        try {
+            const res = await fetch(`/api/uploads/${upload.upload_id}`, {
+                method: 'PUT',
+                headers: {'Content-Type': 'application/octet-stream', 'Upload-Offset': String(offset)},
+                body: file.slice(offset, offset + chunkSize)
+            });
+            const data = await res.json();
+            if (res.ok || res.status === 409) {
+                // 409 - сервер принял другой объем, продолжаем с его смещения
+                offset = data.offset;
+                failures = 0;
+                if (onProgress) onProgress(offset / file.size);
+                continue;
+            }
+            throw new Error(data.error || `HTTP ${res.status}`);
+        } catch (err) {
+            if (++failures > UPLOAD_MAX_RETRIES) throw err;
+            console.warn('Chunk upload failed, retrying:', err);
+            await new Promise(resolve => setTimeout(resolve, UPLOAD_RETRY_DELAY * failures));
+            try {
+                const res = await fetch(`/api/uploads/${upload.upload_id}`);
+                if (res.ok) offset = (await res.json()).offset;
+            } catch (e) {
+                // Сеть еще недоступна - повторим на следующей попытке
+            }
+        }
+    }
+}
+
+async function trackCoverFile(track) {
+    // Обложка: выбранный пользователем файл или base64 из метаданных
+    if (track.coverData) return track.coverData;
+    if (track.cover && track.cover.startsWith('data:image')) {
+        try {
+            const res = await fetch(track.cover);
+            const blob = await res.blob();
+            return new File([blob], "cover.jpg", { type: "image/jpeg" });
+        } catch (e) {
+            console.error('Error converting cover:', e);
+        }
+    }
+    return null;
+}
+
+function setBulkStatus(index, text, color) {
+    const statusEl = document.getElementById(`status-${index}`);
+    if (statusEl) {
+        statusEl.textContent = text;
+        statusEl.style.color = color;
+    }
+    return statusEl;
+}
+
 async function publishAllTracks() {
     const btn = document.querySelector('.upload-actions .btn-primary');
     btn.disabled = true;
     btn.innerHTML = '<div class="spinner small"></div> Публикация...';
     
-    let successCount = 0;
+    let successCount = bulkUploadFiles.filter(t => t.status === 'success').length;
+    // Треки, которые сервер еще обрабатывает в фоне (теги, обложка, длительность)
+    const processing = [];
     
+    // Уже загруженные файлы (сессии) переживают повторное нажатие после ошибки
+    const pending = [];
     for (let i = 0; i < bulkUploadFiles.length; i++) {
         const track = bulkUploadFiles[i];
         if (track.status === 'success') continue; // Skip already uploaded
-        
-        const card = document.getElementById(`bulk-track-${i}`);
-        const statusEl = document.getElementById(`status-${i}`);
-        
-        if (statusEl) {
-            statusEl.textContent = 'Загрузка...';
-            statusEl.style.color = '#0a84ff';
-        }
-        
-        const formData = new FormData();
-        formData.append('audio', track.file);
-        formData.append('title', track.title);
-        formData.append('artist', track.artist);
-        
-        // Добавляем обложку если есть (либо загруженную, либо из метаданных base64 - но сервер ждет файл)
-        // Если coverData есть (пользователь выбрал файл) - отправляем
-        if (track.coverData) {
-            formData.append('cover', track.coverData);
-        } else if (track.cover && track.cover.startsWith('data:image')) {
-            // Если обложка из метаданных (base64), конвертируем в файл
-            try {
-                const res = await fetch(track.cover);
-                const blob = await res.blob();
-                formData.append('cover', new File([blob], "cover.jpg", { type: "image/jpeg" }));
-            } catch (e) {
-                console.error('Error converting cover:', e);
-            }
-        }
+        if (!track.coverFile) track.coverFile = await trackCoverFile(track);
+        pending.push({ index: i, track });
+    }
     
+    let chunkSize = UPLOAD_DEFAULT_CHUNK_SIZE;
     try {
-        const res = await fetch('/api/tracks', {
-            method: 'POST',
-            body: formData
+        // Сессии для всех файлов - одним запросом
+        const files = [];
+        pending.forEach(p => {
+            if (!p.track.upload) files.push({ key: p, field: 'upload', file: p.track.file });
+            if (p.track.coverFile && !p.track.coverUpload) files.push({ key: p, field: 'coverUpload', file: p.track.coverFile });
         });
-        
-        const data = await res.json();
-        
-        if (data.success) {
-                track.status = 'success';
-                if (statusEl) {
-                    statusEl.textContent = 'Опубликовано';
-                    statusEl.style.color = '#30d158';
-                }
-                if (card) {
-                    card.style.opacity = '0.5';
-                    card.style.borderColor = '#30d158';
+        if (files.length) {
+            const res = await fetch('/api/uploads', {
+                method: 'POST',
+                headers: {'Content-Type': 'application/json'},
+                body: JSON.stringify({ files: files.map(f => ({ name: f.file.name, size: f.file.size })) })
+            });
+            const data = await res.json();
+            if (!data.success) throw new Error(data.error || 'Upload init failed');
+            files.forEach((f, j) => { f.key.track[f.field] = data.uploads[j]; });
+            chunkSize = data.chunk_size;
+        }
+        // Файлы идут по очереди, каждый - частями
+        const ready = [];
+        for (const { index, track } of pending) {
+            try {
+                await uploadInChunks(track.upload, track.file, chunkSize, progress => {
+                    setBulkStatus(index, `Загрузка... ${Math.round(progress * 100)}%`, '#0a84ff');
+                });
+                track.upload.offset = track.file.size;
+                if (track.coverUpload) {
+                    await uploadInChunks(track.coverUpload, track.coverFile, chunkSize);
+                    track.coverUpload.offset = track.coverFile.size;
                 }
-                successCount++;
-        } else {
+                setBulkStatus(index, 'Загружено', '#0a84ff');
+                ready.push({ index, track });
+            } catch (err) {
+                console.error(err);
                 track.status = 'error';
-                if (statusEl) {
-                    statusEl.textContent = 'Ошибка: ' + (data.error || 'Unknown');
-                    statusEl.style.color = '#ff453a';
+                setBulkStatus(index, 'Ошибка сети', '#ff453a');
+            }
         }
+        
+        // Все загруженные треки создаются одной транзакцией
+        if (ready.length) {
+            const res = await fetch('/api/uploads/finalize', {
+                method: 'POST',
+                headers: {'Content-Type': 'application/json'},
+                body: JSON.stringify({ tracks: ready.map(({ track }) => ({
+                    upload_id: track.upload.upload_id,
+                    cover_upload_id: track.coverUpload ? track.coverUpload.upload_id : null,
+                    title: track.title,
+                    artist: track.artist
+                })) })
+            });
+            const data = await res.json();
+            if (!data.success) {
+                ready.forEach(({ index, track }) => {
+                    track.status = 'error';
+                    setBulkStatus(index, 'Ошибка: ' + (data.error || 'Unknown'), '#ff453a');
+                });
+            } else {
+                data.tracks.forEach((created, j) => {
+                    const { index, track } = ready[j];
+                    track.status = 'success';
+                    const statusEl = setBulkStatus(index,
+                        created.status === 'processing' ? 'Обработка...' : 'Опубликовано', '#30d158');
+                    if (created.status === 'processing') {
+                        processing.push({ id: created.id, statusEl });
+                    }
+                    const card = document.getElementById(`bulk-track-${index}`);
+                    if (card) {
+                        card.style.opacity = '0.5';
+                        card.style.borderColor = '#30d158';
+                    }
+                    successCount++;
+                });
             }
-        } catch (err) {
+        }
+    } catch (err) {
         console.error(err);
-            track.status = 'error';
-            if (statusEl) {
-                statusEl.textContent = 'Ошибка сети';
-                statusEl.style.color = '#ff453a';
+        pending.forEach(({ index, track }) => {
+            if (track.status !== 'success') {
+                track.status = 'error';
+                setBulkStatus(index, 'Ошибка сети', '#ff453a');
             }
-        }
+        });
     }
     
+    await waitForTracksProcessing(processing);
+    
     btn.disabled = false;
     btn.innerHTML = '<ion-icon name="checkmark-done"></ion-icon> Опубликовать все';
     
@@ -1000,6 +1103,43 @@ async function publishAllTracks() {
     }
 }
 
+// Опрос статуса фоновой обработки загруженных треков
+const PROCESSING_POLL_INTERVAL = 1000;
+const PROCESSING_POLL_MAX_ATTEMPTS = 60;
+
+async function waitForTracksProcessing(items) {
+    let pending = items.slice();
+    
+    for (let attempt = 0; pending.length && attempt < PROCESSING_POLL_MAX_ATTEMPTS; attempt++) {
+        await new Promise(resolve => setTimeout(resolve, PROCESSING_POLL_INTERVAL));
+        
+        try {
+            const ids = pending.map(item => item.id).join(',');
+            const res = await fetch(`/api/tracks/status?ids=${ids}`);
+            if (!res.ok) continue;
+            const data = await res.json();
+            const statuses = new Map(data.tracks.map(t => [t.id, t]));
+            
+            pending = pending.filter(item => {
+                const info = statuses.get(item.id);
+                if (!info || info.status === 'processing') return true;
+                
+                if (item.statusEl) {
+                    if (info.status === 'failed') {
+                        item.statusEl.textContent = 'Опубликовано (метаданные не прочитаны)';
+                        item.statusEl.style.color = '#ff9f0a';
+                    } else {
+                        item.statusEl.textContent = 'Опубликовано';
+                    }
+                }
+                return false;
+            });
+        } catch (e) {
+            console.error('Error polling track status:', e);
+        }
+    }
+}
+
 // Модифицированная extractMetadata (возвращает данные, а не меняет DOM)
 async function extractMetadata(file) {
     const formData = new FormData();
@@ -1134,6 +1274,17 @@ async function editTrack(trackId) {
     document.getElementById('edit-track-artist').value = track.artist;
     document.getElementById('edit-track-slug').value = track.slug || '';
     document.getElementById('edit-track-lyrics').value = track.lyrics || '';
+    if (track.lyrics === undefined) {
+        // В списке треков текста нет - подгружаем для формы
+        fetch(`/api/tracks/${trackId}/lyrics`)
+            .then(r => r.ok ? r.json() : null)
+            .then(data => {
+                if (data && currentEditTrackId === trackId) {
+                    document.getElementById('edit-track-lyrics').value = data.lyrics || '';
+                }
+            })
+            .catch(() => {});
+    }
     
     // Показываем текущую обложку
     const coverPreview = document.getElementById('edit-track-cover-preview');
@@ -2779,7 +2930,7 @@ async function manageAlbumTracks(albumId) {
     // Загружаем треки альбома
     let albumTracks = [];
     try {
-        const res = await fetch(`/api/albums/${albumId}/tracks?t=${Date.now()}`);
+        const res = await fetch(`/api/albums/${albumId}/tracks`);
         if (res.ok) {
             albumTracks = await res.json();
         }
@@ -2819,7 +2970,13 @@ async function manageAlbumTracks(albumId) {
     renderAlbumTracks(albumId, albumTracks);
 }
 
+// Текущий порядок треков в окне управления альбомом (перемещения применяются локально)
+let managedAlbumTracks = [];
+const albumOrderTimers = {};
+const ALBUM_ORDER_SAVE_DELAY = 600;
+
 function renderAlbumTracks(albumId, tracks) {
+    managedAlbumTracks = tracks;
     const container = document.getElementById('album-tracks-list');
     if (!container) return;
     
@@ -2877,7 +3034,7 @@ function showAddTracksToAlbum(albumId) {
     modal.id = 'modal-add-tracks-to-album';
     
     // Получаем треки, которых еще нет в альбоме
-    fetch(`/api/albums/${albumId}/tracks?t=${Date.now()}`).then(res => res.json()).then(albumTracks => {
+    fetch(`/api/albums/${albumId}/tracks`).then(res => res.json()).then(albumTracks => {
         const albumTrackIds = albumTracks.map(t => t.id);
         const availableTracks = myTracks.filter(t => !albumTrackIds.includes(t.id));
         
@@ -2999,18 +3156,17 @@ async function addSelectedTracksToAlbum(albumId) {
     const tracks = Array.from(selectedTracksForAlbum);
     let successCount = 0;
     
-    // Добавляем последовательно
-    for (const trackId of tracks) {
-        try {
-            const res = await fetch(`/api/albums/${albumId}/tracks`, {
-                method: 'POST',
-                headers: {'Content-Type': 'application/json'},
-                body: JSON.stringify({ track_id: trackId })
-            });
-            if (res.ok) successCount++;
-        } catch (e) {
-            console.error(e);
-        }
+    // Все выбранные треки - одним запросом
+    try {
+        const res = await fetch(`/api/albums/${albumId}/tracks/batch`, {
+            method: 'POST',
+            headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify({ track_ids: tracks })
+        });
+        const data = await res.json();
+        if (data.success) successCount = data.added;
+    } catch (e) {
+        console.error(e);
     }
     
     closeModal('modal-add-tracks-to-album');
@@ -3035,7 +3191,7 @@ async function removeTrackFromAlbum(albumId, trackId) {
         
         if (data.success) {
             // Обновляем список треков
-            const tracksRes = await fetch(`/api/albums/${albumId}/tracks?t=${Date.now()}`);
+            const tracksRes = await fetch(`/api/albums/${albumId}/tracks`);
             if (tracksRes.ok) {
                 const tracks = await tracksRes.json();
                 renderAlbumTracks(albumId, tracks);
@@ -3049,29 +3205,42 @@ async function removeTrackFromAlbum(albumId, trackId) {
     }
 }
 
-async function moveTrackInAlbum(albumId, trackId, direction) {
+function moveTrackInAlbum(albumId, trackId, direction) {
+    const tracks = managedAlbumTracks.slice();
+    const index = tracks.findIndex(t => t.id === trackId);
+    const target = direction === 'up' ? index - 1 : index + 1;
+    if (index < 0 || target < 0 || target >= tracks.length) return;
+    
+    [tracks[index], tracks[target]] = [tracks[target], tracks[index]];
+    renderAlbumTracks(albumId, tracks);
+    
+    // Серия нажатий сохраняется одним запросом с итоговым порядком
+    const trackIds = tracks.map(t => t.id);
+    clearTimeout(albumOrderTimers[albumId]);
+    albumOrderTimers[albumId] = setTimeout(() => saveAlbumOrder(albumId, trackIds), ALBUM_ORDER_SAVE_DELAY);
+}
+
+async function saveAlbumOrder(albumId, trackIds) {
+    delete albumOrderTimers[albumId];
     try {
-        const res = await fetch(`/api/albums/${albumId}/tracks/${trackId}/move`, {
-            method: 'POST',
+        const res = await fetch(`/api/albums/${albumId}/order`, {
+            method: 'PUT',
             headers: {'Content-Type': 'application/json'},
-            body: JSON.stringify({ direction })
+            body: JSON.stringify({ track_ids: trackIds })
         });
         
         const data = await res.json();
-        
-        if (data.success) {
-            // Обновляем список треков
-            const tracksRes = await fetch(`/api/albums/${albumId}/tracks?t=${Date.now()}`);
-            if (tracksRes.ok) {
-                const tracks = await tracksRes.json();
-                renderAlbumTracks(albumId, tracks);
-            }
-        } else {
-            alert('Ошибка перемещения трека');
+        if (!data.success) {
+            throw new Error(data.error || 'order not saved');
         }
     } catch(err) {
         alert('Ошибка перемещения трека');
         console.error(err);
+        // Возвращаем порядок с сервера
+        const tracksRes = await fetch(`/api/albums/${albumId}/tracks`);
+        if (tracksRes.ok) {
+            renderAlbumTracks(albumId, await tracksRes.json());
+        }
     }
 }
 
@@ -775,11 +775,10 @@
                     if (!track.id) continue;
                     
                     try {
-                        // Проверяем существование трека через список треков с фильтром
-                        const res = await fetch(`/api/tracks?id=${track.id}`);
+                        // Проверяем существование трека через точечный запрос по ID
+                        const res = await fetch(`/api/tracks/${track.id}`);
                         if (res.ok) {
-                            const tracks = await res.json();
-                            const foundTrack = Array.isArray(tracks) ? tracks.find(t => t.id === track.id) : null;
+                            const foundTrack = await res.json();
                             if (foundTrack) {
                                 validTracks.push(foundTrack);
                             } else {
@@ -875,7 +874,7 @@
                 console.log('Restoring track:', track.title, 'isPlaying:', state.isPlaying, 'currentTime:', state.currentTime, 'index:', state.currentIndex);
                 
                 // Устанавливаем источник
-                const audioSrc = `/uploads/${track.filename}`;
+                const audioSrc = trackAudioUrl(track);
                 if (audio.src !== audioSrc) {
                     audio.src = audioSrc;
                 }
@@ -954,7 +953,7 @@
             const track = state.tracks[state.currentIndex];
             if (track) {
                 console.log('Restoring track by index (no autoplay):', track.title, 'index:', state.currentIndex);
-                const audioSrc = `/uploads/${track.filename}`;
+                const audioSrc = trackAudioUrl(track);
                 audio.src = audioSrc;
                 if (state.currentTime > 0) {
                     audio.currentTime = state.currentTime;
@@ -1250,7 +1249,7 @@
         const miniPlayer = document.getElementById('mini-player');
         
         if (miniCover && track.cover_filename) {
-            miniCover.src = `/uploads/${track.cover_filename}`;
+            miniCover.src = thumbUrl(track.cover_filename);
         }
         if (miniTitle) miniTitle.textContent = track.title || 'Not Playing';
         if (miniArtist) miniArtist.textContent = track.artist || '';
@@ -1265,12 +1264,13 @@
         const playerBg = document.getElementById('player-bg');
         
         if (fullCover && track.cover_filename) {
-            fullCover.src = `/uploads/${track.cover_filename}`;
+            fullCover.src = thumbUrl(track.cover_filename, 512);
         }
         if (fullTitle) fullTitle.textContent = track.title || 'Title';
         if (fullArtist) fullArtist.textContent = track.artist || 'Artist';
         if (playerBg && track.cover_filename) {
-            playerBg.style.backgroundImage = `url(/uploads/${track.cover_filename})`;
+            // Фон размыт - достаточно самой маленькой миниатюры
+            playerBg.style.backgroundImage = `url(${thumbUrl(track.cover_filename, 64)})`;
         }
     }
     
@@ -1311,9 +1311,31 @@
         setTimeout(initSPANavigation, 100);
     }
     
+    // URL миниатюры обложки (64/256/512, WebP или JPEG по Accept)
+    function thumbUrl(filename, size = 256) {
+        return `/thumbs/${size}/${filename || ''}`;
+    }
+    
+    // URL аудио: сервер выбирает версию по битрейту (Save-Data / ECT / Downlink)
+    function audioUrl(filename) {
+        return `/uploads/${filename || ''}?quality=auto`;
+    }
+    
+    // Длинные треки - сегментами HLS, если браузер играет его сам (Safari, iOS, Android)
+    const nativeHls = !!document.createElement('audio').canPlayType('application/vnd.apple.mpegurl');
+    function trackAudioUrl(track) {
+        if (track.segmented && nativeHls) {
+            return `/hls/${track.filename}/index.m3u8`;
+        }
+        return audioUrl(track.filename);
+    }
+    
     // Экспортируем функции для использования в других скриптах
     window.savePlayerStateForSPA = savePlayerState;
     window.restorePlayerStateForSPA = restorePlayerState;
+    window.thumbUrl = thumbUrl;
+    window.audioUrl = audioUrl;
+    window.trackAudioUrl = trackAudioUrl;
     
 })();
 
@@ -62,11 +62,10 @@ function initPlayer() {
                         if (!track.id) continue;
                         
                         try {
-                            // Проверяем существование трека через список треков с фильтром
-                            const res = await fetch(`/api/tracks?id=${track.id}`);
+                            // Проверяем существование трека через точечный запрос по ID
+                            const res = await fetch(`/api/tracks/${track.id}`);
                             if (res.ok) {
-                                const tracks = await res.json();
-                                const foundTrack = Array.isArray(tracks) ? tracks.find(t => t.id === track.id) : null;
+                                const foundTrack = await res.json();
                                 if (foundTrack) {
                                     validTracks.push(foundTrack);
                                 } else {
@@ -126,7 +125,7 @@ function initPlayer() {
                                 
                                 // Устанавливаем src аудио но НЕ запускаем
                                 if (audio && track.filename) {
-                                    audio.src = `/uploads/${track.filename}`;
+                                    audio.src = trackAudioUrl(track);
                                     // Восстанавливаем время если было сохранено
                                     if (state.currentTime > 0) {
                                         audio.addEventListener('loadedmetadata', function restoreTime() {
@@ -391,6 +390,16 @@ let audioContext = null;
 let gainNode = null;
 let sourceNode = null;
 let useWebAudio = false;
+// Нормализация громкости: отдельный узел между источником и громкостью пользователя
+let normNode = null;
+
+// Бесшовный переход: следующий трек прогревается заранее, а переключение
+// планируется на конец записи (без добивки кодера), не дожидаясь 'ended'
+const GAPLESS_PRELOAD_SECONDS = 20;
+const GAPLESS_LOOKAHEAD_SECONDS = 1;
+let gaplessTimer = null;
+let preloadAudio = null;
+let preloadedUrl = null;
 
 // Инициализация Web Audio API - отключена для iOS
 function initWebAudio() {
@@ -447,7 +456,10 @@ function connectWebAudio() {
         // Важно: можно создать только один раз для одного audio элемента
         if (!sourceNode) {
             sourceNode = audioContext.createMediaElementSource(audio);
-            sourceNode.connect(gainNode);
+            normNode = audioContext.createGain();
+            normNode.connect(gainNode);
+            sourceNode.connect(normNode);
+            applyTrackGain(getCurrentTrack());
             // Не подключаем audio напрямую к destination - gainNode уже подключен
         }
     } catch(e) {
@@ -456,6 +468,86 @@ function connectWebAudio() {
     }
 }
 
+// Усиление из анализа на сервере (дБ). В списке альбома есть album_gain -
+// общее для альбома, чтобы сохранить разницу громкости между его треками
+function trackGainFactor(track) {
+    if (!track) return 1;
+    const gain = track.album_gain != null ? track.album_gain : track.gain;
+    return gain != null ? Math.pow(10, gain / 20) : 1;
+}
+
+function applyTrackGain(track) {
+    if (!normNode) return;
+    try {
+        normNode.gain.value = trackGainFactor(track);
+    } catch(e) {}
+}
+
+// Задержка кодера того файла, что реально отдается (оригинал или версия
+// пониженного битрейта - у них разные), - с сервера, тем же ?quality=
+function loadPlaybackHints(track) {
+    if (!track || !track.id) return;
+    // Версия могла дозреть с прошлого раза - запрашиваем при каждом запуске
+    track.playback = null;
+    fetch(`/api/tracks/${track.id}/playback?quality=auto`)
+        .then(res => res.ok ? res.json() : null)
+        .then(info => { if (info) track.playback = info; })
+        .catch(() => {});
+}
+
+// Конец записи в секундах audio.currentTime. Сервер отдает длительность без
+// задержки и добивки кодера; если браузер их не отрезал, запись начинается
+// на encoder_delay отсчетов позже и кончается раньше audio.duration
+function trackContentEnd(track) {
+    const total = audio.duration;
+    const hints = track && track.playback;
+    if (!track || !track.duration || !hints || !hints.sample_rate || hints.encoder_delay == null) return total;
+    if (audio.currentSrc && audio.currentSrc.includes('/hls/')) return total;
+    return Math.min(total, track.duration + hints.encoder_delay / hints.sample_rate);
+}
+
+function nextListTrack() {
+    if (window.SHARED_MODE || radioMode || tracks.length === 0) return null;
+    return tracks[currentIndex < tracks.length - 1 ? currentIndex + 1 : 0];
+}
+
+// Прогрев следующего трека в кэше браузера, чтобы он начал играть сразу
+function preloadNextTrack() {
+    const next = nextListTrack();
+    if (!next || !next.filename) return;
+    const url = trackAudioUrl(next);
+    if (url === preloadedUrl) return;
+    preloadedUrl = url;
+    if (!preloadAudio) {
+        preloadAudio = new Audio();
+        preloadAudio.preload = 'auto';
+        preloadAudio.muted = true;
+        preloadAudio.crossOrigin = 'anonymous';
+    }
+    preloadAudio.src = url;
+}
+
+function cancelGapless() {
+    if (gaplessTimer) {
+        clearTimeout(gaplessTimer);
+        gaplessTimer = null;
+    }
+}
+
+// Вызывается из timeupdate: за секунду до конца записи ставим точный таймер
+function updateGapless() {
+    const remaining = trackContentEnd(getCurrentTrack()) - audio.currentTime;
+    if (!isFinite(remaining)) return;
+    if (remaining < GAPLESS_PRELOAD_SECONDS) preloadNextTrack();
+    if (remaining < GAPLESS_LOOKAHEAD_SECONDS && !gaplessTimer && !audio.paused) {
+        const src = audio.src;
+        gaplessTimer = setTimeout(() => {
+            gaplessTimer = null;
+            if (audio.src === src && !audio.paused) nextTrack();
+        }, Math.max(0, remaining) * 1000 / (audio.playbackRate || 1));
+    }
+}
+
 // Инициализируем Web Audio при первом пользовательском действии (для iOS)
 function initWebAudioOnUserAction(event) {
     // Предотвращаем множественные вызовы
@@ -501,6 +593,25 @@ function initWebAudioOnUserAction(event) {
 // Используем глобальную переменную window.currentUser из app.js
 
 // === INIT ===
+const TRACKS_PAGE_SIZE = 200;
+
+// Все треки по запросу, страницами по limit/next_cursor (без lyrics - текст грузится отдельно)
+async function fetchTrackPages(query = '') {
+    const result = [];
+    let cursor = null;
+    do {
+        const params = new URLSearchParams(query);
+        params.set('limit', TRACKS_PAGE_SIZE);
+        if (cursor) params.set('cursor', cursor);
+        const res = await fetch(`/api/tracks?${params}`);
+        if (!res.ok) throw new Error(`HTTP ${res.status}`);
+        const page = await res.json();
+        result.push(...page.tracks);
+        cursor = page.next_cursor;
+    } while (cursor);
+    return result;
+}
+
 async function fetchTracks() {
     // Если Shared Mode, используем переданный трек
     if (window.SHARED_MODE && typeof INITIAL_TRACK !== 'undefined' && INITIAL_TRACK) {
@@ -533,8 +644,7 @@ async function fetchTracks() {
         }
         
         // Получаем публичные треки (для библиотеки используются треки из app.js)
-        const res = await fetch('/api/tracks');
-        tracks = await res.json();
+        tracks = await fetchTrackPages();
         
         // Обновляем currentIndex если трек все еще существует
         if (currentTrackId !== null) {
@@ -569,11 +679,12 @@ function renderList() {
         div.className = `track-item ${i === currentIndex ? 'playing-now' : ''}`;
         const equalizerClass = (i === currentIndex && isPlaying) ? 'equalizer-animation' : 'equalizer-animation paused';
         div.innerHTML = `
-            <img src="/uploads/${t.cover_filename || ''}" loading="lazy" onerror="this.style.display='none'">
+            <img src="${thumbUrl(t.cover_filename)}" loading="lazy" onerror="this.style.display='none'">
             <div class="track-info">
                 <div class="track-title">${t.title}</div>
                 <div class="track-artist">${t.artist}</div>
             </div>
+            ${t.duration ? `<div class="track-duration">${fmtTime(t.duration)}</div>` : ''}
             ${i === currentIndex ? `<div class="${equalizerClass}"><div class="equalizer-bar"></div><div class="equalizer-bar"></div><div class="equalizer-bar"></div><div class="equalizer-bar"></div><div class="equalizer-bar"></div></div>` : ''}
         `;
         div.onclick = () => playTrack(i);
@@ -613,7 +724,10 @@ function playTrack(index, autoPlay = true) {
     }
     
     // Sources
-    audio.src = `/uploads/${track.filename}`;
+    cancelGapless();
+    audio.src = trackAudioUrl(track);
+    applyTrackGain(track);
+    loadPlaybackHints(track);
     
     // Увеличиваем счетчик прослушиваний трека
     if (track.id) {
@@ -664,17 +778,17 @@ function playTrack(index, autoPlay = true) {
     if ('mediaSession' in navigator) {
         try {
             // Для iOS используем абсолютный URL для artwork
-            const artworkUrl = coverUrl.startsWith('http') ? coverUrl : window.location.origin + coverUrl;
+            // Миниатюры в JPEG - не все системные плееры понимают WebP
+            const artworkThumb = (size) => window.location.origin + thumbUrl(track.cover_filename, size) + '?format=jpg';
             
             navigator.mediaSession.metadata = new MediaMetadata({
                 title: track.title,
                 artist: track.artist,
                 album: '',
                 artwork: [
-                    { src: artworkUrl, sizes: '512x512', type: 'image/jpeg' },
-                    { src: artworkUrl, sizes: '256x256', type: 'image/jpeg' },
-                    { src: artworkUrl, sizes: '128x128', type: 'image/jpeg' },
-                    { src: artworkUrl, sizes: '96x96', type: 'image/jpeg' }
+                    { src: artworkThumb(512), sizes: '512x512', type: 'image/jpeg' },
+                    { src: artworkThumb(256), sizes: '256x256', type: 'image/jpeg' },
+                    { src: artworkThumb(64), sizes: '64x64', type: 'image/jpeg' }
                 ]
             });
             
@@ -815,32 +929,8 @@ function playTrack(index, autoPlay = true) {
     updateArtistName(playerArtist, track);
     updateArtistName(fullArtist, track);
     
-    // Parse Lyrics
-    parseLyrics(track.lyrics);
-    
-    // Обновляем состояние кнопки лириков и закрываем лирики, если их нет
-    updateLyricsButton();
-    
-    // Если лирики были открыты, но у нового трека их нет - закрываем
-    if (isLyricsOpen && lyricsData.length === 0) {
-        const cover = document.getElementById('full-cover');
-        const lyricsWrap = document.getElementById('lyrics-wrapper');
-        const btn = document.getElementById('lyrics-btn');
-        
-        if (cover && lyricsWrap && btn) {
-            isLyricsOpen = false;
-            lyricsWrap.style.opacity = '0';
-            setTimeout(() => {
-                lyricsWrap.style.display = 'none';
-            }, 300);
-            cover.style.display = 'block';
-            requestAnimationFrame(() => {
-                cover.style.opacity = '1';
-                cover.style.transform = 'scale(1)';
-            });
-            btn.classList.remove('active');
-        }
-    }
+    // Текст: готовая шкала с сервера (или разбор на месте, если сервер недоступен)
+    showTrackLyrics(track);
     
     // Re-render list for active state
     renderList();
@@ -926,7 +1016,7 @@ function playTrack(index, autoPlay = true) {
         expandPlayer();
         // Автоматически открываем лирики только если они есть
         setTimeout(() => {
-            if (!isLyricsOpen && lyricsData.length > 0 && track.lyrics && track.lyrics.trim()) {
+            if (!isLyricsOpen && lyricsData.length > 0) {
                 toggleLyricsView();
             }
         }, 200);
@@ -1005,6 +1095,57 @@ function updatePlayButtons(isPlaying) {
     renderList();
 }
 
+// === РАДИО: следующий трек - похожий на текущий ===
+let radioMode = localStorage.getItem('swag_radio') === '1';
+// Уже сыгранные в радио треки (чтобы не зацикливаться)
+const radioHistory = [];
+const RADIO_HISTORY_MAX = 100;
+
+function updateRadioButton() {
+    const btn = document.getElementById('player-radio-btn');
+    if (!btn) return;
+    btn.style.background = radioMode ? 'rgba(255,255,255,0.3)' : 'rgba(255,255,255,0.1)';
+    btn.title = radioMode ? 'Радио: включено' : 'Радио: похожие треки после текущего';
+}
+
+function toggleRadio() {
+    radioMode = !radioMode;
+    localStorage.setItem('swag_radio', radioMode ? '1' : '0');
+    radioHistory.length = 0;
+    updateRadioButton();
+}
+
+async function playRadioNext() {
+    // playTrack берет window.tracks, если он задан - вставляем в тот же список
+    const list = window.tracks && window.tracks.length > 0 ? window.tracks : tracks;
+    const current = list[currentIndex];
+    if (!current) return false;
+    
+    if (!radioHistory.includes(current.id)) {
+        radioHistory.push(current.id);
+        if (radioHistory.length > RADIO_HISTORY_MAX) radioHistory.shift();
+    }
+    try {
+        const res = await fetch(`/api/tracks/${current.id}/similar?limit=5&exclude=${radioHistory.join(',')}`);
+        if (!res.ok) return false;
+        const similar = await res.json();
+        if (!similar.length) return false;
+        
+        const next = similar[0];
+        const existing = list.findIndex(t => t.id === next.id);
+        if (existing !== -1) {
+            playTrack(existing);
+        } else {
+            list.splice(currentIndex + 1, 0, next);
+            playTrack(currentIndex + 1);
+        }
+        return true;
+    } catch (e) {
+        console.error('Radio error:', e);
+        return false;
+    }
+}
+
 function nextTrack() {
     if (tracks.length === 0) return;
     if (window.SHARED_MODE) {
@@ -1013,6 +1154,15 @@ function nextTrack() {
         playTrack(0);
         return;
     }
+    if (radioMode) {
+        // Нет похожих (или сеть недоступна) - обычный следующий по списку
+        playRadioNext().then(ok => { if (!ok) nextInList(); });
+        return;
+    }
+    nextInList();
+}
+
+function nextInList() {
     if (currentIndex < tracks.length - 1) {
         playTrack(currentIndex + 1);
     } else {
@@ -1100,8 +1250,91 @@ function collapsePlayer() {
 }
 
 // === LYRICS SYSTEM ===
+let lyricLineEls = [];
+
+// Показ текста трека: шкалу разбирает сервер, клиент только рисует
+function showTrackLyrics(track) {
+    if (track.lyricsTimeline) {
+        applyLyricsTimeline(track.lyricsTimeline);
+    } else if (track.lyrics !== undefined && !(track.lyrics && track.lyrics.trim())) {
+        // Текста нет - на сервер не ходим
+        applyLyricsTimeline(null);
+    } else {
+        renderLyricsTimeline(null, true);
+        loadTrackLyrics(track);
+    }
+}
+
+// Отрисовать шкалу, обновить кнопку и закрыть панель, если текста нет
+function applyLyricsTimeline(timeline) {
+    renderLyricsTimeline(timeline);
+    updateLyricsButton();
+    
+    // Если лирики были открыты, но у нового трека их нет - закрываем
+    if (isLyricsOpen && lyricsData.length === 0) {
+        const cover = document.getElementById('full-cover');
+        const lyricsWrap = document.getElementById('lyrics-wrapper');
+        const btn = document.getElementById('lyrics-btn');
+        
+        if (cover && lyricsWrap && btn) {
+            isLyricsOpen = false;
+            lyricsWrap.style.opacity = '0';
+            setTimeout(() => {
+                lyricsWrap.style.display = 'none';
+            }, 300);
+            cover.style.display = 'block';
+            requestAnimationFrame(() => {
+                cover.style.opacity = '1';
+                cover.style.transform = 'scale(1)';
+            });
+            btn.classList.remove('active');
+        }
+    }
+}
+
+// Разбор LRC на клиенте - запасной путь, формат как у /api/tracks/<id>/lyrics/timeline
+function parseLrcTimeline(text) {
+    const timeline = { times: [], lines: [], gaps: [], tail: 0 };
+    if (!text) return timeline;
+    
+    const regex = /\[(\d{2}):(\d{2}\.?\d*)\](.*)/;
+    const entries = [];
+    let gap = 0;
+    
+    text.split('\n').forEach(line => {
+        const match = line.match(regex);
+        if (match) {
+            const textContent = match[3].trim();
+            if (textContent) {
+                const time = parseInt(match[1]) * 60 + parseFloat(match[2]);
+                entries.push({ ms: Math.round(time * 1000), text: textContent, gap });
+                gap = 0;
+            } else {
+                gap++;
+            }
+        } else if (line.trim() === '') {
+            gap++;
+        }
+    });
+    
+    // Бинарному поиску нужна отсортированная шкала (sort стабильный)
+    entries.sort((a, b) => a.ms - b.ms);
+    entries.forEach(e => {
+        timeline.times.push(e.ms);
+        timeline.lines.push(e.text);
+        timeline.gaps.push(e.gap);
+    });
+    timeline.tail = gap;
+    return timeline;
+}
+
 function parseLyrics(text) {
+    renderLyricsTimeline(parseLrcTimeline(text));
+}
+
+function renderLyricsTimeline(timeline, loading = false) {
     lyricsData = [];
+    lyricLineEls = [];
     const container = document.getElementById('lyrics-container');
     if (!container) {
         console.error('Lyrics container not found');
@@ -1109,97 +1342,75 @@ function parseLyrics(text) {
     }
     container.innerHTML = '';
     
-    if (!text || !text.trim()) {
-        container.innerHTML = '<div style="margin-top:50px; color:#666;">No lyrics available</div>';
+    if (!timeline || !timeline.times || timeline.times.length === 0) {
+        if (!loading) {
+            container.innerHTML = '<div style="margin-top:50px; color:#666;">No lyrics available</div>';
+        }
         return;
     }
-
-    const lines = text.split('\n');
-    const regex = /\[(\d{2}):(\d{2}\.?\d*)\](.*)/;
+    
+    const fragment = document.createDocumentFragment();
+    const addGap = (count) => {
+        // Пустые строки - сохраняем отступ
+        for (let i = 0; i < count; i++) {
+            const emptyDiv = document.createElement('div');
+            emptyDiv.style.height = '40px';
+            fragment.appendChild(emptyDiv);
+        }
+    };
 
     // Небольшой отступ сверху для первой строки
     const emptyTop = document.createElement('div');
     emptyTop.className = 'lyric-spacer';
     emptyTop.style.height = '50vh'; // Достаточно для центрирования первой строки
-    container.appendChild(emptyTop);
-
-    let hasZeroTime = false;
-    let firstNonZeroTime = null;
-
-    lines.forEach(line => {
-        const match = line.match(regex);
-        if (match) {
-            const time = parseInt(match[1]) * 60 + parseFloat(match[2]);
-            const textContent = match[3].trim();
-            
-            // Отслеживаем наличие нулевой секунды
-            if (time === 0 || time < 0.1) {
-                hasZeroTime = true;
-            }
-            
-            // Запоминаем первое ненулевое время
-            if (firstNonZeroTime === null && time > 0.1) {
-                firstNonZeroTime = time;
-            }
-            
-            // Сохраняем строку с текстом
-            if (textContent) {
-                lyricsData.push({ time, text: textContent });
-            
-            const div = document.createElement('div');
-            div.className = 'lyric-line';
-                div.innerText = textContent;
-            div.dataset.time = time;
-            div.onclick = () => {
-                audio.currentTime = time;
-                syncLyrics(); // Сразу обновить UI
-            };
-            container.appendChild(div);
-            } else {
-                // Пустая строка - сохраняем отступ
-                const emptyDiv = document.createElement('div');
-                emptyDiv.style.height = '40px'; // Побольше отступ для пустых строк
-                container.appendChild(emptyDiv);
-            }
-        } else if (line.trim() === '') {
-            // Пустая строка без таймкода - сохраняем отступ
-            const emptyDiv = document.createElement('div');
-            emptyDiv.style.height = '40px';
-            container.appendChild(emptyDiv);
-        }
-    });
+    fragment.appendChild(emptyTop);
     
-    // Защита: если первая строка начинается не с нуля, устанавливаем её время на 0
-    // чтобы текст был виден с самого начала, а не появлялся позже
-    if (!hasZeroTime && lyricsData.length > 0) {
-        // Изменяем время первой строки на 0, чтобы она была видна с начала
-        lyricsData[0].time = 0;
+    timeline.lines.forEach((textContent, i) => {
+        addGap(timeline.gaps ? timeline.gaps[i] || 0 : 0);
         
-        // Обновляем время в DOM для первой строки
-        const firstLineElement = container.querySelector('.lyric-line');
-        if (firstLineElement) {
-            firstLineElement.dataset.time = 0;
-            firstLineElement.onclick = () => {
-                audio.currentTime = 0;
-                syncLyrics();
-            };
-        }
-    }
+        // Защита: если первая строка начинается не с нуля, показываем её с самого начала
+        const time = i === 0 && timeline.times[0] >= 100 ? 0 : timeline.times[i] / 1000;
+        lyricsData.push({ time, text: textContent });
+        
+        const div = document.createElement('div');
+        div.className = 'lyric-line';
+        div.innerText = textContent;
+        div.dataset.time = time;
+        div.onclick = () => {
+            audio.currentTime = time;
+            syncLyrics(); // Сразу обновить UI
+        };
+        fragment.appendChild(div);
+        lyricLineEls.push(div);
+    });
+    addGap(timeline.tail || 0);
     
     // Большой отступ внизу для последней строки
     const emptyBottom = document.createElement('div');
     emptyBottom.className = 'lyric-spacer';
     emptyBottom.style.height = '50vh'; // Достаточно для центрирования последней строки
-    container.appendChild(emptyBottom);
+    fragment.appendChild(emptyBottom);
+    container.appendChild(fragment);
     
     // Настраиваем отслеживание скролла после парсинга
     setupLyricsScrollTracking();
-    
-    // Проверяем, что текст действительно был добавлен
-    const finalLines = container.querySelectorAll('.lyric-line');
-    if (finalLines.length === 0 && lyricsData.length > 0) {
-        console.warn('Lyrics data exists but no lines were rendered');
+}
+
+// Индекс активной строки: последняя строка с time <= текущего (бинарный поиск)
+function findLyricIndex(time) {
+    let lo = 0;
+    let hi = lyricsData.length - 1;
+    let idx = -1;
+    while (lo <= hi) {
+        const mid = (lo + hi) >> 1;
+        if (lyricsData[mid].time <= time) {
+            idx = mid;
+            lo = mid + 1;
+        } else {
+            hi = mid - 1;
+        }
     }
+    return idx;
 }
 
 function syncLyrics() {
@@ -1208,17 +1419,10 @@ function syncLyrics() {
     const time = audio.currentTime;
     if (isNaN(time) || time < 0) return;
     
-    let activeIdx = -1;
-    
     // Находим активную строку (ближайшую к текущему времени)
-    for (let i = lyricsData.length - 1; i >= 0; i--) {
-        if (time >= lyricsData[i].time) {
-            activeIdx = i;
-            break;
-        }
-    }
+    const activeIdx = findLyricIndex(time);
 
-    const lines = document.querySelectorAll('.lyric-line');
+    const lines = lyricLineEls;
     if (lines.length === 0) return;
     
     // Обновляем классы только если строка изменилась
@@ -1383,13 +1587,7 @@ function toggleLyricsView() {
                 
                 // Находим активную строку
                 const time = audio.currentTime;
-                let activeIdx = -1;
-                for (let i = lyricsData.length - 1; i >= 0; i--) {
-                    if (time >= lyricsData[i].time) {
-                        activeIdx = i;
-                        break;
-                    }
-                }
+                const activeIdx = findLyricIndex(time);
                 
                 // Скроллим к активной строке или к первой
                 const targetLine = activeIdx >= 0 && activeIdx < updatedLines.length 
@@ -1475,6 +1673,8 @@ function setupAudioListeners() {
         if (currTime) currTime.innerText = fmtTime(audio.currentTime);
         if (durTime) durTime.innerText = fmtTime(audio.duration || 0);
         
+        updateGapless();
+        
         // Синхронизируем кнопки play/pause
         const isPlaying = !audio.paused;
         if (lastPlayState !== isPlaying) {
@@ -1486,13 +1686,7 @@ function setupAudioListeners() {
         const time = audio.currentTime;
         if (isNaN(time) || time < 0) return;
         
-        let currentActiveIdx = -1;
-        for (let i = lyricsData.length - 1; i >= 0; i--) {
-            if (time >= lyricsData[i].time) {
-                currentActiveIdx = i;
-                break;
-            }
-        }
+        const currentActiveIdx = findLyricIndex(time);
         
         // Синхронизируем только когда активная строка изменилась
         if (currentActiveIdx !== lastActiveIdx) {
@@ -1514,6 +1708,7 @@ function setupAudioListeners() {
     });
 
     audio.addEventListener('pause', () => {
+        cancelGapless();
         updatePlayButtons(false);
         lastPlayState = false;
         // Обновляем Media Session для фонового воспроизведения
@@ -1524,8 +1719,12 @@ function setupAudioListeners() {
         }
     });
 
+    // После перемотки таймер перехода пересчитается в timeupdate
+    audio.addEventListener('seeking', cancelGapless);
+
     // Обработка окончания трека
     audio.addEventListener('ended', () => {
+        cancelGapless();
         updatePlayButtons(false);
         lastPlayState = false;
         // Переходим к следующему треку
@@ -1729,17 +1928,43 @@ if ('serviceWorker' in navigator) {
     });
 }
 
+// Загрузка готовой шкалы текста (сервер разбирает LRC один раз при сохранении)
+async function loadTrackLyrics(track) {
+    let timeline = null;
+    try {
+        const res = await fetch(`/api/tracks/${track.id}/lyrics/timeline`);
+        if (res.ok) {
+            timeline = await res.json();
+            track.lyricsTimeline = timeline;
+        }
+    } catch(e) {
+        console.error('Error loading lyrics:', e);
+    }
+    
+    // Сервер недоступен - разбираем текст на месте, если он есть
+    if (!timeline && track.lyrics) {
+        timeline = parseLrcTimeline(track.lyrics);
+    }
+    
+    // Пока грузили, могли переключить трек
+    const current = getCurrentTrack();
+    if (current && current.id === track.id) {
+        applyLyricsTimeline(timeline);
+    }
+}
+
 // Функция для воспроизведения трека по ID
 async function playTrackById(trackId) {
     try {
         // Пробуем найти трек в текущем списке
         let track = tracks.find(t => t.id === trackId);
         
-        // Если не найден, загружаем его
+        // Если не найден, загружаем только его
         if (!track) {
-            const res = await fetch(`/api/tracks`);
-            const allTracks = await res.json();
-            track = allTracks.find(t => t.id === trackId);
+            const res = await fetch(`/api/tracks/${trackId}`);
+            if (res.ok) {
+                track = await res.json();
+            }
         }
         
         if (track) {
@@ -2071,4 +2296,11 @@ window.playTrack = playTrack;
 window.getPlayerState = window.getPlayerState;
 window.updatePlayerUI = window.updatePlayerUI;
 window.shareCurrentTrack = shareCurrentTrack;
+window.toggleRadio = toggleRadio;
+
+if (document.readyState === 'loading') {
+    document.addEventListener('DOMContentLoaded', updateRadioButton);
+} else {
+    updateRadioButton();
+}
 
@@ -14,6 +14,7 @@
         isShuffleOn: false,
         volume: parseFloat(localStorage.getItem('swag_volume') || '1'),
         lyricsData: [],
+        lyricsIdx: -1,
         shuffledIndices: []
     };
     
@@ -131,6 +132,11 @@
             $('search-input').value = init.q;
             $('search-bar').style.display = 'block';
         }
+        
+        // На главной ищем по мере ввода через /api/search, без перезагрузки страницы
+        if (!init.sharedTrack && !init.sharedAlbum) {
+            $('search-input').addEventListener('input', onSearchInput);
+        }
     }
     
     // Album page functions
@@ -149,6 +155,25 @@
     }
     
     // ============= CONTENT =============
+    const TRACKS_PAGE_SIZE = 200;
+    
+    // Все треки по запросу, страницами по limit/next_cursor (без lyrics - текст грузится отдельно)
+    async function fetchTrackPages(query) {
+        const result = [];
+        let cursor = null;
+        do {
+            const params = new URLSearchParams(query);
+            params.set('limit', TRACKS_PAGE_SIZE);
+            if (cursor) params.set('cursor', cursor);
+            const res = await fetch(`/api/tracks?${params}`);
+            if (!res.ok) throw new Error(`HTTP ${res.status}`);
+            const page = await res.json();
+            result.push(...page.tracks);
+            cursor = page.next_cursor;
+        } while (cursor);
+        return result;
+    }
+    
     function loadContent() {
         renderTracks(state.tracks);
         renderAlbums(state.albums);
@@ -164,13 +189,14 @@
         
         container.innerHTML = tracks.map((t, i) => `
             <div class="track-card" onclick="window.SwagPlayer.playTrack(${i})">
-                <img src="${t.cover_filename ? '/uploads/' + t.cover_filename : '/static/img/default-cover.svg'}" 
+                <img src="${t.cover_filename ? thumbUrl(t.cover_filename) : '/static/img/default-cover.svg'}" 
                      onerror="this.src='/static/img/default-cover.svg'">
                 <div class="info">
                     <div class="title">${escHtml(t.title)}</div>
                     <div class="artist">${escHtml(t.artist || '')}</div>
                 </div>
                 <div class="stats">
+                    ${t.duration ? `<span>${formatTime(t.duration)}</span>` : ''}
                     <span><i data-lucide="play" class="w-3 h-3"></i>${t.plays_count || 0}</span>
                     <span><i data-lucide="heart" class="w-3 h-3"></i>${t.likes_count || 0}</span>
                 </div>
@@ -191,7 +217,7 @@
             <a href="/album/${a.slug || a.id}" class="album-card">
                 <div class="cover">
                     ${a.cover_filename 
-                        ? `<img src="/uploads/${a.cover_filename}">`
+                        ? `<img src="${thumbUrl(a.cover_filename)}">`
                         : `<div class="placeholder"><i data-lucide="disc-3" class="w-12 h-12"></i></div>`}
                 </div>
                 <div class="title">${escHtml(a.title)}</div>
@@ -210,7 +236,7 @@
         state.currentTrack = state.tracks[index];
         const t = state.currentTrack;
         
-        audio.src = `/uploads/${t.filename}`;
+        audio.src = trackAudioUrl(t);
         audio.play().catch(() => {});
         
         updateTrackUI();
@@ -219,16 +245,44 @@
         // Count play
         fetch(`/api/tracks/${t.id}/play`, { method: 'POST' }).catch(() => {});
         
-        // Parse lyrics
-        if (t.lyrics) {
-            state.lyricsData = parseLRC(t.lyrics);
+        // Lyrics: готовая шкала с сервера
+        state.lyricsData = [];
+        state.lyricsIdx = -1;
+        if (t.lyrics === undefined || (t.lyrics && t.lyrics.trim())) {
+            $('lyrics-scroll').innerHTML = '';
+            loadLyrics(t);
+        } else {
+            showNoLyrics();
+        }
+    }
+    
+    async function loadLyrics(t) {
+        let data = null;
+        try {
+            const res = await fetch(`/api/tracks/${t.id}/lyrics/timeline`);
+            if (res.ok) {
+                const timeline = await res.json();
+                data = timeline.times.map((ms, i) => ({ t: ms / 1000, text: timeline.lines[i] }));
+            }
+        } catch(e) {}
+        
+        // Запасной вариант - разбор на клиенте
+        if (!data) data = parseLRC(t.lyrics);
+        
+        if (state.currentTrack !== t) return;
+        state.lyricsData = data;
+        state.lyricsIdx = -1;
+        if (data.length) {
             renderLyrics();
         } else {
-            state.lyricsData = [];
-            $('lyrics-scroll').innerHTML = '<p style="text-align:center;color:#666;padding-top:20vh;">Текст недоступен</p>';
+            showNoLyrics();
         }
     }
     
+    function showNoLyrics() {
+        $('lyrics-scroll').innerHTML = '<p style="text-align:center;color:#666;padding-top:20vh;">Текст недоступен</p>';
+    }
+    
     function togglePlay() {
         if (!state.currentTrack) {
             if (state.tracks.length) playTrack(0);
@@ -416,7 +470,7 @@
                 if (text) result.push({ t: time, text });
             }
         });
-        return result;
+        return result.sort((a, b) => a.t - b.t);
     }
     
     function renderLyrics() {
@@ -428,23 +482,36 @@
     
     function updateActiveLyric() {
         const time = audio.currentTime;
-        let activeIdx = -1;
-        state.lyricsData.forEach((l, i) => { if (time >= l.t) activeIdx = i; });
-        
-        const lines = document.querySelectorAll('.lyric-line');
-        lines.forEach((el, i) => {
-            const isActive = i === activeIdx;
-            if (isActive && !el.classList.contains('active')) {
-                el.classList.add('active');
-                gsap.to($('lyrics-scroll'), {
-                    duration: 1,
-                    scrollTo: { y: el.offsetTop - $('lyrics-scroll').offsetHeight / 2 + el.offsetHeight / 2 },
-                    ease: "power3.out"
-                });
-            } else if (!isActive) {
-                el.classList.remove('active');
+        
+        // Бинарный поиск последней строки с t <= time
+        const data = state.lyricsData;
+        let lo = 0, hi = data.length - 1, activeIdx = -1;
+        while (lo <= hi) {
+            const mid = (lo + hi) >> 1;
+            if (data[mid].t <= time) {
+                activeIdx = mid;
+                lo = mid + 1;
+            } else {
+                hi = mid - 1;
             }
-        });
+        }
+        if (activeIdx === state.lyricsIdx) return;
+        
+        const lines = $('lyrics-scroll').querySelectorAll('.lyric-line');
+        if (state.lyricsIdx >= 0 && lines[state.lyricsIdx]) {
+            lines[state.lyricsIdx].classList.remove('active');
+        }
+        state.lyricsIdx = activeIdx;
+        
+        const el = lines[activeIdx];
+        if (el) {
+            el.classList.add('active');
+            gsap.to($('lyrics-scroll'), {
+                duration: 1,
+                scrollTo: { y: el.offsetTop - $('lyrics-scroll').offsetHeight / 2 + el.offsetHeight / 2 },
+                ease: "power3.out"
+            });
+        }
     }
     
     function seekToLyric(time) {
@@ -526,12 +593,11 @@
         $('my-content').style.display = 'block';
         
         try {
-            const [tracksRes, albumsRes] = await Promise.all([
-                fetch(`/api/tracks?user_id=${state.user.id}&show_hidden=true`),
+            const [myTracks, albumsRes] = await Promise.all([
+                fetchTrackPages({ user_id: state.user.id, show_hidden: 'true' }),
                 fetch(`/api/albums?user_id=${state.user.id}`)
             ]);
             
-            const myTracks = await tracksRes.json();
             const myAlbums = await albumsRes.json();
             
             renderMyTracks(myTracks);
@@ -553,7 +619,7 @@
         
         container.innerHTML = tracks.map((t, i) => `
             <div class="track-card" onclick="window.SwagPlayer.playMyTrack(${i})">
-                <img src="${t.cover_filename ? '/uploads/' + t.cover_filename : '/static/img/default-cover.svg'}">
+                <img src="${t.cover_filename ? thumbUrl(t.cover_filename) : '/static/img/default-cover.svg'}">
                 <div class="info">
                     <div class="title">${escHtml(t.title)}</div>
                     <div class="artist">${escHtml(t.artist || '')}</div>
@@ -574,7 +640,7 @@
             <div class="album-card" onclick="window.SwagPlayer.loadAlbum('${a.slug || a.id}')">
                 <div class="cover">
                     ${a.cover_filename 
-                        ? `<img src="/uploads/${a.cover_filename}">`
+                        ? `<img src="${thumbUrl(a.cover_filename)}">`
                         : `<div class="placeholder"><i data-lucide="disc-3" class="w-12 h-12"></i></div>`}
                 </div>
                 <div class="title">${escHtml(a.title)}</div>
@@ -599,6 +665,49 @@
         if (!visible) $('search-input').focus();
     }
     
+    const SEARCH_DEBOUNCE_MS = 250;
+    let searchTimer = null;
+    let searchSeq = 0;
+    
+    function onSearchInput() {
+        clearTimeout(searchTimer);
+        searchTimer = setTimeout(runLiveSearch, SEARCH_DEBOUNCE_MS);
+    }
+    
+    async function runLiveSearch() {
+        const q = $('search-input').value.trim();
+        const seq = ++searchSeq;
+        
+        if (!q) {
+            // Главная без запроса - серверная лента (страница могла открыться с ?q=)
+            if (window.INIT?.q) {
+                window.location.href = '/';
+                return;
+            }
+            state.tracks = window.INIT?.tracks || [];
+            state.albums = window.INIT?.albums || [];
+            renderTracks(state.tracks);
+            renderAlbums(state.albums);
+            return;
+        }
+        
+        try {
+            const res = await fetch(`/api/search?q=${encodeURIComponent(q)}&type=tracks,albums&limit=50`);
+            if (!res.ok) return;
+            const data = await res.json();
+            // Ответ на устаревший запрос (пользователь уже ввел больше) не рисуем
+            if (seq !== searchSeq) return;
+            
+            state.tracks = data.tracks || [];
+            state.albums = data.albums || [];
+            renderTracks(state.tracks);
+            renderAlbums(state.albums);
+            window.history.replaceState(null, '', `/?q=${encodeURIComponent(q)}`);
+        } catch (err) {
+            console.error('Search error:', err);
+        }
+    }
+    
     function performSearch(e) {
         e.preventDefault();
         const q = $('search-input').value.trim();
@@ -763,6 +872,22 @@
         return `${m}:${sec < 10 ? '0' + sec : sec}`;
     }
     
+    // URL миниатюры обложки (64/256/512, WebP или JPEG по Accept)
+    function thumbUrl(filename, size = 256) {
+        return `/thumbs/${size}/${filename}`;
+    }
+    
+    // URL аудио: сервер выбирает версию по битрейту (Save-Data / ECT / Downlink)
+    function audioUrl(filename) {
+        return `/uploads/${filename}?quality=auto`;
+    }
+    
+    // Длинные треки - сегментами HLS, если браузер играет его сам (Safari, iOS, Android)
+    const nativeHls = !!document.createElement('audio').canPlayType('application/vnd.apple.mpegurl');
+    function trackAudioUrl(track) {
+        return track.segmented && nativeHls ? `/hls/${track.filename}/index.m3u8` : audioUrl(track.filename);
+    }
+
     function escHtml(str) {
         if (!str) return '';
         return str.replace(/&/g, '&amp;').replace(/</g, '&lt;').replace(/>/g, '&gt;').replace(/"/g, '&quot;');
@@ -0,0 +1,233 @@
+"""
+Отдача загруженных файлов (аудио и обложек) с поддержкой HTTP Range.
+
+- 206 Partial Content для одного и нескольких диапазонов (multipart/byteranges)
+- сильный ETag по SHA-256 содержимого, If-None-Match / If-Modified-Since / If-Range
+- Cache-Control: immutable для файлов с UUID в имени (их содержимое не меняется)
+- полный файл отдается через wsgi.file_wrapper (sendfile у gunicorn/uwsgi)
+- режимы X-Accel-Redirect (nginx) и X-Sendfile (apache/lighttpd), когда байты
+  отдает фронтенд-сервер, а Flask только проверяет доступ и ставит заголовки
+"""
+import hashlib
+import mimetypes
+import os
+import re
+import threading
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+from flask import Response, request
+from werkzeug.http import http_date, parse_date, parse_etags, parse_range_header, quote_etag
+from werkzeug.security import safe_join
+from werkzeug.wsgi import wrap_file
+
+# Типы, которые mimetypes знает плохо или по-разному на разных системах
+MIME_TYPES = {
+    'mp3': 'audio/mpeg',
+    'wav': 'audio/wav',
+    'ogg': 'audio/ogg',
+    'opus': 'audio/ogg',
+    'm4a': 'audio/mp4',
+    'm3u8': 'application/vnd.apple.mpegurl',
+    'ts': 'video/mp2t',
+    'jpg': 'image/jpeg',
+    'jpeg': 'image/jpeg',
+    'png': 'image/png',
+    'gif': 'image/gif',
+    'webp': 'image/webp',
+    'svg': 'image/svg+xml',
+}
+
+# Файлы с UUID/SHA в имени никогда не перезаписываются - кэшируем навсегда
+IMMUTABLE_NAME_RE = re.compile(r'[0-9a-f]{32}')
+# Имя файла в контентно-адресуемом хранилище - это уже SHA-256 содержимого
+CONTENT_ADDRESSED_RE = re.compile(r'^([0-9a-f]{64})(?:\.\w+)?$')
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+DEFAULT_CACHE_CONTROL = 'public, max-age=86400, must-revalidate'
+
+# Больше диапазонов в одном запросе не обслуживаем - отдаем файл целиком
+MAX_RANGES = 16
+CHUNK_SIZE = 64 * 1024
+ETAG_CACHE_SIZE = 10000
+HASH_BLOCK_SIZE = 1024 * 1024
+
+_etag_cache = OrderedDict()
+_etag_lock = threading.Lock()
+
+
+def guess_mimetype(filename):
+    ext = filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+    return MIME_TYPES.get(ext) or mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+
+def content_etag(path, st):
+    """SHA-256 содержимого файла; кэшируется по (mtime, size)"""
+    match = CONTENT_ADDRESSED_RE.match(os.path.basename(path))
+    if match:
+        return match.group(1)
+
+    key = (st.st_mtime_ns, st.st_size)
+    with _etag_lock:
+        cached = _etag_cache.get(path)
+        if cached and cached[0] == key:
+            _etag_cache.move_to_end(path)
+            return cached[1]
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    etag = digest.hexdigest()
+
+    with _etag_lock:
+        _etag_cache[path] = (key, etag)
+        _etag_cache.move_to_end(path)
+        while len(_etag_cache) > ETAG_CACHE_SIZE:
+            _etag_cache.popitem(last=False)
+    return etag
+
+
+def _resolve_ranges(length):
+    """Диапазоны из заголовка Range -> [(start, end_exclusive)], None - отдать целиком, [] - 416"""
+    header = request.headers.get('Range')
+    if not header:
+        return None
+    parsed = parse_range_header(header)
+    if parsed is None or parsed.units != 'bytes' or len(parsed.ranges) > MAX_RANGES:
+        return None
+
+    ranges = []
+    for start, stop in parsed.ranges:
+        if start < 0:
+            # bytes=-500: последние 500 байт
+            start = max(0, length + start)
+            stop = length
+        elif stop is None or stop > length:
+            stop = length
+        if start < stop:
+            ranges.append((start, stop))
+
+    # Склеиваем пересекающиеся и соседние диапазоны
+    merged = []
+    for start, stop in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+        else:
+            merged.append((start, stop))
+    return merged
+
+
+def _if_range_matches(etag, last_modified):
+    if_range = request.headers.get('If-Range')
+    if not if_range:
+        return True
+    if if_range.startswith(('"', 'W/')):
+        # If-Range требует сильного сравнения
+        return if_range == quote_etag(etag)
+    date = parse_date(if_range)
+    return date is not None and last_modified <= date
+
+
+def _not_modified(etag, last_modified):
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match:
+        return parse_etags(if_none_match).contains_weak(etag)
+    since = parse_date(request.headers.get('If-Modified-Since'))
+    return since is not None and last_modified <= since
+
+
+def _iter_ranges(path, ranges):
+    with open(path, 'rb') as f:
+        for start, stop in ranges:
+            f.seek(start)
+            remaining = stop - start
+            while remaining > 0:
+                block = f.read(min(CHUNK_SIZE, remaining))
+                if not block:
+                    return
+                remaining -= len(block)
+                yield block
+
+
+def _iter_multipart(path, parts, boundary):
+    for header, (start, stop) in parts:
+        yield header
+        yield from _iter_ranges(path, [(start, stop)])
+        yield b'\r\n'
+    yield f'--{boundary}--\r\n'.encode()
+
+
+def send_upload(directory, filename, offload=None, accel_prefix='/protected-uploads/'):
+    """
+    Отдать файл из directory. offload: None, 'x-accel' (nginx) или 'x-sendfile'.
+    Возвращает Response или None, если файла нет.
+    """
+    if any(part.startswith('.') for part in filename.split('/')):
+        # Служебные каталоги (временные файлы хранилища) наружу не отдаем
+        return None
+    path = safe_join(os.path.abspath(directory), filename)
+    if path is None:
+        return None
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    if not os.path.isfile(path):
+        return None
+
+    mimetype = guess_mimetype(filename)
+    length = st.st_size
+    etag = content_etag(path, st)
+    last_modified = datetime.fromtimestamp(int(st.st_mtime), tz=timezone.utc)
+
+    headers = {
+        'ETag': quote_etag(etag),
+        'Last-Modified': http_date(last_modified),
+        'Cache-Control': IMMUTABLE_CACHE_CONTROL if IMMUTABLE_NAME_RE.search(filename) else DEFAULT_CACHE_CONTROL,
+        'Accept-Ranges': 'bytes',
+    }
+
+    if _not_modified(etag, last_modified):
+        return Response(status=304, headers=headers)
+
+    if offload == 'x-accel':
+        # Range, sendfile и кэш отдает nginx (location internal с alias на uploads/)
+        headers['X-Accel-Redirect'] = accel_prefix.rstrip('/') + '/' + filename
+        return Response(status=200, headers=headers, mimetype=mimetype)
+    if offload == 'x-sendfile':
+        headers['X-Sendfile'] = path
+        return Response(status=200, headers=headers, mimetype=mimetype)
+
+    ranges = _resolve_ranges(length) if _if_range_matches(etag, last_modified) else None
+
+    if ranges is None:
+        # Весь файл: wsgi.file_wrapper -> sendfile на стороне WSGI-сервера
+        headers['Content-Length'] = str(length)
+        body = wrap_file(request.environ, open(path, 'rb'), CHUNK_SIZE)
+        return Response(body, status=200, headers=headers, mimetype=mimetype, direct_passthrough=True)
+
+    if not ranges:
+        headers['Content-Range'] = f'bytes */{length}'
+        return Response(status=416, headers=headers)
+
+    if len(ranges) == 1:
+        start, stop = ranges[0]
+        headers['Content-Range'] = f'bytes {start}-{stop - 1}/{length}'
+        headers['Content-Length'] = str(stop - start)
+        return Response(_iter_ranges(path, ranges), status=206, headers=headers,
+                        mimetype=mimetype, direct_passthrough=True)
+
+    # Несколько диапазонов - multipart/byteranges
+    boundary = uuid.uuid4().hex
+    parts = []
+    total = len(f'--{boundary}--\r\n')
+    for start, stop in ranges:
+        part_header = (f'--{boundary}\r\n'
+                       f'Content-Type: {mimetype}\r\n'
+                       f'Content-Range: bytes {start}-{stop - 1}/{length}\r\n\r\n').encode()
+        parts.append((part_header, (start, stop)))
+        total += len(part_header) + (stop - start) + 2
+    headers['Content-Length'] = str(total)
+    return Response(_iter_multipart(path, parts, boundary), status=206, headers=headers,
+                    content_type=f'multipart/byteranges; boundary={boundary}', direct_passthrough=True)
@@ -0,0 +1,83 @@
+import io
+import os
+import sqlite3
+
+import pytest
+
+import blobstore
+
+
+@pytest.fixture
+def store(tmp_path):
+    return blobstore.BlobStore(str(tmp_path))
+
+
+@pytest.fixture
+def conn(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / 'test.db'))
+    blobstore.init_schema(conn)
+    conn.commit()
+    yield conn
+    conn.close()
+
+
+def acquire(conn, store, data=b'audio'):
+    blob = store.ingest(io.BytesIO(data), 'mp3')
+    conn.execute("BEGIN IMMEDIATE")
+    path = blobstore.acquire_blob(conn.cursor(), store, blob)
+    return path
+
+
+def test_release_keeps_file_until_collect(conn, store):
+    path = acquire(conn, store)
+    conn.commit()
+    conn.execute("BEGIN IMMEDIATE")
+    assert blobstore.release_blob(conn.cursor(), store, path) is True
+    conn.commit()
+    assert os.path.exists(store.full_path(path))
+    assert blobstore.collect(conn, store) == 1
+    assert not os.path.exists(store.full_path(path))
+    assert conn.execute("SELECT COUNT(*) FROM blobs").fetchone()[0] == 0
+
+
+def test_rolled_back_release_keeps_file(conn, store):
+    path = acquire(conn, store)
+    conn.commit()
+    conn.execute("BEGIN IMMEDIATE")
+    blobstore.release_blob(conn.cursor(), store, path)
+    conn.rollback()
+    assert blobstore.collect(conn, store) == 0
+    assert os.path.exists(store.full_path(path))
+
+
+def test_reacquire_before_collect_keeps_file(conn, store):
+    path = acquire(conn, store)
+    conn.commit()
+    conn.execute("BEGIN IMMEDIATE")
+    blobstore.release_blob(conn.cursor(), store, path)
+    conn.commit()
+    acquire(conn, store)
+    conn.commit()
+    assert blobstore.collect(conn, store) == 0
+    assert os.path.exists(store.full_path(path))
+
+
+def test_orphan_from_rolled_back_acquire(conn, store):
+    path = acquire(conn, store)
+    conn.rollback()
+    assert os.path.exists(store.full_path(path))
+    # Свежий файл может принадлежать незакоммиченной транзакции
+    assert blobstore.collect(conn, store) == 0
+    assert blobstore.collect(conn, store, orphan_grace=-1) == 1
+    assert not os.path.exists(store.full_path(path))
+
+
+def test_legacy_flat_file_is_collected(conn, store):
+    with open(store.full_path('old.mp3'), 'wb') as f:
+        f.write(b'x')
+    conn.execute("BEGIN IMMEDIATE")
+    assert blobstore.release_blob(conn.cursor(), store, 'old.mp3') is True
+    conn.commit()
+    assert os.path.exists(store.full_path('old.mp3'))
+    assert blobstore.collect(conn, store) == 1
+    assert not os.path.exists(store.full_path('old.mp3'))
@@ -0,0 +1,61 @@
+import json
+
+import pytest
+
+import lyrics
+
+
+@pytest.mark.parametrize('text, times, lines', [
+    # Форматы таймкода: [mm:ss], [mm:ss.x], [mm:ss.xx], [mm:ss.xxx], [mm:ss:xx]
+    ('[00:05]a', [5000], ['a']),
+    ('[00:05.5]a', [5500], ['a']),
+    ('[00:05.05]a', [5050], ['a']),
+    ('[00:05.005]a', [5005], ['a']),
+    ('[00:05:25]a', [5250], ['a']),
+    ('[1:02]a', [62000], ['a']),
+    ('[100:00]a', [6000000], ['a']),
+    # Несколько таймкодов - строка повторяется на каждом
+    ('[00:10][01:20]chorus', [10000, 80000], ['chorus', 'chorus']),
+    # Строки не по порядку сортируются, при равных таймкодах - порядок в тексте
+    ('[00:20]b\n[00:10]a', [10000, 20000], ['a', 'b']),
+    ('[00:10]first\n[00:10]second', [10000, 10000], ['first', 'second']),
+    ('[00:30]c\n[00:10][00:50]x\n[00:20]b', [10000, 20000, 30000, 50000], ['x', 'b', 'c', 'x']),
+    # Метаданные и строки без таймкода пропускаются
+    ('[ar:Artist]\n[ti:Title]\n[00:01]a', [1000], ['a']),
+    ('plain text\nno stamps', [], []),
+    ('', [], []),
+    (None, [], []),
+    # Пробелы вокруг строки и после таймкода обрезаются, \r\n как \n
+    ('  [00:01]  a  \r\n[00:02]b', [1000, 2000], ['a', 'b']),
+    # Таймкод в середине строки - часть текста
+    ('[00:01]a [00:02] b', [1000], ['a [00:02] b']),
+])
+def test_parse_lrc(text, times, lines):
+    timeline = lyrics.parse_lrc(text)
+    assert timeline['times'] == times
+    assert timeline['lines'] == lines
+
+
+@pytest.mark.parametrize('offset, times', [
+    ('[offset:500]', [500, 1500]),
+    ('[offset:+500]', [500, 1500]),
+    ('[offset:-500]', [1500, 2500]),
+    ('[OFFSET: 2000]', [0, 0]),
+])
+def test_parse_lrc_offset(offset, times):
+    """Положительный offset - текст раньше; раньше нуля не бывает"""
+    assert lyrics.parse_lrc(f"{offset}\n[00:01]a\n[00:02]b")['times'] == times
+
+
+def test_parse_lrc_gaps():
+    """Пустые строки и таймкоды без текста - отступы перед следующей строкой"""
+    timeline = lyrics.parse_lrc("[00:01]a\n\n[00:02]\n[00:03]b\n[00:04][00:05]c\n\n\n")
+    assert timeline['lines'] == ['a', 'b', 'c', 'c']
+    assert timeline['gaps'] == [0, 2, 0, 0]
+    assert timeline['tail'] == 2
+
+
+def test_dump_timeline_round_trip():
+    timeline = lyrics.parse_lrc("[00:01]привет")
+    assert json.loads(lyrics.dump_timeline(timeline)) == timeline
+    assert timeline['version'] == lyrics.TIMELINE_VERSION
@@ -0,0 +1,32 @@
+import sqlite3
+
+import playcounter
+
+
+def test_prune_batches_keeps_recent(tmp_path):
+    db_file = str(tmp_path / 'plays.db')
+    conn = sqlite3.connect(db_file)
+    playcounter.init_schema(conn)
+    conn.execute("INSERT INTO play_flush_batches (batch_id, events, flushed_at) VALUES ('old', 1, datetime('now', '-8 days'))")
+    conn.execute("INSERT INTO play_flush_batches (batch_id, events, flushed_at) VALUES ('edge', 1, datetime('now', '-6 days'))")
+    conn.execute("INSERT INTO play_flush_batches (batch_id, events) VALUES ('new', 1)")
+    conn.commit()
+
+    counter = playcounter.PlayCounter(db_file, str(tmp_path / 'spill'))
+    assert counter.prune_batches() == 1
+    assert counter.stats()['pruned_batches'] == 1
+    left = [row[0] for row in conn.execute("SELECT batch_id FROM play_flush_batches ORDER BY batch_id")]
+    assert left == ['edge', 'new']
+    conn.close()
+
+
+def test_recover_prunes(tmp_path):
+    db_file = str(tmp_path / 'plays.db')
+    conn = sqlite3.connect(db_file)
+    playcounter.init_schema(conn)
+    conn.execute("INSERT INTO play_flush_batches (batch_id, events, flushed_at) VALUES ('old', 1, datetime('now', '-30 days'))")
+    conn.commit()
+
+    playcounter.PlayCounter(db_file, str(tmp_path / 'spill')).recover()
+    assert conn.execute("SELECT COUNT(*) FROM play_flush_batches").fetchone()[0] == 0
+    conn.close()
@@ -0,0 +1,94 @@
+import io
+import os
+import sqlite3
+
+import pytest
+
+import blobstore
+import resumable
+
+
+@pytest.fixture
+def store(tmp_path):
+    return blobstore.BlobStore(str(tmp_path))
+
+
+@pytest.fixture
+def conn():
+    conn = sqlite3.connect(':memory:')
+    conn.row_factory = sqlite3.Row
+    resumable.init_schema(conn)
+    yield conn
+    conn.close()
+
+
+DATA = bytes(range(256)) * 40
+
+
+def session(conn, store, size=len(DATA)):
+    upload_id = resumable.create(conn, store, 1, 'a.mp3', 'mp3', size)
+    conn.commit()
+    return upload_id
+
+
+def fetch(conn, upload_id):
+    return conn.execute("SELECT * FROM upload_sessions WHERE id = ?", (upload_id,)).fetchone()
+
+
+def put(conn, store, upload_id, offset, data):
+    return resumable.append(conn, store, fetch(conn, upload_id), offset, io.BytesIO(data), resumable.MAX_CHUNK_SIZE)
+
+
+def test_chunks_in_order_then_adopt(conn, store):
+    upload_id = session(conn, store)
+    assert put(conn, store, upload_id, 0, DATA[:4000]) == 4000
+    assert put(conn, store, upload_id, 4000, DATA[4000:]) == len(DATA)
+    blob = resumable.adopt(store, fetch(conn, upload_id))
+    with open(blob.temp_path, 'rb') as f:
+        assert f.read() == DATA
+    assert blob.size == len(DATA)
+
+
+def test_out_of_order_chunk_is_rejected(conn, store):
+    upload_id = session(conn, store)
+    assert put(conn, store, upload_id, 1000, DATA[1000:2000]) is None
+    assert fetch(conn, upload_id)['received'] == 0
+    assert os.path.getsize(resumable.part_path(store, upload_id)) == 0
+
+
+def test_duplicate_chunk_does_not_shorten_file(conn, store):
+    upload_id = session(conn, store)
+    stale = fetch(conn, upload_id)
+    assert put(conn, store, upload_id, 0, DATA[:3000]) == 3000
+    # Повтор той же части (клиент не дождался ответа) - со старым состоянием сессии
+    retry = resumable.append(conn, store, stale, 0, io.BytesIO(DATA[:1000]), resumable.MAX_CHUNK_SIZE)
+    assert retry is None
+    assert fetch(conn, upload_id)['received'] == 3000
+    assert os.path.getsize(resumable.part_path(store, upload_id)) == 3000
+
+
+def test_chunk_while_session_is_locked_is_rejected(conn, store):
+    import fcntl
+    upload_id = session(conn, store)
+    with open(resumable.part_path(store, upload_id), 'r+b') as busy:
+        fcntl.flock(busy, fcntl.LOCK_EX)
+        assert put(conn, store, upload_id, 0, DATA[:1000]) is None
+    assert put(conn, store, upload_id, 0, DATA[:1000]) == 1000
+
+
+def test_chunk_is_capped_at_declared_size(conn, store):
+    upload_id = session(conn, store, size=100)
+    assert put(conn, store, upload_id, 0, DATA[:500]) == 100
+    assert os.path.getsize(resumable.part_path(store, upload_id)) == 100
+
+
+def test_adopt_rejects_size_mismatch_and_rewind(conn, store):
+    upload_id = session(conn, store)
+    assert put(conn, store, upload_id, 0, DATA) == len(DATA)
+    with open(resumable.part_path(store, upload_id), 'r+b') as f:
+        f.truncate(2000)
+    upload = fetch(conn, upload_id)
+    assert resumable.adopt(store, upload) is None
+    assert resumable.rewind(conn, store, upload) == 2000
+    assert put(conn, store, upload_id, 2000, DATA[2000:]) == len(DATA)
+    assert resumable.adopt(store, fetch(conn, upload_id)) is not None
@@ -0,0 +1,73 @@
+import sqlite3
+
+import pytest
+
+import blobstore
+import transcode
+
+
+@pytest.fixture
+def conn():
+    conn = sqlite3.connect(':memory:')
+    conn.execute("CREATE TABLE tracks (id INTEGER PRIMARY KEY, filename TEXT, bitrate INTEGER)")
+    blobstore.init_schema(conn)
+    transcode.init_schema(conn)
+    yield conn
+    conn.close()
+
+
+def add_source(conn, source, bitrate):
+    """Версии, которые TranscodeQueue.process сделал бы для исходника с таким битрейтом"""
+    for quality in transcode.planned_qualities(bitrate):
+        conn.execute("""INSERT INTO audio_renditions (source, quality, codec, bitrate, source_bitrate, size)
+                        VALUES (?, ?, ?, ?, ?, 1)""",
+                     (source, quality, transcode.CODEC, transcode.LADDER[quality], bitrate))
+
+
+def chosen(conn, source, quality):
+    name = transcode.choose_rendition(conn.cursor(), source, quality)
+    return int(name.split('/')[0]) if name else None
+
+
+@pytest.mark.parametrize('bitrate, expected', [
+    # Исходник не выше запрошенного - оригинал, а не версия хуже него
+    (64, {'low': None, 'medium': None, 'high': None}),
+    (128, {'low': 64, 'medium': None, 'high': None}),
+    (192, {'low': 64, 'medium': 128, 'high': None}),
+    (320, {'low': 64, 'medium': 128, 'high': 256}),
+    (1411, {'low': 64, 'medium': 128, 'high': 256}),
+])
+def test_choose_rendition_by_source_bitrate(conn, bitrate, expected):
+    add_source(conn, 'ab/cd/x.mp3', bitrate)
+    assert {quality: chosen(conn, 'ab/cd/x.mp3', quality) for quality in expected} == expected
+
+
+def test_choose_rendition_original_and_unknown(conn):
+    add_source(conn, 'ab/cd/x.mp3', 320)
+    assert chosen(conn, 'ab/cd/x.mp3', 'original') is None
+    assert chosen(conn, 'ab/cd/x.mp3', 'bogus') is None
+    assert chosen(conn, 'ab/cd/missing.mp3', 'low') is None
+
+
+def test_choose_rendition_not_ready(conn):
+    # Готова только low - для high отдается лучшая готовая ниже цели
+    conn.execute("""INSERT INTO audio_renditions (source, quality, codec, bitrate, source_bitrate, size)
+                    VALUES ('ab/cd/x.wav', 'low', 'mp3', 64, 1411, 1)""")
+    assert chosen(conn, 'ab/cd/x.wav', 'high') == 64
+    assert chosen(conn, 'ab/cd/x.wav', 'medium') == 64
+
+
+def test_choose_rendition_legacy_rows_use_track_bitrate(conn):
+    # Строки без source_bitrate (до миграции) - битрейт исходника из tracks
+    conn.execute("""INSERT INTO audio_renditions (source, quality, codec, bitrate, size)
+                    VALUES ('ab/cd/x.mp3', 'low', 'mp3', 64, 1)""")
+    conn.execute("INSERT INTO tracks (filename, bitrate) VALUES ('ab/cd/x.mp3', 128)")
+    assert chosen(conn, 'ab/cd/x.mp3', 'high') is None
+    assert chosen(conn, 'ab/cd/x.mp3', 'low') == 64
+
+
+def test_auto_quality_hints():
+    assert transcode.auto_quality({}) == 'high'
+    assert transcode.auto_quality({'Save-Data': 'on'}) == 'low'
+    assert transcode.auto_quality({'ECT': '3g'}) == 'low'
+    assert transcode.auto_quality({'Downlink': '2.5'}) == 'medium'
@@ -0,0 +1,60 @@
+import sqlite3
+import time
+from datetime import datetime, timezone
+
+import pytest
+
+import trending
+
+
+@pytest.fixture
+def c():
+    conn = sqlite3.connect(':memory:')
+    conn.execute("CREATE TABLE tracks (id INTEGER PRIMARY KEY, trend_score REAL DEFAULT 0)")
+    conn.execute("INSERT INTO tracks (id) VALUES (1)")
+    yield conn.cursor()
+    conn.close()
+
+
+def sql_time(ts):
+    """unix-время -> формат CURRENT_TIMESTAMP"""
+    return datetime.fromtimestamp(ts, timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def score(c):
+    return c.execute("SELECT trend_score FROM tracks WHERE id = 1").fetchone()[0]
+
+
+def test_apply_events_matches_decayed_sum(c):
+    now = int(time.time())
+    trending.apply_events(c, 'tracks', [(1, 1.0, now), (1, 3.0, now - trending.HALF_LIFE)])
+    # 1 + 3 * 1/2
+    assert trending.current_value(score(c), now) == pytest.approx(2.5)
+
+
+@pytest.mark.parametrize('age_days', [0, 3, 30])
+def test_like_unlike_round_trip(c, age_days):
+    now = int(time.time())
+    trending.apply_events(c, 'tracks', [(1, 40.0, now - 2 * 86400), (1, 10.0, now - 3600)])
+    before = score(c)
+    liked_at = sql_time(now - age_days * 86400)
+    trending.record_like(c, 'tracks', 1, True, liked_at)
+    assert score(c) > before
+    trending.record_like(c, 'tracks', 1, False, liked_at)
+    assert score(c) == pytest.approx(before, abs=1e-9)
+
+
+def test_unlike_only_activity_resets_to_zero(c):
+    liked_at = sql_time(int(time.time()) - 86400)
+    trending.record_like(c, 'tracks', 1, True, liked_at)
+    trending.record_like(c, 'tracks', 1, False, liked_at)
+    assert score(c) == 0.0
+
+
+def test_like_before_epoch_or_unknown_time_is_ignored(c):
+    trending.apply_events(c, 'tracks', [(1, 1.0, int(time.time()))])
+    before = score(c)
+    for liked_at in (sql_time(trending.EPOCH - 86400), None, 'garbage'):
+        trending.record_like(c, 'tracks', 1, True, liked_at)
+        trending.record_like(c, 'tracks', 1, False, liked_at)
+    assert score(c) == before
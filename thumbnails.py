@@ -0,0 +1,261 @@
+"""
+Миниатюры обложек.
+
+Лента рисует десятки обложек, а загружают их в исходном размере (вплоть
+до APIC-картинок на несколько мегабайт). Здесь из исходника делаются
+фиксированные размеры (64/256/512) в WebP и JPEG:
+
+    /thumbs/256/ab/cd/<sha256>.png  ->  thumb_cache/256/ab/cd/<sha256>.png.webp
+
+Миниатюры создаются заранее при загрузке или извлечении обложки и лениво
+при первом запросе (для старых обложек). Каталог кэша ограничен по
+размеру: при превышении удаляются давно не запрашивавшиеся файлы (LRU
+по mtime, который обновляется при каждой отдаче).
+"""
+import os
+import queue
+import threading
+import zlib
+from collections import OrderedDict
+
+from werkzeug.security import safe_join
+
+try:
+    from PIL import Image, ImageOps
+    PIL_AVAILABLE = True
+except ImportError:
+    PIL_AVAILABLE = False
+
+SIZES = (64, 256, 512)
+# Расширение в URL/кэше -> формат Pillow
+FORMATS = {'webp': 'WEBP', 'jpg': 'JPEG'}
+SAVE_OPTIONS = {
+    'webp': {'quality': 80, 'method': 4},
+    'jpg': {'quality': 82, 'optimize': True, 'progressive': True},
+}
+# Что Pillow умеет открывать (SVG отдается как есть)
+SOURCE_EXTENSIONS = {'jpg', 'jpeg', 'png', 'gif', 'webp'}
+
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+LOCK_STRIPES = 64
+
+
+def snap_size(size):
+    """Ближайший поддерживаемый размер не меньше запрошенного"""
+    for allowed in SIZES:
+        if size <= allowed:
+            return allowed
+    return SIZES[-1]
+
+
+def negotiate_format(accept_header):
+    """WebP, если браузер его принимает, иначе JPEG"""
+    return 'webp' if 'image/webp' in (accept_header or '') else 'jpg'
+
+
+def _prepare(img, fmt):
+    """Привести режим изображения к тому, что умеет целевой формат"""
+    has_alpha = img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info)
+    if fmt == 'jpg':
+        if has_alpha:
+            # JPEG без альфа-канала - кладем на белый фон
+            img = img.convert('RGBA')
+            background = Image.new('RGB', img.size, (255, 255, 255))
+            background.paste(img, mask=img.getchannel('A'))
+            return background
+        return img.convert('RGB') if img.mode != 'RGB' else img
+    if has_alpha:
+        return img.convert('RGBA') if img.mode != 'RGBA' else img
+    return img.convert('RGB') if img.mode != 'RGB' else img
+
+
+class ThumbnailCache:
+    """Генерация миниатюр и LRU-кэш на диске с ограничением размера"""
+
+    def __init__(self, source_root, cache_root, max_bytes=DEFAULT_MAX_BYTES):
+        self.source_root = source_root
+        self.cache_root = cache_root
+        self.max_bytes = max_bytes
+        os.makedirs(cache_root, exist_ok=True)
+
+        self._lock = threading.Lock()
+        # Блокировки по хэшу пути: один и тот же размер не генерируется дважды параллельно
+        self._stripes = [threading.Lock() for _ in range(LOCK_STRIPES)]
+        self._entries = None
+        self._total = 0
+        self._queue = queue.Queue()
+        self._thread = None
+        self._stats = {'hits': 0, 'generated': 0, 'evicted': 0, 'errors': 0}
+
+    @staticmethod
+    def supports(filename):
+        return PIL_AVAILABLE and filename.rsplit('.', 1)[-1].lower() in SOURCE_EXTENSIONS
+
+    @staticmethod
+    def thumb_name(filename, size, fmt):
+        return f"{size}/{filename}.{fmt}"
+
+    # === Отдача ===
+
+    def get(self, filename, size, fmt):
+        """
+        Путь миниатюры относительно cache_root (создается при необходимости).
+        None - миниатюру сделать нельзя, отдавать исходник.
+        """
+        if size not in SIZES or fmt not in FORMATS or not self.supports(filename):
+            return None
+        if any(part.startswith('.') for part in filename.split('/')):
+            return None
+        source = safe_join(os.path.abspath(self.source_root), filename)
+        rel = self.thumb_name(filename, size, fmt)
+        target = safe_join(os.path.abspath(self.cache_root), rel)
+        if source is None or target is None:
+            return None
+
+        if self._touch(rel, target):
+            return rel
+
+        with self._stripes[zlib.crc32(rel.encode()) % LOCK_STRIPES]:
+            if self._touch(rel, target):
+                return rel
+            if not os.path.isfile(source):
+                return None
+            try:
+                self._generate(source, target, size, fmt)
+            except Exception as e:
+                print(f"Error generating thumbnail {rel}: {e}")
+                with self._lock:
+                    self._stats['errors'] += 1
+                return None
+            self._register(rel, os.path.getsize(target))
+        return rel
+
+    def _touch(self, rel, target):
+        """Отметить обращение (для LRU); False - файла в кэше нет"""
+        try:
+            os.utime(target)
+        except OSError:
+            return False
+        with self._lock:
+            self._stats['hits'] += 1
+            entries = self._load_entries()
+            if rel in entries:
+                entries.move_to_end(rel)
+        return True
+
+    def _generate(self, source, target, size, fmt):
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        temp = f"{target}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with Image.open(source) as img:
+                img = ImageOps.exif_transpose(img)
+                # thumbnail() сохраняет пропорции и не увеличивает маленькие картинки
+                img.thumbnail((size, size), Image.Resampling.LANCZOS)
+                _prepare(img, fmt).save(temp, FORMATS[fmt], **SAVE_OPTIONS[fmt])
+            os.replace(temp, target)
+        finally:
+            if os.path.exists(temp):
+                os.remove(temp)
+
+    # === LRU ===
+
+    def _load_entries(self):
+        """Список файлов кэша от давно не использованных к свежим (под self._lock)"""
+        if self._entries is None:
+            found = []
+            for dirpath, _, filenames in os.walk(self.cache_root):
+                for name in filenames:
+                    if name.endswith('.tmp'):
+                        continue
+                    full = os.path.join(dirpath, name)
+                    try:
+                        st = os.stat(full)
+                    except OSError:
+                        continue
+                    rel = os.path.relpath(full, self.cache_root).replace(os.sep, '/')
+                    found.append((st.st_mtime, rel, st.st_size))
+            found.sort()
+            self._entries = OrderedDict((rel, size) for _, rel, size in found)
+            self._total = sum(size for _, _, size in found)
+        return self._entries
+
+    def _register(self, rel, size):
+        evict = []
+        with self._lock:
+            entries = self._load_entries()
+            self._total += size - entries.pop(rel, 0)
+            entries[rel] = size
+            self._stats['generated'] += 1
+            while self._total > self.max_bytes and len(entries) > 1:
+                old_rel, old_size = entries.popitem(last=False)
+                self._total -= old_size
+                self._stats['evicted'] += 1
+                evict.append(old_rel)
+        for old_rel in evict:
+            self._remove_file(old_rel)
+
+    def _remove_file(self, rel):
+        try:
+            os.remove(os.path.join(self.cache_root, *rel.split('/')))
+        except OSError:
+            pass
+
+    def discard(self, filename):
+        """Удалить все миниатюры исходника (исходный файл удален)"""
+        for size in SIZES:
+            for fmt in FORMATS:
+                rel = self.thumb_name(filename, size, fmt)
+                with self._lock:
+                    entries = self._load_entries()
+                    if rel in entries:
+                        self._total -= entries.pop(rel)
+                self._remove_file(rel)
+
+    # === Предварительная генерация ===
+
+    def pregenerate(self, filename):
+        """Сделать все размеры и форматы сразу (вызывается из фоновых потоков)"""
+        if not self.supports(filename):
+            return
+        for size in SIZES:
+            for fmt in FORMATS:
+                self.get(filename, size, fmt)
+
+    def schedule(self, filename):
+        """Поставить обложку в очередь на генерацию, не задерживая запрос"""
+        if filename and self.supports(filename):
+            self._queue.put(filename)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='thumbnail-worker', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            filename = self._queue.get()
+            if filename is None:
+                break
+            try:
+                self.pregenerate(filename)
+            except Exception as e:
+                print(f"Error pregenerating thumbnails for {filename}: {e}")
+
+    def stop(self, timeout=5):
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join(timeout=timeout)
+        self._thread = None
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            entries = self._load_entries()
+            stats['files'] = len(entries)
+            stats['bytes'] = self._total
+        stats['max_bytes'] = self.max_bytes
+        stats['queued'] = self._queue.qsize()
+        stats['pil_available'] = PIL_AVAILABLE
+        return stats
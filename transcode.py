@@ -0,0 +1,505 @@
+"""
+Лестница битрейтов для воспроизведения.
+
+Загрузки (mp3/wav/ogg) отдаются как есть, и WAV-трек стоит мобильному
+клиенту десятков мегабайт на каждое прослушивание. Фоновые потоки делают из
+исходника MP3-версии фиксированного битрейта (44.1 кГц, стерео, без
+встроенной обложки):
+
+    renditions/128/ab/cd/<sha256>.wav.mp3
+
+а /uploads/<файл>?quality=low|medium|high|auto отдает подходящую версию
+(auto - по Save-Data/ECT/Downlink). Версии, не меньшие исходника по
+битрейту, не создаются, и если исходник сам не выше запрошенного
+битрейта - отдается оригинал. Пока версий нет
+(или нет кодировщика), тоже отдается оригинал.
+
+Используется только локальный ffmpeg с libmp3lame (путь - TRANSCODE_FFMPEG).
+MP3, а не Opus: Ogg/Opus не воспроизводится во WebView старых iOS.
+Исходники контентно-адресуемые, поэтому версии неизменяемы и привязаны к
+пути исходника, а не к треку: одинаковые файлы кодируются один раз. Файлы
+версий удаляются вместе с исходником (BlobStore.on_remove), строки
+audio_renditions - триггером на blobs.
+
+Длинные треки (от HLS_MIN_DURATION) дополнительно режутся на сегменты
+HLS по HLS_SEGMENT_SECONDS (AAC в MPEG-TS) с плейлистом:
+
+    renditions/hls/ab/cd/<sha256>.wav/index.m3u8, seg00000.ts, ...
+
+Плеер начинает воспроизведение и перематывает, скачивая только нужные
+сегменты, вместо Range-запросов к WAV/VBR MP3, где позиция байта по времени
+не вычисляется. Готовность отмечается в tracks.segmented.
+"""
+import os
+import queue
+import shutil
+import subprocess
+import threading
+import time
+
+from werkzeug.security import safe_join
+
+try:
+    import mutagen
+    MUTAGEN_AVAILABLE = True
+except ImportError:
+    MUTAGEN_AVAILABLE = False
+
+import analysis
+import db
+
+# Качество -> битрейт, кбит/с
+LADDER = {'low': 64, 'medium': 128, 'high': 256}
+QUALITIES = ('original', 'auto') + tuple(LADDER)
+CODEC = 'mp3'
+RENDITION_SAMPLE_RATE = 44100
+# Версия не нужна, если она не меньше исходника хотя бы на 10%
+MIN_SAVING = 0.9
+DEFAULT_WORKERS = 1
+ENCODE_TIMEOUT = 600
+ERROR_MAX_LENGTH = 200
+# Неудачное задание повторяется через RETRY_DELAY, 2*RETRY_DELAY, ... секунд;
+# после MAX_ATTEMPTS попыток остается в transcode_jobs с ошибкой и не повторяется
+MAX_ATTEMPTS = 5
+RETRY_DELAY = 60
+
+# Сегменты HLS для длинных треков (None - выключено)
+HLS_FOLDER = 'hls'
+HLS_PLAYLIST = 'index.m3u8'
+HLS_SEGMENT_SECONDS = 6
+HLS_BITRATE = 128
+DEFAULT_HLS_MIN_DURATION = 600
+
+# Клиентские подсказки о сети (Accept-CH на HTML-страницах)
+CLIENT_HINTS = ('Save-Data', 'ECT', 'Downlink')
+SLOW_ECT = {'slow-2g', '2g', '3g'}
+# Downlink (Мбит/с) ниже порога - low, ниже второго - medium
+DOWNLINK_LOW = 1.0
+DOWNLINK_MEDIUM = 3.0
+
+
+def init_schema(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS audio_renditions
+                 (source TEXT,
+                  quality TEXT,
+                  codec TEXT,
+                  bitrate INTEGER,
+                  size INTEGER,
+                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  PRIMARY KEY (source, quality))''')
+    # Битрейт исходника: версия не выше него, иначе отдается оригинал.
+    # Задержка и добивка кодера - у каждой версии свои (analysis.gapless)
+    for column in ('source_bitrate INTEGER', 'encoder_delay INTEGER', 'encoder_padding INTEGER'):
+        try:
+            c.execute(f"ALTER TABLE audio_renditions ADD COLUMN {column}")
+        except:
+            pass
+    c.execute('''CREATE TABLE IF NOT EXISTS hls_playlists
+                 (source TEXT PRIMARY KEY,
+                  segment_seconds INTEGER,
+                  segments INTEGER,
+                  size INTEGER,
+                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS transcode_jobs
+                 (source TEXT PRIMARY KEY,
+                  attempts INTEGER DEFAULT 0,
+                  error TEXT,
+                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+    try:
+        c.execute("ALTER TABLE transcode_jobs ADD COLUMN failed_at INTEGER")
+    except:
+        pass
+    c.execute("DROP TRIGGER IF EXISTS renditions_blobs_ad")
+    c.execute("""CREATE TRIGGER renditions_blobs_ad AFTER DELETE ON blobs BEGIN
+                     DELETE FROM audio_renditions WHERE source = old.path;
+                     DELETE FROM hls_playlists WHERE source = old.path;
+                     DELETE FROM transcode_jobs WHERE source = old.path;
+                 END""")
+
+
+def add_job(c, source):
+    """Поставить исходник в очередь (в транзакции роута; после commit - TranscodeQueue.submit)"""
+    c.execute("INSERT OR IGNORE INTO transcode_jobs (source) VALUES (?)", (source,))
+
+
+def find_ffmpeg(path=None):
+    """Путь к ffmpeg с libmp3lame или None"""
+    binary = shutil.which(path or 'ffmpeg')
+    if not binary:
+        return None
+    try:
+        result = subprocess.run([binary, '-hide_banner', '-encoders'], capture_output=True,
+                                text=True, timeout=10)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return binary if 'libmp3lame' in result.stdout else None
+
+
+def source_info(path):
+    """(битрейт в кбит/с, длительность в секундах) исходника; None - не удалось определить"""
+    if not MUTAGEN_AVAILABLE:
+        return None, None
+    try:
+        audio = mutagen.File(path)
+    except Exception:
+        return None, None
+    if audio is None:
+        return None, None
+    bitrate = getattr(audio.info, 'bitrate', 0)
+    duration = getattr(audio.info, 'length', 0)
+    return (bitrate // 1000 if bitrate else None), (duration or None)
+
+
+def planned_qualities(bitrate):
+    """Ступени лестницы, которые имеет смысл делать для исходника с таким битрейтом"""
+    if not bitrate:
+        return list(LADDER)
+    return [quality for quality, kbps in LADDER.items() if kbps < bitrate * MIN_SAVING]
+
+
+def auto_quality(headers):
+    """Качество по клиентским подсказкам; по умолчанию high"""
+    if headers.get('Save-Data', '').lower() == 'on':
+        return 'low'
+    if headers.get('ECT', '').lower() in SLOW_ECT:
+        return 'low'
+    try:
+        downlink = float(headers.get('Downlink', ''))
+    except ValueError:
+        return 'high'
+    if downlink < DOWNLINK_LOW:
+        return 'low'
+    if downlink < DOWNLINK_MEDIUM:
+        return 'medium'
+    return 'high'
+
+
+def choose_quality(c, source, quality):
+    """
+    Ступень, которая будет отдана на запрос качества quality, или None -
+    отдавать оригинал. Если исходник не выше запрошенного
+    битрейта - оригинал; иначе лучшая готовая версия ниже и запрошенного
+    битрейта, и исходника. Нет такой - оригинал (еще не перекодирован).
+    """
+    target = LADDER.get(quality)
+    if target is None:
+        return None
+    # Строки до появления source_bitrate - битрейт исходника берется из трека
+    c.execute("""SELECT r.quality, r.bitrate,
+                        COALESCE(r.source_bitrate, (SELECT MAX(t.bitrate) FROM tracks t WHERE t.filename = r.source))
+                 FROM audio_renditions r WHERE r.source = ?""", (source,))
+    rows = c.fetchall()
+    if not rows:
+        return None
+    source_bitrate = rows[0][2]
+    if source_bitrate and source_bitrate <= target:
+        return None
+    ready = [(row[1], row[0]) for row in rows
+             if row[1] <= target and (not source_bitrate or row[1] < source_bitrate)]
+    if not ready:
+        return None
+    return max(ready)[1]
+
+
+def choose_rendition(c, source, quality):
+    """Путь версии (относительно каталога версий) для запрошенного качества или None - оригинал"""
+    chosen = choose_quality(c, source, quality)
+    return rendition_name(source, chosen) if chosen else None
+
+
+def rendition_gapless(c, source, quality):
+    """(задержка, добивка) версии в отсчетах RENDITION_SAMPLE_RATE; (None, None) - неизвестно"""
+    c.execute("SELECT encoder_delay, encoder_padding FROM audio_renditions WHERE source = ? AND quality = ?",
+              (source, quality))
+    row = c.fetchone()
+    return (row[0], row[1]) if row else (None, None)
+
+
+def retry_delay(attempts):
+    """Пауза перед следующей попыткой после attempts неудачных, сек"""
+    return RETRY_DELAY * 2 ** (max(attempts, 1) - 1)
+
+
+def rendition_name(source, quality):
+    return f"{LADDER[quality]}/{source}.{CODEC}"
+
+
+def hls_name(source, name=HLS_PLAYLIST):
+    """Путь плейлиста (или сегмента) относительно каталога версий"""
+    return f"{HLS_FOLDER}/{source}/{name}"
+
+
+class TranscodeQueue:
+    """Очередь перекодирования с пулом рабочих потоков"""
+
+    def __init__(self, db_file, source_root, output_root, ffmpeg=None, workers=DEFAULT_WORKERS,
+                 hls_min_duration=DEFAULT_HLS_MIN_DURATION):
+        self.db_file = db_file
+        self.source_root = source_root
+        self.output_root = output_root
+        self.ffmpeg = ffmpeg
+        self.workers = workers
+        self.hls_min_duration = hls_min_duration
+        os.makedirs(output_root, exist_ok=True)
+        self._queue = queue.Queue()
+        self._threads = []
+        self._timers = {}
+        self._lock = threading.Lock()
+        self._stats = {'submitted': 0, 'processed': 0, 'failed': 0, 'retried': 0, 'given_up': 0,
+                       'renditions': 0, 'playlists': 0, 'bytes_in': 0, 'bytes_out': 0}
+
+    @property
+    def enabled(self):
+        return self.ffmpeg is not None
+
+    def submit(self, source):
+        if not self.enabled or not source:
+            return
+        with self._lock:
+            self._stats['submitted'] += 1
+        self._queue.put(source)
+
+    def recover(self):
+        """Поставить в очередь задания, не доделанные до перезапуска (неудачные - по расписанию повторов)"""
+        if not self.enabled:
+            return 0
+        conn = db.connect(self.db_file)
+        try:
+            jobs = conn.execute("""SELECT source, attempts, failed_at FROM transcode_jobs
+                                   WHERE attempts < ? ORDER BY created_at""", (MAX_ATTEMPTS,)).fetchall()
+        finally:
+            conn.close()
+        now = time.time()
+        for source, attempts, failed_at in jobs:
+            delay = failed_at + retry_delay(attempts) - now if attempts and failed_at else 0
+            if delay > 0:
+                self._retry_later(source, delay)
+            else:
+                self.submit(source)
+        return len(jobs)
+
+    def _retry_later(self, source, delay):
+        timer = threading.Timer(delay, self._retry, (source,))
+        timer.daemon = True
+        with self._lock:
+            self._timers[source] = timer
+        timer.start()
+
+    def _retry(self, source):
+        with self._lock:
+            self._timers.pop(source, None)
+            self._stats['retried'] += 1
+        self.submit(source)
+
+    # === Рабочие потоки ===
+
+    def start(self):
+        if self._threads or not self.enabled:
+            return
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f'transcode-worker-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _run(self):
+        while True:
+            source = self._queue.get()
+            if source is None:
+                break
+            try:
+                self.process(source)
+                outcome = 'processed'
+            except Exception as e:
+                print(f"Error transcoding {source}: {e}")
+                attempts = self._mark_failed(source, e)
+                outcome = 'failed'
+                if attempts is not None and attempts < MAX_ATTEMPTS:
+                    self._retry_later(source, retry_delay(attempts))
+                elif attempts is not None:
+                    with self._lock:
+                        self._stats['given_up'] += 1
+            with self._lock:
+                self._stats[outcome] += 1
+
+    def stop(self, timeout=5):
+        with self._lock:
+            timers, self._timers = list(self._timers.values()), {}
+        for timer in timers:
+            timer.cancel()
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join(timeout=timeout)
+        self._threads = []
+
+    # === Перекодирование одного исходника ===
+
+    def process(self, source):
+        source_path = safe_join(os.path.abspath(self.source_root), source)
+        conn = db.connect(self.db_file)
+        try:
+            if source_path is None or not os.path.isfile(source_path):
+                # Исходник удален, пока задание ждало очереди
+                conn.execute("DELETE FROM transcode_jobs WHERE source = ?", (source,))
+                conn.commit()
+                return
+
+            c = conn.cursor()
+            c.execute("SELECT quality, encoder_delay FROM audio_renditions WHERE source = ?", (source,))
+            done = {row[0]: row[1] for row in c.fetchall()}
+            bitrate, duration = source_info(source_path)
+            for quality in planned_qualities(bitrate):
+                if quality in done:
+                    if done[quality] is None:
+                        # Версия сделана до появления encoder_delay
+                        delay, padding = analysis.gapless(self._output_path(source, quality))
+                        c.execute("""UPDATE audio_renditions SET encoder_delay = ?, encoder_padding = ?
+                                     WHERE source = ? AND quality = ?""", (delay, padding, source, quality))
+                        conn.commit()
+                    continue
+                size = self._encode(source_path, source, quality)
+                delay, padding = analysis.gapless(self._output_path(source, quality))
+                c.execute("""INSERT OR REPLACE INTO audio_renditions
+                                 (source, quality, codec, bitrate, source_bitrate, size, encoder_delay, encoder_padding)
+                             VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                          (source, quality, CODEC, LADDER[quality], bitrate, size, delay, padding))
+                conn.commit()
+                with self._lock:
+                    self._stats['renditions'] += 1
+                    self._stats['bytes_in'] += os.path.getsize(source_path)
+                    self._stats['bytes_out'] += size
+
+            if self.hls_min_duration and duration and duration >= self.hls_min_duration:
+                c.execute("SELECT 1 FROM hls_playlists WHERE source = ?", (source,))
+                if not c.fetchone():
+                    segments, size = self._segment(source_path, source)
+                    c.execute("""INSERT OR REPLACE INTO hls_playlists (source, segment_seconds, segments, size)
+                                 VALUES (?, ?, ?, ?)""", (source, HLS_SEGMENT_SECONDS, segments, size))
+                    with self._lock:
+                        self._stats['playlists'] += 1
+                c.execute("UPDATE tracks SET segmented = 1 WHERE filename = ? AND COALESCE(segmented, 0) = 0",
+                          (source,))
+            c.execute("DELETE FROM transcode_jobs WHERE source = ?", (source,))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _output_path(self, source, quality):
+        return safe_join(os.path.abspath(self.output_root), rendition_name(source, quality))
+
+    def _encode(self, source_path, source, quality):
+        """Закодировать одну ступень; возвращает размер файла"""
+        target = self._output_path(source, quality)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        temp = f"{target}.{os.getpid()}.{threading.get_ident()}.tmp"
+        command = [self.ffmpeg, '-hide_banner', '-loglevel', 'error', '-nostdin', '-y',
+                   '-i', source_path, '-map', '0:a:0', '-vn', '-map_metadata', '-1',
+                   '-ar', str(RENDITION_SAMPLE_RATE), '-ac', '2', '-codec:a', 'libmp3lame', '-b:a', f"{LADDER[quality]}k",
+                   '-f', 'mp3', temp]
+        try:
+            result = subprocess.run(command, capture_output=True, text=True, timeout=ENCODE_TIMEOUT)
+            if result.returncode != 0:
+                raise RuntimeError(result.stderr.strip()[-ERROR_MAX_LENGTH:] or f"ffmpeg exit {result.returncode}")
+            os.replace(temp, target)
+        finally:
+            if os.path.exists(temp):
+                os.remove(temp)
+        return os.path.getsize(target)
+
+    def _segment(self, source_path, source):
+        """Нарезать исходник на сегменты HLS; возвращает (число сегментов, размер)"""
+        target = safe_join(os.path.abspath(self.output_root), os.path.dirname(hls_name(source)))
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        # Каталог собирается рядом и подменяется целиком - плейлист без части сегментов не отдается
+        temp = f"{target}.{os.getpid()}.{threading.get_ident()}.tmp"
+        shutil.rmtree(temp, ignore_errors=True)
+        os.makedirs(temp)
+        command = [self.ffmpeg, '-hide_banner', '-loglevel', 'error', '-nostdin', '-y',
+                   '-i', source_path, '-map', '0:a:0', '-vn', '-map_metadata', '-1',
+                   '-ar', '44100', '-ac', '2', '-codec:a', 'aac', '-b:a', f"{HLS_BITRATE}k",
+                   '-f', 'hls', '-hls_time', str(HLS_SEGMENT_SECONDS), '-hls_playlist_type', 'vod',
+                   '-hls_segment_filename', os.path.join(temp, 'seg%05d.ts'),
+                   os.path.join(temp, HLS_PLAYLIST)]
+        try:
+            result = subprocess.run(command, capture_output=True, text=True, timeout=ENCODE_TIMEOUT)
+            if result.returncode != 0:
+                raise RuntimeError(result.stderr.strip()[-ERROR_MAX_LENGTH:] or f"ffmpeg exit {result.returncode}")
+            shutil.rmtree(target, ignore_errors=True)
+            os.replace(temp, target)
+        finally:
+            shutil.rmtree(temp, ignore_errors=True)
+        names = os.listdir(target)
+        segments = sum(1 for name in names if name.endswith('.ts'))
+        return segments, sum(os.path.getsize(os.path.join(target, name)) for name in names)
+
+    def _mark_failed(self, source, error):
+        """Записать неудачную попытку; возвращает число попыток (None - задания уже нет)"""
+        conn = db.connect(self.db_file)
+        try:
+            conn.execute("""UPDATE transcode_jobs SET attempts = attempts + 1, error = ?, failed_at = ?
+                            WHERE source = ?""", (str(error)[:ERROR_MAX_LENGTH], int(time.time()), source))
+            row = conn.execute("SELECT attempts FROM transcode_jobs WHERE source = ?", (source,)).fetchone()
+            conn.commit()
+            return row[0] if row else None
+        except Exception as e:
+            print(f"Error marking transcode job {source} as failed: {e}")
+            return None
+        finally:
+            conn.close()
+
+    def discard(self, source):
+        """Удалить все версии исходника (исходный файл удален)"""
+        for quality in LADDER:
+            target = self._output_path(source, quality)
+            if target and os.path.exists(target):
+                try:
+                    os.remove(target)
+                except OSError:
+                    pass
+        playlist = safe_join(os.path.abspath(self.output_root), os.path.dirname(hls_name(source)))
+        if playlist:
+            shutil.rmtree(playlist, ignore_errors=True)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['waiting_retry'] = len(self._timers)
+        stats['queued'] = self._queue.qsize()
+        stats['workers'] = len(self._threads)
+        stats['encoder'] = self.ffmpeg
+        return stats
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Перекодировать треки без готовых версий')
+    parser.add_argument('--db', default='music.db', help='файл базы данных')
+    parser.add_argument('--uploads', default='uploads', help='каталог загрузок')
+    parser.add_argument('--output', default=os.environ.get('RENDITIONS_FOLDER', 'renditions'),
+                        help='каталог версий')
+    parser.add_argument('--hls-min-duration', type=int,
+                        default=int(os.environ.get('HLS_MIN_DURATION', DEFAULT_HLS_MIN_DURATION)),
+                        help='резать на сегменты HLS треки от этой длительности, сек (0 - не резать)')
+    args = parser.parse_args()
+
+    ffmpeg = find_ffmpeg(os.environ.get('TRANSCODE_FFMPEG'))
+    if not ffmpeg:
+        raise SystemExit("ffmpeg with libmp3lame not found")
+
+    setup = db.connect(args.db)
+    init_schema(setup)
+    sources = [row[0] for row in setup.execute("SELECT DISTINCT filename FROM tracks WHERE filename IS NOT NULL")]
+    setup.commit()
+    setup.close()
+
+    transcoder = TranscodeQueue(args.db, args.uploads, args.output, ffmpeg=ffmpeg,
+                                hls_min_duration=args.hls_min_duration)
+    for source in sources:
+        try:
+            transcoder.process(source)
+        except Exception as e:
+            print(f"{source}: {e}")
+    stats = transcoder.stats()
+    print(f"Sources {len(sources)}, new renditions {stats['renditions']}, playlists {stats['playlists']}, "
+          f"{stats['bytes_in']} -> {stats['bytes_out']} bytes")
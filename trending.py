@@ -0,0 +1,126 @@
+"""
+Рейтинг "в тренде" с экспоненциальным затуханием.
+
+Каждое прослушивание и лайк дают вклад weight * 2^(-возраст / HALF_LIFE).
+Хранить затухающую сумму напрямую нельзя - ее пришлось бы пересчитывать
+у всех строк каждый час. Поэтому хранится log2 суммы вкладов, приведенных
+к фиксированной эпохе:
+
+    trend_score = log2( sum weight_i * 2^((ts_i - EPOCH) / HALF_LIFE) )
+
+Сдвиг "текущего момента" уменьшает все значения на одну и ту же величину,
+так что порядок по trend_score всегда совпадает с порядком по затухающей
+сумме. Новое событие просто добавляется к сумме (logaddexp), а лента
+сортируется по обычному индексу - так же дешево, как по дате.
+
+0 - у объекта нет активности (вклады до EPOCH тоже считаются нулем).
+"""
+import math
+from datetime import datetime, timezone
+
+# 2024-01-01 UTC
+EPOCH = 1704067200
+# При изменении периода полураспада сохраненные значения нужно пересчитать (rebuild)
+HALF_LIFE = 24 * 3600
+
+PLAY_WEIGHT = 1.0
+LIKE_WEIGHT = 5.0
+
+# Таблица -> (лайки, колонка объекта в таблице лайков)
+LIKE_TABLES = {'tracks': ('likes', 'track_id'), 'albums': ('album_likes', 'album_id')}
+IDS_CHUNK = 500
+
+
+def event_key(weight, ts):
+    """log2 вклада события, приведенного к эпохе"""
+    return math.log2(weight) + (ts - EPOCH) / HALF_LIFE
+
+
+def add_keys(a, b):
+    """log2(2^a + 2^b); a <= 0 - пустая сумма"""
+    if a <= 0:
+        return max(b, 0.0)
+    high, low = max(a, b), min(a, b)
+    return high + math.log2(1 + 2 ** (low - high))
+
+
+def subtract_key(a, b):
+    """log2(2^a - 2^b) (снятый лайк); не меньше 0"""
+    if a <= 0 or b >= a:
+        return 0.0
+    return max(a + math.log2(1 - 2 ** (b - a)), 0.0)
+
+
+def current_value(score, now):
+    """Затухающая сумма на момент now (для отладки и админки)"""
+    if score <= 0:
+        return 0.0
+    return 2 ** (score - (now - EPOCH) / HALF_LIFE)
+
+
+def apply_events(c, table, events):
+    """
+    Добавить события к trend_score (внутри транзакции вызывающего).
+    events - [(id, weight, unix-время)]; отрицательный weight снимает вклад.
+    """
+    added = {}
+    removed = {}
+    for item_id, weight, ts in events:
+        target = added if weight > 0 else removed
+        key = event_key(abs(weight), ts)
+        target[item_id] = add_keys(target[item_id], key) if item_id in target else key
+    ids = list(set(added) | set(removed))
+    updates = []
+    for i in range(0, len(ids), IDS_CHUNK):
+        chunk = ids[i:i + IDS_CHUNK]
+        c.execute(f"SELECT id, trend_score FROM {table} WHERE id IN ({','.join('?' * len(chunk))})", chunk)
+        for item_id, score in c.fetchall():
+            score = score or 0.0
+            if item_id in added:
+                score = add_keys(score, added[item_id])
+            if item_id in removed:
+                score = subtract_key(score, removed[item_id])
+            updates.append((score, item_id))
+    c.executemany(f"UPDATE {table} SET trend_score = ? WHERE id = ?", updates)
+
+
+def record_like(c, table, item_id, liked, created_at):
+    """
+    Лайк (или его снятие) трека/альбома. created_at - likes.created_at
+    этого лайка: при снятии вычитается ровно тот вклад, что был добавлен.
+    """
+    ts = _timestamp(created_at)
+    if ts is None or ts <= EPOCH:
+        # Такой лайк в рейтинг не попадал (см. rebuild)
+        return
+    weight = LIKE_WEIGHT if liked else -LIKE_WEIGHT
+    apply_events(c, table, [(item_id, weight, ts)])
+
+
+def _timestamp(value):
+    """CURRENT_TIMESTAMP SQLite ('YYYY-MM-DD HH:MM:SS', UTC) -> unix-время"""
+    try:
+        return datetime.strptime(value, '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+def rebuild(c):
+    """
+    Пересчитать рейтинг по истории (при появлении колонки): лайки и
+    track_plays (число прослушиваний - на момент последнего).
+    Анонимные прослушивания поштучно не хранились и не учитываются.
+    """
+    for table in LIKE_TABLES:
+        c.execute(f"UPDATE {table} SET trend_score = 0")
+
+    for table, (likes_table, column) in LIKE_TABLES.items():
+        c.execute(f"SELECT {column}, created_at FROM {likes_table}")
+        events = [(row[0], LIKE_WEIGHT, ts) for row in c.fetchall()
+                  if (ts := _timestamp(row[1])) is not None and ts > EPOCH]
+        apply_events(c, table, events)
+
+    c.execute("SELECT track_id, play_count, last_played_at FROM track_plays WHERE play_count > 0")
+    events = [(row[0], PLAY_WEIGHT * row[1], ts) for row in c.fetchall()
+              if (ts := _timestamp(row[2])) is not None and ts > EPOCH]
+    apply_events(c, 'tracks', events)